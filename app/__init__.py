@@ -8,10 +8,23 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from depot.manager import DepotManager
 
-from app.config import DB_USERNAME, DB_PASSWORD, DB_NAME, DATA_ROOT
+from app.config import DB_USERNAME, DB_PASSWORD, DB_NAME, DATA_ROOT, DB_POOL_SIZE, DB_MAX_OVERFLOW, \
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, UPLOAD_MAX_SIZE, FILE_OFFLOAD, FILE_ACCEL_PREFIX, \
+    FILE_CACHE_MAX_AGE, JOB_WORKERS
 
 DB_URI = "postgresql+pg8000://%s:%s@db:5432/%s" % (DB_USERNAME, DB_PASSWORD, DB_NAME)
 
+class PooledSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy extension with instrumented connection pool and pre-ping support. """
+    def apply_pool_defaults(self, app, options):
+        """ Apply connection pool configuration to engine options. """
+        super(PooledSQLAlchemy, self).apply_pool_defaults(app, options)
+        # Pool options are not applicable to single-connection pools of SQLite
+        if "pool_size" in options:
+            from app.util.pool import InstrumentedQueuePool
+            options["poolclass"] = InstrumentedQueuePool
+            options["pool_pre_ping"] = app.config.get("SQLALCHEMY_POOL_PRE_PING", False)
+
 def setup_app(app_name=__name__, db_uri=None):
     """
     Set up Flask application and database.
@@ -26,18 +39,33 @@ def setup_app(app_name=__name__, db_uri=None):
     # Application configuration
     app.config.update({
         "SQLALCHEMY_DATABASE_URI": db_uri,
-        "SQLALCHEMY_TRACK_MODIFICATIONS": False
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "MAX_CONTENT_LENGTH": UPLOAD_MAX_SIZE
     })
+    # Connection pool configuration
+    if not db_uri.startswith("sqlite"):
+        app.config.update({
+            "SQLALCHEMY_POOL_SIZE": DB_POOL_SIZE,
+            "SQLALCHEMY_MAX_OVERFLOW": DB_MAX_OVERFLOW,
+            "SQLALCHEMY_POOL_TIMEOUT": DB_POOL_TIMEOUT,
+            "SQLALCHEMY_POOL_RECYCLE": DB_POOL_RECYCLE,
+            "SQLALCHEMY_POOL_PRE_PING": DB_POOL_PRE_PING
+        })
     # Database object
-    db = SQLAlchemy(app)
+    db = PooledSQLAlchemy(app)
     # Depot
+    from app.util.files import FileServeMiddleware
     DepotManager.configure("default", {
+        "depot.backend": "app.util.files.ContentAddressedStorage",
         "depot.storage_path": DATA_ROOT
     })
-    app.wsgi_app = DepotManager.make_middleware(app.wsgi_app, replace_wsgi_filewrapper=True)
+    app.wsgi_app = FileServeMiddleware(app.wsgi_app, offload=FILE_OFFLOAD, accel_prefix=FILE_ACCEL_PREFIX,
+        cache_max_age=FILE_CACHE_MAX_AGE)
+    DepotManager.set_middleware(app.wsgi_app)
     # Import all related modules
     import_module("app.models")
     import_module("app.views")
+    import_module("app.jobs")
 
 def run_app(**kwargs):
     """
@@ -78,6 +106,64 @@ def run_test(**kwargs):
     TextTestRunner().run(tests)
     # unittest.main(module='app.tests')
 
+def run_bench(**kwargs):
+    """
+    Seed a synthetic dataset, benchmark API endpoints and print the report as JSON.
+
+    Args:
+        kwargs: Keyword arguments containing backend runtime configurations.
+    """
+    from json import dumps
+    from app.bench import seed_dataset, bench_endpoints
+    setup_app(db_uri=kwargs.get("bench_db") or "sqlite://")
+    # Reset database
+    if kwargs.get("reset"):
+        db.drop_all()
+    db.create_all()
+    # Benchmark
+    seed = kwargs.get("seed") or 0
+    id_ranges = seed_dataset(scale=kwargs.get("bench_scale") or 1, seed=seed)
+    report = bench_endpoints(id_ranges, n_requests=kwargs.get("bench_requests") or 200, seed=seed)
+    print(dumps(report, indent=2, sort_keys=True))
+
+def run_upgrade(**kwargs):
+    """
+    Upgrade existing database in place with missing columns, primary keys and indexes.
+    Resembles Django's "manage.py migrate" command.
+
+    Args:
+        kwargs: Keyword arguments containing backend runtime configurations.
+    """
+    from app.util.migrate import upgrade_db
+    setup_app(db_uri=DB_URI)
+    for change in upgrade_db(db):
+        print("Added %s" % change)
+
+def run_recount(**kwargs):
+    """
+    Recompute denormalized counters of existing database in bulk.
+
+    Args:
+        kwargs: Keyword arguments containing backend runtime configurations.
+    """
+    from app.util.data import recount_counters
+    setup_app(db_uri=DB_URI)
+    with db.engine.begin() as conn:
+        for counter, n_rows in recount_counters(conn).items():
+            print("Repaired %d rows of %s" % (n_rows, counter))
+
+def run_worker(**kwargs):
+    """
+    Run background job workers until interrupted.
+
+    Args:
+        kwargs: Keyword arguments containing backend runtime configurations.
+    """
+    from app.util.jobs import Worker
+    setup_app(db_uri=DB_URI)
+    db.create_all()
+    Worker(app, n_threads=kwargs.get("workers") or JOB_WORKERS).run()
+
 def run_shell(**kwargs):
     """
     Run an interactive Python shell with application and database set up.
@@ -96,7 +182,11 @@ def run_shell(**kwargs):
 __mode_handler_mapping = {
     "app": run_app,
     "test": run_test,
-    "shell": run_shell
+    "shell": run_shell,
+    "bench": run_bench,
+    "upgrade": run_upgrade,
+    "recount": run_recount,
+    "worker": run_worker
 }
 
 def run_with_mode(mode, **kwargs):
@@ -0,0 +1,189 @@
+""" Micro-benchmarks of backend hot paths and endpoint benchmarks. """
+import json, random, tracemalloc
+from timeit import default_timer
+
+import app
+from app.seed import WORDS
+from app.util.test import create_json_param
+
+# Password of benchmark users
+BENCH_PASSWORD = "bench_pass"
+
+def bench_dump_data(n_objects=500, n_rounds=5, nested=("owners", "notes.author")):
+    """
+    Compare per-object serialization cost of a fresh schema instance with the cached dump plan.
+    Cost of batch-resolving relationships, shared by both methods, is reported separately.
+    Benchmark data is added to current database.
+
+    Args:
+        n_objects: Amount of papers to be serialized.
+        n_rounds: Amount of rounds for each serialization method. Best round is reported.
+        nested: Nested fields to be serialized.
+    Returns:
+        Per-object serialization cost in microseconds, keyed by serialization method.
+    """
+    from app.models import User, Paper, Note
+    from app.schemas import PaperSchema
+    from app.util.data import dump_data, get_dump_plan
+    db = app.db
+    # Dataset
+    users = [User(username="bench_user_%d" % i) for i in range(n_objects)]
+    db.session.add_all(users)
+    for i in range(n_objects):
+        paper = Paper(title="bench_paper_%d" % i)
+        paper.owners.append(users[i])
+        paper.collectors.append(users[(i+1)%n_objects])
+        db.session.add(paper)
+        db.session.add(Note(title="bench_note_%d" % i, author=users[i], paper=paper))
+    db.session.commit()
+    papers = Paper.query.filter(Paper.title.like("bench_paper_%")).all()
+    # Serialization methods
+    plan = get_dump_plan(PaperSchema, nested)
+    methods = {
+        "schema_instance": lambda: dump_data(PaperSchema(many=True), papers, nested=nested),
+        "dump_plan": lambda: dump_data(PaperSchema, papers, nested=nested, many=True),
+        "prefetch": lambda: plan.prefetch(papers)
+    }
+    assert methods["schema_instance"]()==methods["dump_plan"](), "Serialization results differ."
+    # Best round of each method
+    result = {}
+    for name, method in methods.items():
+        costs = []
+        for _ in range(n_rounds):
+            start = default_timer()
+            method()
+            costs.append(default_timer()-start)
+        result[name] = min(costs)/n_objects*1e6
+    return result
+
+def seed_dataset(scale=1, seed=0):
+    """
+    Seed a synthetic dataset for endpoint benchmarks with "seed_database".
+
+    Args:
+        scale: Dataset scale. Each unit adds 100 users, 10 groups, 500 papers and 1000 notes.
+        seed: Random seed of the dataset.
+    Returns:
+        A dictionary with primary key ranges of seeded elements, keyed by model name.
+    """
+    from app.models import User, Paper, Note
+    from app.seed import seed_database
+    from app.util.password import new_password
+    result = seed_database(
+        n_users=100*scale,
+        n_papers=500*scale,
+        n_notes=1000*scale,
+        n_groups=10*scale,
+        seed=seed,
+        password=new_password(BENCH_PASSWORD)
+    )
+    return {
+        model.__name__: (result[model.__tablename__]["first_id"], result[model.__tablename__]["last_id"])
+        for model in (User, Paper, Note)
+    }
+
+def bench_scenarios(id_ranges, rng):
+    """
+    Get endpoint benchmark scenarios.
+
+    Args:
+        id_ranges: Primary key ranges of seeded elements, keyed by model name.
+        rng: Random number generator.
+    Returns:
+        A dictionary mapping scenario names to functions, which take a test client and an auth header,
+        and issue a request.
+    """
+    def login(client, headers):
+        return client.post("/users/login", data=json.dumps({
+            "username": "user_%d" % rng.randint(*id_ranges["User"]),
+            "password": BENCH_PASSWORD
+        }), content_type="application/json")
+    return {
+        "list_papers_filter": lambda client, headers: client.get("/papers?json_params=%s" % create_json_param({
+            "query": ["contains", "title", rng.choice(WORDS)],
+            "order": [["title", True]],
+            "limit": 20
+        })),
+        "list_notes_page": lambda client, headers: client.get("/notes?json_params=%s" % create_json_param({
+            "query": ["eq", "paper_id", rng.randint(*id_ranges["Paper"])],
+            "limit": 20
+        })),
+        "retrieve_paper_with": lambda client, headers: client.get("/papers/%d?json_params=%s" % (
+            rng.randint(*id_ranges["Paper"]),
+            create_json_param({"with": ["owners", "notes.author"]})
+        )),
+        "retrieve_user": lambda client, headers: client.get("/users/%d" % rng.randint(*id_ranges["User"])),
+        "login": login,
+        "toggle_collect_paper": lambda client, headers: client.post(
+            "/papers/%d/toggle_collect_status" % rng.randint(*id_ranges["Paper"]),
+            headers=headers
+        ),
+        "toggle_collect_note": lambda client, headers: client.post(
+            "/notes/%d/toggle_collect_status" % rng.randint(*id_ranges["Note"]),
+            headers=headers
+        )
+    }
+
+def __percentile(sorted_values, fraction):
+    """ Get percentile of sorted values with nearest-rank method. """
+    return sorted_values[min(int(len(sorted_values)*fraction), len(sorted_values)-1)]
+
+def bench_endpoints(id_ranges, n_requests=200, n_warmup=20, seed=0):
+    """
+    Drive API endpoints through the test client and measure latency, queries and allocations.
+    Allocations are measured in a separate pass, since tracing memory slows down requests.
+
+    Args:
+        id_ranges: Primary key ranges of seeded elements, keyed by model name.
+        n_requests: Amount of measured requests per scenario.
+        n_warmup: Amount of unmeasured requests per scenario.
+        seed: Random seed of requests.
+    Returns:
+        Benchmark report, keyed by scenario name.
+    """
+    from app.config import AUTH_TOKEN_HEADER
+    from app.util.test import count_queries, login_token
+    client = app.app.test_client()
+    rng = random.Random(seed)
+    headers = {AUTH_TOKEN_HEADER: login_token(client, "user_%d" % id_ranges["User"][0], BENCH_PASSWORD)}
+    report = {}
+    for name, scenario in bench_scenarios(id_ranges, rng).items():
+        for _ in range(n_warmup):
+            scenario(client, headers)
+        # Latency and queries
+        latencies, n_statements, statuses = [], 0, {}
+        for _ in range(n_requests):
+            with count_queries(app.db.engine) as statements:
+                start = default_timer()
+                rv = scenario(client, headers)
+                latencies.append(default_timer()-start)
+            n_statements += len(statements)
+            statuses[rv.status_code] = statuses.get(rv.status_code, 0)+1
+        # Allocations (Tracing restarts per request to reset the peak, since "reset_peak" needs Python 3.9)
+        allocated, peak = 0, 0
+        for _ in range(n_requests):
+            tracemalloc.start()
+            scenario(client, headers)
+            request_allocated, request_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            allocated += request_allocated
+            peak = max(peak, request_peak)
+        latencies.sort()
+        report[name] = {
+            "requests": n_requests,
+            "statuses": statuses,
+            "p50_ms": __percentile(latencies, 0.50)*1000,
+            "p95_ms": __percentile(latencies, 0.95)*1000,
+            "p99_ms": __percentile(latencies, 0.99)*1000,
+            "mean_ms": sum(latencies)/n_requests*1000,
+            "queries_per_request": n_statements/n_requests,
+            "retained_kb_per_request": allocated/n_requests/1024,
+            "peak_kb": peak/1024
+        }
+    return report
+
+if __name__=="__main__":
+    app.setup_app(db_uri="sqlite://")
+    app.db.create_all()
+    for name, cost in bench_dump_data().items():
+        print("%s: %.1f us/object" % (name, cost))
@@ -2,13 +2,55 @@
 from app.private_config import *
 
 # Rounds of hashing
-N_HASH_ROUNDS = 256
+N_HASH_ROUNDS = int(os.environ.get("N_HASH_ROUNDS", 100000))
+# Rounds of hashing of passwords stored without rounds
+N_LEGACY_HASH_ROUNDS = 256
+# Password hashing processes per worker (Hashing is done in request threads if 0)
+HASH_POOL_SIZE = int(os.environ.get("HASH_POOL_SIZE", 2))
+# Maximum amount of queued and running password hashing tasks per worker
+HASH_QUEUE_LIMIT = int(os.environ.get("HASH_QUEUE_LIMIT", 32))
+# Password hashing timeout (In seconds)
+HASH_TIMEOUT = 10
 # Cross origin request max age
 CORS_MAX_AGE = 691200
 # Authentication token header
 AUTH_TOKEN_HEADER = "X-Academia-Auth-Token"
 # Token length
 TOKEN_LEN = 60
+# Maximum amount of cached session tokens per worker
+AUTH_CACHE_SIZE = 10000
+# Cached session token time to live (In seconds)
+AUTH_CACHE_TTL = 60
+# Interval of polling session revocations of other workers (In seconds)
+AUTH_REVOCATION_POLL_INTERVAL = 1
+# Allowance for commit delay and clock skew when polling session revocations (In seconds)
+AUTH_REVOCATION_MARGIN = 10
+# Time requests and send timing in "Server-Timing" header
+REQUEST_TIMING = os.environ.get("REQUEST_TIMING", "0")=="1"
+# Fraction of timed requests logged to "app.timing" logger
+REQUEST_TIMING_LOG_RATE = float(os.environ.get("REQUEST_TIMING_LOG_RATE", 0))
+# Client addresses allowed to read statistics endpoints (Comma separated)
+STATS_ALLOWED_ADDRS = frozenset(os.environ.get("STATS_ALLOWED_ADDRS", "127.0.0.1,::1").split(","))
+# Maximum amount of users with cached group membership per worker
+GROUP_CACHE_SIZE = 10000
+# Cached group membership time to live (In seconds)
+GROUP_CACHE_TTL = 60
+# Maximum amount of items in a bulk operation
+BULK_MAX_SIZE = 1000
+# Background job worker threads per worker process
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+# Idle job worker polling interval (In seconds)
+JOB_POLL_INTERVAL = 1
+# Default maximum attempts of a background job
+JOB_MAX_ATTEMPTS = 5
+# Delay before the first retry of a failed background job, doubled on each retry (In seconds)
+JOB_RETRY_DELAY = 10
+# Running jobs without heartbeat for this long are considered abandoned and retried (In seconds)
+JOB_TIMEOUT = 600
+# Heartbeat interval of running jobs (In seconds)
+JOB_HEARTBEAT_INTERVAL = 60
+# Finished background jobs, and their idempotency keys, are kept for this long (In seconds)
+JOB_RETENTION = 7*86400
 
 # Database name
 DB_NAME = os.environ["DB_NAME"]
@@ -17,5 +59,44 @@ DB_USERNAME = os.environ["POSTGRES_USER"]
 # Database user password
 DB_PASSWORD = os.environ["POSTGRES_PASSWORD"]
 
+# Database connection pool size per worker
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 20))
+# Maximum amount of connections beyond pool size per worker
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+# Connection checkout timeout (In seconds)
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+# Connection recycle time (In seconds)
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 3600))
+# Test connections for liveness on checkout
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1")=="1"
+
 # Data root
-DATA_ROOT = "/root/data"
+DATA_ROOT = os.environ.get("DATA_ROOT", "/root/data")
+# Root of unfinished uploads (Inside data root, so that uploads survive redeployment and are stored without copying)
+UPLOAD_ROOT = os.environ.get("UPLOAD_ROOT", os.path.join(DATA_ROOT, "uploads"))
+# Maximum size of uploaded files (In bytes)
+UPLOAD_MAX_SIZE = int(os.environ.get("UPLOAD_MAX_SIZE", 256*1024*1024))
+# Size of chunks in which request bodies are streamed to disk (In bytes)
+UPLOAD_CHUNK_SIZE = 64*1024
+# Unfinished resumable upload time to live (In seconds)
+UPLOAD_TTL = 86400
+# Offload stored file bodies to front proxy ("x-accel-redirect", "x-sendfile", or empty to serve by the application)
+FILE_OFFLOAD = os.environ.get("FILE_OFFLOAD", "")
+# Internal front proxy location of data root for "X-Accel-Redirect"
+FILE_ACCEL_PREFIX = os.environ.get("FILE_ACCEL_PREFIX", "/_data")
+# Stored file cache max age (In seconds)
+FILE_CACHE_MAX_AGE = 7*86400
+# Maximum width and height of normalized avatars (In pixels)
+AVATAR_MAX_SIZE = 1024
+# Maximum amount of pixels of decoded images
+IMAGE_MAX_PIXELS = 40*1000*1000
+# Sizes of square thumbnails (In pixels)
+THUMBNAIL_SIZES = (32, 64, 256)
+# Formats of thumbnails
+THUMBNAIL_FORMATS = ("webp", "jpeg")
+# Encoding quality of normalized images and thumbnails
+THUMBNAIL_QUALITY = 85
+# Root of lazily rendered thumbnails (Inside data root)
+THUMBNAIL_CACHE_ROOT = os.path.join(DATA_ROOT, "thumbnails")
+# Maximum total size of lazily rendered thumbnails per data root (In bytes)
+THUMBNAIL_CACHE_SIZE = int(os.environ.get("THUMBNAIL_CACHE_SIZE", 256*1024*1024))
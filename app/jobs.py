@@ -0,0 +1,16 @@
+""" Background job handlers. """
+from app import db
+from app.util.data import recount_counters
+from app.util.jobs import job
+
+@job("recount_counters")
+def recount_counters_job(tables=None):
+    """
+    Recompute denormalized counters in bulk.
+
+    Args:
+        tables: Names of tables to recount, or None for all tables with counters.
+    """
+    if tables!=None:
+        tables = [db.metadata.tables[name] for name in tables]
+    recount_counters(db.session, tables)
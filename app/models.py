@@ -3,20 +3,23 @@ from datetime import datetime
 from depot.fields.sqlalchemy import UploadedFileField
 
 from app import db
-from app.util.data import many_to_many, foreign_key
+from app.util.data import many_to_many, foreign_key, Versioned, searchable, counter
+from app.util.images import UploadedAvatar
 from app.config import TOKEN_LEN
 
-class User(db.Model):
+class User(db.Model, Versioned):
     """ User model class. """
     id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
     username = db.Column(db.String(32), unique=True)
     email = db.Column(db.String(64), unique=True)
     password = db.Column(db.Binary(32))
+    password_salt = db.Column(db.Binary(16))
+    password_rounds = db.Column(db.Integer())
     join_date = db.Column(db.DateTime(), default=datetime.now)
     active = db.Column(db.Boolean(), default=False)
-    avatar = db.Column(UploadedFileField())
+    avatar = db.Column(UploadedFileField(upload_type=UploadedAvatar))
     self_introduction = db.Column(db.Text(), unique=True)
-    contribution = db.Column(db.Integer(), default=0)
+    contribution = counter("notes", "questions_asked", "replies", "comments")
     job = db.Column(db.String(64), unique=True)
 
 class Session(db.Model):
@@ -24,6 +27,34 @@ class Session(db.Model):
     token = db.Column(db.Binary(TOKEN_LEN), primary_key=True)
     user, user_id = foreign_key("User", backref_name="sessions")
 
+class SessionRevocation(db.Model):
+    """ Revoked API session, or removed user or changed group membership of a user, used to invalidate caches of all workers. """
+    id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
+    # Invalidated cache ("session" or "membership")
+    kind = db.Column(db.String(16), nullable=False, default="session", server_default="session")
+    token = db.Column(db.Binary(TOKEN_LEN))
+    user_id = db.Column(db.Integer())
+    revoke_time = db.Column(db.DateTime(), default=datetime.now, index=True)
+
+class Job(db.Model):
+    """ Background job model class. """
+    id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
+    name = db.Column(db.String(64), nullable=False)
+    args = db.Column(db.Text(), nullable=False, default="{}")
+    priority = db.Column(db.Integer(), nullable=False, default=0)
+    idempotency_key = db.Column(db.String(128), unique=True)
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    max_attempts = db.Column(db.Integer(), nullable=False)
+    run_after = db.Column(db.DateTime(), nullable=False, default=datetime.now)
+    locked_by = db.Column(db.String(64))
+    locked_at = db.Column(db.DateTime())
+    last_error = db.Column(db.Text())
+    create_time = db.Column(db.DateTime(), default=datetime.now)
+    finish_time = db.Column(db.DateTime())
+    # Claiming order of pending jobs
+    __table_args__ = (db.Index("ix_job_status_priority_run_after", "status", "priority", "run_after"),)
+
 class AbstractBaseGroup(object):
     """ Abstract base group class. """
     pass
@@ -35,7 +66,8 @@ class Group(db.Model, AbstractBaseGroup):
     users = many_to_many("Group", "User", backref_name="groups")
     introduction = db.Column(db.Text())
 
-class Paper(db.Model):
+@searchable("title", "abstract", "authors")
+class Paper(db.Model, Versioned):
     """ Paper model class. """
     id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
     title = db.Column(db.String(256), unique=False)
@@ -46,9 +78,11 @@ class Paper(db.Model):
     owners = many_to_many("Paper", "User", backref_name="papers")
     owngroup = many_to_many("Paper", "Group", backref_name="papers")
     collectors = many_to_many("Paper", "User", backref_name="collect_papers")
+    collector_count = counter("collectors")
     paper_file = db.Column(UploadedFileField())
 
-class Note(db.Model):
+@searchable("title", "content")
+class Note(db.Model, Versioned):
     """ User model class. """
     id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
     title = db.Column(db.String(256), unique=False)
@@ -57,6 +91,7 @@ class Note(db.Model):
     author, author_id = foreign_key("User", backref_name="notes")
     paper, paper_id = foreign_key("Paper", backref_name="notes")
     collectors = many_to_many("Note", "User", backref_name="collect_notes")
+    collector_count = counter("collectors")
     owngroup = many_to_many("Note", "Group", backref_name="notes")
     content = db.Column(db.Text(), unique=False)
     annotation_file = db.Column(UploadedFileField())
@@ -68,6 +103,7 @@ class Question(db.Model):
     description = db.Column(db.Text(), unique=False)
     upvotes = many_to_many("Question", "User", backref_name="questions_upvote")
     downvotes = many_to_many("Question", "User", backref_name="questions_downvote")
+    vote_score = counter("upvotes", ("downvotes", -1))
     create_time = db.Column(db.DateTime(), default=datetime.now)
     last_modified = db.Column(db.DateTime(), default=datetime.now)
 
@@ -78,6 +114,7 @@ class Reply(db.Model):
     content = db.Column(db.Text())
     upvotes = many_to_many("Reply", "User", backref_name="replies_upvote")
     downvotes = many_to_many("Reply", "User", backref_name="replies_downvote")
+    vote_score = counter("upvotes", ("downvotes", -1))
     create_time = db.Column(db.DateTime(), default=datetime.now)
     last_modified = db.Column(db.DateTime(), default=datetime.now)
 
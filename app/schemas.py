@@ -1,43 +1,45 @@
 """ Marshmallow schemas for serialization and deserialization. """
-from hashlib import pbkdf2_hmac
-from marshmallow import fields, validate
+from marshmallow import fields, validate, post_load
 from marshmallow_sqlalchemy import ModelSchema, field_for
 
 from app import db
-from app.config import USER_PASSWD_HMAC_SALT, N_HASH_ROUNDS
 from app.models import *
-from app.util.data import Nested, FileField
+from app.util.data import Nested, FileField, ModelConverter
+from app.util.images import ThumbnailField
+from app.util.password import set_password
 
 class UserSchema(ModelSchema):
     """ User schema class. """
     email = field_for(User, "email", validate=validate.Email())
-    password = fields.Method(deserialize="calc_password")
+    password = fields.String(load_only=True)
     papers = Nested("PaperSchema", many=True, model=Paper)
     collect_papers = Nested("PaperSchema", many=True, model=Paper)
     collect_notes = Nested("NoteSchema", many=True, model=Note)
     avatar = FileField()
-    def calc_password(self, raw_password):
+    avatar_thumbnails = ThumbnailField(attribute="avatar", dump_only=True)
+    @post_load
+    def make_instance(self, data):
         """
-        Calculate HMAC-SHA2 password.
+        Make or update user instance, hashing raw password with a new salt.
 
         Args:
-            raw_password: Raw user password.
+            data: Deserialized data.
         Returns:
-            Byte sequence of HMAC-SHA256 result of user password.
+            User instance.
         """
-        return pbkdf2_hmac(
-            "sha256",
-            raw_password.encode(),
-            USER_PASSWD_HMAC_SALT,
-            N_HASH_ROUNDS
-        )
+        raw_password = data.pop("password", None)
+        user = super(UserSchema, self).make_instance(data)
+        if raw_password!=None:
+            set_password(user, raw_password)
+        return user
     class Meta:
         """ User schema meta class. """
         model = User
         sqla_session = db.session
+        model_converter = ModelConverter
         load_only = ("password",)
-        dump_only = ("id", "join_date")
-        exclude = ("sessions",)
+        dump_only = ("id", "join_date", "contribution")
+        exclude = ("sessions", "version", "password_salt", "password_rounds")
 
 class PaperSchema(ModelSchema):
     """ Paper schema class. """
@@ -49,9 +51,10 @@ class PaperSchema(ModelSchema):
         """ User schema meta class. """
         model = Paper
         sqla_session = db.session
+        model_converter = ModelConverter
         load_only = () #deserialize
-        dump_only = ("owners", "owngroup", "id") #serialize
-        exclude = () #both not
+        dump_only = ("owners", "owngroup", "id", "collector_count") #serialize
+        exclude = ("version",) #both not
 
 class NoteSchema(ModelSchema):
     """ Paper schema class. """
@@ -63,6 +66,7 @@ class NoteSchema(ModelSchema):
         """ User schema meta class. """
         model = Note
         sqla_session = db.session
+        model_converter = ModelConverter
         load_only = () #deserialize
-        dump_only = ("id", "collectors", "owngroup") #serialize
-        exclude = () #both not
+        dump_only = ("id", "collectors", "owngroup", "collector_count") #serialize
+        exclude = ("version",) #both not
@@ -0,0 +1,267 @@
+""" Synthetic data generator for load and scale testing. """
+import csv, io, math, random
+from datetime import datetime, timedelta
+from itertools import islice
+from sqlalchemy import text, select, func
+
+import app
+
+# Rows per bulk load statement
+SEED_CHUNK_SIZE = 10000
+# Vocabulary of generated text
+WORDS = (
+    "learning", "neural", "network", "graph", "model", "data", "system", "analysis", "deep", "efficient",
+    "distributed", "query", "optimization", "language", "vision", "robust", "adaptive", "scalable", "memory",
+    "inference", "training", "sparse", "attention", "retrieval", "index", "storage", "parallel", "stream",
+    "probabilistic", "semantic", "federated", "secure", "transformer", "kernel", "embedding", "compression"
+)
+
+class Zipf(object):
+    """
+    Sampler of integers in [1, n] with Zipfian distribution; 1 is the most frequent.
+    Values are drawn by rejection-inversion (Hörmann and Derflinger, 1996), so that memory use is independent of n.
+    """
+    def __init__(self, n, exponent=1.1):
+        """
+        Constructor.
+
+        Args:
+            n: Amount of distinct values.
+            exponent: Exponent of the distribution. Larger exponents give longer tails.
+        """
+        self.n = n
+        self.exponent = exponent
+        self.h_integral_x1 = self.__h_integral(1.5)-1
+        self.h_integral_n = self.__h_integral(n+0.5)
+        self.s = 2-self.__h_integral_inverse(self.__h_integral(2.5)-self.__h(2))
+    @staticmethod
+    def __helper1(x):
+        """ log(1+x)/x, accurate near 0. """
+        return math.log1p(x)/x if abs(x)>1e-8 else 1-x*(0.5-x*(1/3-0.25*x))
+    @staticmethod
+    def __helper2(x):
+        """ (exp(x)-1)/x, accurate near 0. """
+        return math.expm1(x)/x if abs(x)>1e-8 else 1+x*0.5*(1+x/3*(1+0.25*x))
+    def __h(self, x):
+        """ Unnormalized density; x^-exponent. """
+        return math.exp(-self.exponent*math.log(x))
+    def __h_integral(self, x):
+        """ Integral of the density; (x^(1-exponent)-1)/(1-exponent), or log(x) when exponent is 1. """
+        log_x = math.log(x)
+        return self.__helper2((1-self.exponent)*log_x)*log_x
+    def __h_integral_inverse(self, x):
+        """ Inverse of the integral of the density. """
+        t = max(x*(1-self.exponent), -1)
+        return math.exp(self.__helper1(t)*x)
+    def sample(self, rng):
+        """
+        Draw a value.
+
+        Args:
+            rng: Random number generator.
+        Returns:
+            An integer in [1, n].
+        """
+        while True:
+            u = self.h_integral_n+rng.random()*(self.h_integral_x1-self.h_integral_n)
+            x = self.__h_integral_inverse(u)
+            k = min(max(int(x+0.5), 1), self.n)
+            if k-x<=self.s or u>=self.__h_integral(k+0.5)-self.__h(k):
+                return k
+
+def __sample_distinct(zipf, rng, k, n):
+    """ Draw up to k distinct values from a Zipfian sampler over [1, n]. """
+    k = min(k, n)
+    values = set()
+    for _ in range(k*4):
+        values.add(zipf.sample(rng))
+        if len(values)>=k:
+            break
+    return values
+
+def __copy_value(value):
+    """ Format a value for PostgreSQL COPY in CSV format. """
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return "\\x"+value.hex()
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    return value
+
+def bulk_load(conn, table, rows, chunk_size=SEED_CHUNK_SIZE):
+    """
+    Load rows into a table in chunks.
+    On PostgreSQL, rows are loaded with "COPY FROM STDIN"; otherwise with "executemany" INSERT statements.
+    Memory usage is bounded by chunk size.
+
+    Args:
+        conn: SQLAlchemy connection.
+        table: Target table.
+        rows: Iterable of row dictionaries, all with the same keys.
+        chunk_size: Amount of rows per statement.
+    Returns:
+        Amount of loaded rows.
+    """
+    rows = iter(rows)
+    preparer = conn.dialect.identifier_preparer
+    n_rows = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        n_rows += len(chunk)
+        # Generic; executemany
+        if conn.dialect.name!="postgresql":
+            conn.execute(table.insert(), chunk)
+            continue
+        # PostgreSQL; COPY in CSV format, with unquoted empty values as NULL
+        columns = list(chunk[0])
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        for row in chunk:
+            writer.writerow(["" if value is None else value for value in map(__copy_value, (row[c] for c in columns))])
+        data = io.BytesIO(buf.getvalue().encode())
+        statement = "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (
+            preparer.format_table(table),
+            ", ".join(preparer.quote(column) for column in columns)
+        )
+        cursor = conn.connection.cursor()
+        try:
+            # psycopg2
+            if hasattr(cursor, "copy_expert"):
+                cursor.copy_expert(statement, data)
+            # pg8000
+            else:
+                cursor.execute(statement, stream=data)
+        finally:
+            cursor.close()
+    return n_rows
+
+def seed_database(n_users=1000, n_papers=10000, n_notes=20000, n_groups=50, seed=0, password=None,
+    chunk_size=SEED_CHUNK_SIZE):
+    """
+    Seed current database with synthetic users, groups, papers, notes, ownerships and collections.
+    Popularity of authors, conferences, papers and collected elements follows Zipfian distributions,
+    and collection counts per user and note sizes are long-tailed. Output is deterministic by seed.
+    Primary keys continue from existing rows, and counters are recomputed afterwards.
+
+    Args:
+        n_users: Amount of users.
+        n_papers: Amount of papers.
+        n_notes: Amount of notes.
+        n_groups: Amount of groups.
+        seed: Random seed.
+        password: Password hash, salt and rounds of hashing of all users as returned by "new_password",
+            or None for users without password.
+        chunk_size: Amount of rows per bulk load statement.
+    Returns:
+        A dictionary with amount of loaded rows and primary key range of each model, keyed by table name.
+    """
+    from app.models import User, Group, Paper, Note
+    from app.util.data import recount_counters
+    db = app.db
+    rng = random.Random(seed)
+    result = {}
+    epoch = datetime(2000, 1, 1)
+    corpus = " ".join(rng.choice(WORDS) for _ in range(10000))
+    def random_text(length):
+        start = rng.randrange(len(corpus)-length) if length<len(corpus) else 0
+        return corpus[start:start+length]
+    def random_time():
+        return epoch+timedelta(seconds=rng.randrange(20*365*86400))
+    with db.engine.begin() as conn:
+        preparer = conn.dialect.identifier_preparer
+        # Primary key offsets
+        offsets = {
+            model: conn.execute(select([func.coalesce(func.max(model.__table__.c.id), 0)])).scalar()
+            for model in (User, Group, Paper, Note)
+        }
+        user_ids = lambda: range(offsets[User]+1, offsets[User]+n_users+1)
+        def load(table, rows, id_range=None):
+            result[table.name] = {"rows": bulk_load(conn, table, rows, chunk_size)}
+            if id_range:
+                result[table.name].update(first_id=id_range.start, last_id=id_range.stop-1)
+        # Users
+        load(User.__table__, ({
+            "id": i,
+            "username": "user_%d" % i,
+            "email": "user_%d@example.com" % i,
+            "password": password[0] if password else None,
+            "password_salt": password[1] if password else None,
+            "password_rounds": password[2] if password else None,
+            "join_date": random_time(),
+            "active": True,
+            "contribution": 0
+        } for i in user_ids()), user_ids())
+        # Groups
+        group_ids = range(offsets[Group]+1, offsets[Group]+n_groups+1)
+        load(Group.__table__, ({
+            "id": i,
+            "name": "group_%d" % i,
+            "introduction": random_text(rng.randrange(20, 200))
+        } for i in group_ids), group_ids)
+        # Papers; long-tail authors and conferences
+        author_zipf = Zipf(max(n_users//2, 1))
+        conference_zipf = Zipf(500)
+        paper_ids = range(offsets[Paper]+1, offsets[Paper]+n_papers+1)
+        load(Paper.__table__, ({
+            "id": i,
+            "title": "%s %d" % (random_text(rng.randrange(20, 80)), i),
+            "abstract": random_text(int(min(rng.lognormvariate(6.5, 0.5), 5000))),
+            "authors": ", ".join("Author %d" % author_zipf.sample(rng) for _ in range(rng.randint(1, 5))),
+            "conference": "CONF%d" % conference_zipf.sample(rng),
+            "publish_date": random_time()
+        } for i in paper_ids), paper_ids)
+        # Notes; popular papers and active users get more notes, note sizes are long-tailed
+        user_zipf = Zipf(max(n_users, 1))
+        paper_zipf = Zipf(max(n_papers, 1))
+        note_ids = range(offsets[Note]+1, offsets[Note]+n_notes+1)
+        def notes():
+            for i in note_ids:
+                create_time = random_time()
+                yield {
+                    "id": i,
+                    "title": "%s %d" % (random_text(rng.randrange(10, 60)), i),
+                    "create_time": create_time,
+                    "last_modified": create_time,
+                    "author_id": offsets[User]+user_zipf.sample(rng),
+                    "paper_id": offsets[Paper]+paper_zipf.sample(rng),
+                    "content": random_text(int(min(rng.lognormvariate(6, 1.2), 50000)))
+                }
+        load(Note.__table__, notes(), note_ids)
+        # Relationships; each source element takes distinct targets
+        def relationship_rows(relationship, source_ids, target_offset, n_targets, count, zipf):
+            prop = relationship.property
+            source_column = prop.synchronize_pairs[0][1].name
+            target_column = prop.secondary_synchronize_pairs[0][1].name
+            for source in source_ids:
+                for target in sorted(__sample_distinct(zipf, rng, count(), n_targets)):
+                    yield {source_column: source, target_column: target_offset+target}
+        def load_relationship(relationship, source_ids, target_offset, n_targets, count, zipf):
+            if n_targets:
+                load(
+                    relationship.property.secondary,
+                    relationship_rows(relationship, source_ids, target_offset, n_targets, count, zipf)
+                )
+        # Paper owners; long-tail authors
+        load_relationship(Paper.owners, paper_ids, offsets[User], n_users, lambda: rng.randint(1, 3), user_zipf)
+        # Group members
+        load_relationship(Group.users, group_ids, offsets[User], n_users, lambda: rng.randint(2, 50), user_zipf)
+        # Collections; collection counts per user are long-tailed, popular elements are collected more
+        note_zipf = Zipf(max(n_notes, 1))
+        collect_count = lambda: int(min(rng.paretovariate(1.2), 1000))
+        load_relationship(User.collect_papers, user_ids(), offsets[Paper], n_papers, collect_count, paper_zipf)
+        load_relationship(User.collect_notes, user_ids(), offsets[Note], n_notes, collect_count, note_zipf)
+        # Move sequences past explicitly inserted primary keys
+        if conn.dialect.name=="postgresql":
+            for model in (User, Group, Paper, Note):
+                conn.execute(text(
+                    "SELECT setval(pg_get_serial_sequence(:table_name, 'id'), (SELECT MAX(id) FROM %s))"
+                    % preparer.format_table(model.__table__)
+                ), table_name=model.__tablename__)
+        # Counters of loaded relationships
+        recount_counters(conn)
+    return result
@@ -0,0 +1,121 @@
+""" Test of background job queue. """
+import json
+from datetime import datetime
+from time import sleep
+from app import app, db
+from app.models import Job, User
+from app.util import jobs as jobs_util
+from app.util.jobs import job, enqueue, Worker
+
+from unittest import TestCase
+
+# Arguments of run test jobs
+runs = []
+
+@job("test_record")
+def record_job(value):
+    runs.append(value)
+
+@job("test_fail")
+def fail_job(value):
+    runs.append(value)
+    raise RuntimeError("failure %s" % value)
+
+@job("test_slow")
+def slow_job(value):
+    runs.append(datetime.now())
+    sleep(value)
+
+@job("test_taken_over")
+def taken_over_job(value):
+    # Claimed by another worker meanwhile
+    db.session.execute(Job.__table__.update().where(Job.idempotency_key==value).values(
+        locked_by="other_worker",
+        attempts=Job.attempts+1
+    ))
+    db.session.commit()
+    db.session.add(User(username="taken_over_job_user"))
+
+class JobTestCase(TestCase):
+    """ Background job test class. """
+    worker = Worker(app)
+
+    def setUp(self):
+        runs.clear()
+
+    def test_enqueue_on_commit(self):
+        # Discarded with rolled back transaction
+        enqueue("test_record", {"value": "rollback"})
+        db.session.rollback()
+        self.worker.run_until_idle()
+        self.assertEqual(runs, [])
+        # Run after commit
+        enqueue("test_record", {"value": "commit"})
+        db.session.commit()
+        self.assertEqual(self.worker.run_until_idle(), 1)
+        self.assertEqual(runs, ["commit"])
+        job = Job.query.filter_by(status="done").order_by(Job.id.desc()).first()
+        self.assertEqual((job.name, job.attempts), ("test_record", 1))
+        # Unknown job
+        with self.assertRaises(ValueError):
+            enqueue("test_unknown")
+
+    def test_priority_and_idempotency(self):
+        self.assertTrue(enqueue("test_record", {"value": "low"}, priority=-1))
+        self.assertTrue(enqueue("test_record", {"value": "high"}, priority=10, key="test_high"))
+        self.assertTrue(enqueue("test_record", {"value": "normal"}))
+        # Duplicated idempotency key
+        self.assertFalse(enqueue("test_record", {"value": "high_again"}, priority=10, key="test_high"))
+        # Delayed
+        enqueue("test_record", {"value": "delayed"}, priority=100, delay=3600)
+        db.session.commit()
+        self.assertEqual(self.worker.run_until_idle(), 3)
+        self.assertEqual(runs, ["high", "normal", "low"])
+
+    def test_retry(self):
+        enqueue("test_fail", {"value": 1}, max_attempts=2, key="test_retry")
+        db.session.commit()
+        self.assertEqual(self.worker.run_until_idle(), 1)
+        job = Job.query.filter_by(idempotency_key="test_retry").one()
+        self.assertEqual((job.status, job.attempts), ("pending", 1))
+        self.assertGreater(job.run_after, datetime.now())
+        self.assertIn("failure 1", job.last_error)
+        # Retry is due
+        job.run_after = datetime.now()
+        db.session.commit()
+        self.assertEqual(self.worker.run_until_idle(), 1)
+        job = Job.query.filter_by(idempotency_key="test_retry").one()
+        self.assertEqual((job.status, job.attempts), ("failed", 2))
+        self.assertEqual(runs, [1, 1])
+
+    def test_heartbeat(self):
+        heartbeat_interval = jobs_util.JOB_HEARTBEAT_INTERVAL
+        jobs_util.JOB_HEARTBEAT_INTERVAL = 0.05
+        try:
+            enqueue("test_slow", {"value": 0.3}, key="test_heartbeat")
+            db.session.commit()
+            self.assertEqual(self.worker.run_until_idle(), 1)
+        finally:
+            jobs_util.JOB_HEARTBEAT_INTERVAL = heartbeat_interval
+        job = Job.query.filter_by(idempotency_key="test_heartbeat").one()
+        self.assertEqual(job.status, "done")
+        # Lock time is refreshed while running
+        self.assertGreater(job.locked_at, runs[0])
+
+    def test_taken_over(self):
+        enqueue("test_taken_over", {"value": "test_taken_over"}, key="test_taken_over")
+        db.session.commit()
+        self.assertEqual(self.worker.run_until_idle(), 1)
+        job = Job.query.filter_by(idempotency_key="test_taken_over").one()
+        # Neither job state nor results of the outdated run are written
+        self.assertEqual((job.status, job.locked_by, job.attempts), ("running", "other_worker", 2))
+        self.assertEqual(User.query.filter_by(username="taken_over_job_user").count(), 0)
+        db.session.delete(job)
+        db.session.commit()
+
+    def test_stats(self):
+        client = app.test_client()
+        rv = client.get("/stats/jobs", environ_base={"REMOTE_ADDR": "203.0.113.1"})
+        self.assertEqual(rv.status_code, 403)
+        rv = client.get("/stats/jobs", environ_base={"REMOTE_ADDR": "::1"})
+        self.assertEqual(json.loads(rv.data.decode())["data"], jobs_util.job_stats())
@@ -0,0 +1,548 @@
+""" Test of paper-related APIs. """
+import os
+from hashlib import sha256
+from flask import g
+
+from app import app, db
+from app.config import AUTH_TOKEN_HEADER, DATA_ROOT, UPLOAD_ROOT
+from app.models import User, Paper, Note
+from app.schemas import PaperSchema, UserSchema
+from app.util import core as core_util
+from app.util.core import set_request_timing
+from app.util.data import dump_data, filter_cache_stats, recount_counters, query_user, query_user_chunks
+
+from app.util.test import *
+from unittest import TestCase
+
+def add_papers(n_papers, prefix):
+    """ Add papers with owners, collectors and notes. """
+    users = [User(username="%s_user_%d" % (prefix, i)) for i in range(n_papers)]
+    db.session.add_all(users)
+    for i in range(n_papers):
+        paper = Paper(title="%s_paper_%d" % (prefix, i))
+        paper.owners.append(users[i])
+        paper.collectors.append(users[i])
+        paper.collectors.append(users[(i+1)%n_papers])
+        db.session.add(paper)
+        db.session.add(Note(title="%s_note_%d" % (prefix, i), author=users[i], paper=paper))
+    db.session.commit()
+
+class PaperTestCase(TestCase):
+    """ Paper-related API test class. """
+    client = app.test_client()
+
+    def list_papers(self, prefix, **params):
+        """ List papers with given title prefix and count executed queries. """
+        json_params = create_json_param({"query": ["contains", "title", prefix], **params})
+        with count_queries(db.engine) as statements:
+            rv = self.client.get("/papers?json_params=%s" % json_params)
+        self.assertEqual(rv.status_code, 200)
+        return get_response_data(rv.data)["data"], len(statements)
+
+    def login(self, username):
+        """ Add a user with password "<username>_pass", and authenticate later requests of "post" as the user. """
+        password = username+"_pass"
+        db.session.add(UserSchema().load({"username": username, "password": password})[0])
+        db.session.commit()
+        self.headers = {AUTH_TOKEN_HEADER: login_token(self.client, username, password)}
+
+    def post(self, action, data=None, **params):
+        """ Post JSON data, or raw data with given JSON params, and get response status and data. """
+        if params:
+            action += "?json_params=%s" % create_json_param(params)
+            rv = self.client.post(action, data=data, content_type="application/octet-stream", headers=self.headers)
+        else:
+            rv = self.client.post(action, data=json.dumps(data), content_type="application/json", headers=self.headers)
+        return rv.status_code, get_response_data(rv.data)
+
+    def test_list_query_count(self):
+        """ Listing papers runs a fixed number of queries regardless of page size. """
+        add_papers(2, "qc_small")
+        add_papers(10, "qc_large")
+        small_papers, small_count = self.list_papers("qc_small")
+        large_papers, large_count = self.list_papers("qc_large")
+        self.assertEqual(len(large_papers), 10)
+        self.assertEqual(small_count, large_count)
+
+    def test_list_related_keys(self):
+        """ Batch-resolved related keys match the relationships of each paper. """
+        add_papers(3, "rk")
+        papers, _ = self.list_papers("rk")
+        for data in papers:
+            paper = Paper.query.get(data["id"])
+            self.assertEqual(data["owners"], [user.id for user in paper.owners])
+            self.assertEqual(sorted(data["collectors"]), sorted(user.id for user in paper.collectors))
+            self.assertEqual(data["notes"], [note.id for note in paper.notes])
+
+    def test_list_nested_query_count(self):
+        """ Nested data designated by "with" is loaded with a fixed number of queries. """
+        add_papers(2, "nq_small")
+        add_papers(10, "nq_large")
+        nested = ["owners", "notes.author"]
+        small_papers, small_count = self.list_papers("nq_small", **{"with": nested})
+        large_papers, large_count = self.list_papers("nq_large", **{"with": nested})
+        self.assertEqual(small_count, large_count)
+        for data in large_papers:
+            paper = Paper.query.get(data["id"])
+            self.assertEqual([owner["id"] for owner in data["owners"]], [user.id for user in paper.owners])
+            self.assertEqual([note["author"]["id"] for note in data["notes"]], [note.author.id for note in paper.notes])
+
+    def test_dump_plan(self):
+        """ Cached dump plan serializes the same data as a fresh schema instance. """
+        add_papers(3, "dp")
+        papers = Paper.query.filter(Paper.title.like("dp_%")).all()
+        for nested in [(), ("owners",), ("notes.author", "collectors"), ("notes", "notes.paper")]:
+            self.assertEqual(
+                dump_data(PaperSchema, papers, nested=nested, many=True),
+                dump_data(PaperSchema(many=True), papers, nested=nested)
+            )
+        # Relationship nested at top level and not nested at a deeper level
+        data = dump_data(PaperSchema(many=True), papers, nested=("notes", "notes.paper"))
+        for paper_data in data:
+            self.assertEqual(paper_data["notes"][0]["paper"]["id"], paper_data["id"])
+            self.assertEqual(paper_data["notes"][0]["paper"]["notes"], [note["id"] for note in paper_data["notes"]])
+
+    def test_list_stream(self):
+        """ Streaming list mode returns the same data as the regular list mode. """
+        add_papers(3, "st")
+        papers, _ = self.list_papers("st_", **{"with": ["owners"]})
+        json_params = create_json_param({"query": ["contains", "title", "st_"], "with": ["owners"], "stream": True})
+        rv = self.client.get("/papers?json_params=%s" % json_params)
+        self.assertEqual(rv.status_code, 200)
+        data = get_response_data(rv.data)
+        self.assertEqual(data["status"], "success")
+        self.assertEqual(data["data"], papers)
+        # Chunks continue after ordering keys, or with offset after null ordering keys
+        db.session.add_all([Paper(title="st_null_%d" % i) for i in range(3)])
+        db.session.commit()
+        for params in [{}, {"order": [["conference", True]]}, {"order": [["title", False]], "limit": 5, "offset": 1}]:
+            with app.test_request_context("/papers"):
+                g.json_params = {"query": ["contains", "title", "st_"], **params}
+                expected = [paper.id for paper in query_user(Paper).all()]
+                chunks = list(query_user_chunks(Paper, chunk_size=2))
+            self.assertTrue(all(len(chunk)<=2 for chunk in chunks))
+            self.assertEqual([paper.id for chunk in chunks for paper in chunk], expected)
+            self.assertEqual(len(expected), params.get("limit", 6))
+        # Errors before the first chunk get an error status
+        json_params = create_json_param({"query": ["contains", "title", "st_"], "limit": "many", "stream": True})
+        rv = self.client.get("/papers?json_params=%s" % json_params)
+        self.assertEqual(rv.status_code, 400)
+
+    def test_list_cursor_pagination(self):
+        """ Cursor pagination walks through all papers in order. """
+        add_papers(5, "cp")
+        # Nullable ordering keys
+        for paper in Paper.query.filter(Paper.title.in_(["cp_paper_1", "cp_paper_3"])):
+            paper.conference = "CONF_%s" % paper.title
+        db.session.commit()
+        orders = [
+            [["publish_date", False], ["title", True]],
+            [["conference", True]],
+            [["conference", False]],
+            [["conference", True], ["title", False]]
+        ]
+        for order in orders:
+            all_papers, _ = self.list_papers("cp_", order=order)
+            # Walk through pages
+            pages, cursor = [], None
+            while True:
+                params = {"query": ["contains", "title", "cp_"], "order": order, "limit": 2}
+                if cursor:
+                    params["after"] = cursor
+                rv = self.client.get("/papers?json_params=%s" % create_json_param(params))
+                self.assertEqual(rv.status_code, 200)
+                data = get_response_data(rv.data)
+                pages.extend(data["data"])
+                cursor = data["next_cursor"]
+                if not cursor:
+                    break
+            self.assertEqual(len(pages), 5)
+            self.assertEqual([paper["id"] for paper in pages], [paper["id"] for paper in all_papers])
+        # Malformed cursor
+        rv = self.client.get("/papers?json_params=%s" % create_json_param({"limit": 2, "after": "bad"}))
+        self.assertEqual(rv.status_code, 400)
+
+    def test_filter_cache(self):
+        """ Repeated filter shapes reuse the cached query with different literals. """
+        add_papers(2, "fc_a")
+        add_papers(3, "fc_b")
+        self.list_papers("fc_a", order=[["title", True]])
+        stats = filter_cache_stats()
+        papers, _ = self.list_papers("fc_b", order=[["title", True]])
+        self.assertEqual(filter_cache_stats()["hits"], stats["hits"]+1)
+        self.assertEqual([paper["title"] for paper in papers], ["fc_b_paper_%d" % i for i in range(3)])
+        # Case-insensitive containment with bind parameter
+        json_params = create_json_param({"query": ["icontains", "title", "FC_A_PAPER"]})
+        rv = self.client.get("/papers?json_params=%s" % json_params)
+        self.assertEqual(len(get_response_data(rv.data)["data"]), 2)
+        # Statistics are only served to allowed clients
+        rv = self.client.get("/stats/filter_cache", environ_base={"REMOTE_ADDR": "203.0.113.1"})
+        self.assertEqual(rv.status_code, 403)
+        rv = self.client.get("/stats/filter_cache", environ_base={"REMOTE_ADDR": "127.0.0.1"})
+        self.assertEqual(get_response_data(rv.data)["data"]["hits"], filter_cache_stats()["hits"])
+
+    def test_request_timing(self):
+        """ Timed requests report processing sections and executed statements in "Server-Timing" header. """
+        add_papers(1, "rt")
+        paper_id = Paper.query.filter(Paper.title=="rt_paper_0").one().id
+        request_timing = core_util.request_timing
+        try:
+            # Not timed when disabled
+            set_request_timing(False)
+            self.assertNotIn("Server-Timing", self.client.get("/papers/%d" % paper_id).headers)
+            set_request_timing(True)
+            with count_queries(db.engine) as statements:
+                rv = self.client.get("/papers/%d" % paper_id)
+        finally:
+            set_request_timing(request_timing)
+        self.assertEqual(rv.status_code, 200)
+        metrics = dict(metric.split(";", 1) for metric in rv.headers["Server-Timing"].split(", "))
+        self.assertEqual(list(metrics), ["db", "dump", "json", "handler", "sql", "total"])
+        self.assertEqual(metrics["sql"], 'desc="%d statements"' % len(statements))
+        self.assertGreater(len(statements), 0)
+        for name in ("db", "dump", "json", "handler", "total"):
+            self.assertRegex(metrics[name], r"^dur=\d+\.\d{2}$")
+
+    def test_conditional_retrieve(self):
+        """ Retrieving a paper honors entity tags, which change with the paper and its relationships. """
+        add_papers(2, "et")
+        paper_id, other_paper_id = [
+            paper.id for paper in Paper.query.filter(Paper.title.like("et_paper_%")).order_by(Paper.id)
+        ]
+        def retrieve(etag=None):
+            headers = {"If-None-Match": etag} if etag else {}
+            rv = self.client.get("/papers/%d" % paper_id, headers=headers)
+            return rv.status_code, rv.headers.get("ETag")
+        def assert_changed(etag):
+            db.session.commit()
+            status, new_etag = retrieve(etag)
+            self.assertEqual(status, 200)
+            self.assertNotEqual(new_etag, etag)
+            return new_etag
+        status, etag = retrieve()
+        self.assertEqual(status, 200)
+        self.assertEqual(retrieve(etag), (304, etag))
+        # Entity tag weakened by a proxy
+        self.assertEqual(retrieve("W/"+etag), (304, etag))
+        # Column change
+        Paper.query.get(paper_id).title = "et_paper_renamed"
+        etag = assert_changed(etag)
+        # Many-to-many change
+        Paper.query.get(paper_id).collectors.append(User(username="et_collector"))
+        etag = assert_changed(etag)
+        # Related note moved to another paper
+        Paper.query.get(paper_id).notes.one().paper = Paper.query.get(other_paper_id)
+        etag = assert_changed(etag)
+        self.assertEqual(retrieve(etag), (304, etag))
+        # New note related by foreign key only
+        db.session.add(Note(title="et_note_new", author_id=Paper.query.get(paper_id).owners[0].id, paper_id=paper_id))
+        etag = assert_changed(etag)
+        # Nested fields designated by user request are not tagged
+        json_params = create_json_param({"with": ["owners"]})
+        rv = self.client.get("/papers/%d?json_params=%s" % (paper_id, json_params))
+        self.assertIsNone(rv.headers.get("ETag"))
+
+    def test_list_count(self):
+        """ Requested counts cover all filtered papers regardless of pagination. """
+        add_papers(5, "ct")
+        params = {"query": ["contains", "title", "ct_paper"], "order": [["title", True]], "limit": 2}
+        rv = self.client.get("/papers?json_params=%s" % create_json_param(params))
+        self.assertNotIn("count", get_response_data(rv.data))
+        for mode in (True, "exact", "approximate"):
+            rv = self.client.get("/papers?json_params=%s" % create_json_param(dict(params, count=mode)))
+            data = get_response_data(rv.data)
+            self.assertEqual(len(data["data"]), 2)
+            self.assertEqual(data["count"], 5)
+            self.assertFalse(data["count_approximate"])
+        # Streaming mode
+        rv = self.client.get("/papers?json_params=%s" % create_json_param(dict(params, count=True, stream=True)))
+        self.assertEqual(get_response_data(rv.data)["count"], 5)
+        # Unknown count mode
+        rv = self.client.get("/papers?json_params=%s" % create_json_param(dict(params, count="fast")))
+        self.assertEqual(rv.status_code, 400)
+
+    def test_relationship_query_plans(self):
+        """ Relationship lookups from both sides search indexes instead of scanning tables. """
+        add_papers(2, "qp")
+        paper = Paper.query.filter(Paper.title=="qp_paper_0").one()
+        user = paper.owners.one()
+        for query_set in (paper.owners, paper.collectors, paper.notes, user.papers, user.collect_papers, user.notes):
+            statement = query_set.statement.compile(dialect=db.engine.dialect)
+            plan = db.engine.execute(
+                "EXPLAIN QUERY PLAN "+str(statement),
+                *[statement.params[name] for name in statement.positiontup]
+            ).fetchall()
+            details = [row[-1] for row in plan]
+            self.assertFalse([detail for detail in details if detail.startswith("SCAN")], details)
+
+    def test_bulk_create_update(self):
+        """ Papers and notes are created and updated in batch, with errors reported per item. """
+        self.login("bulk_user")
+        # Create
+        status, data = self.post("/papers/bulk_create", [{"title": "bulk_paper_%d" % i} for i in range(3)])
+        self.assertEqual(status, 200)
+        paper_ids = [paper["id"] for paper in data["data"]]
+        self.assertEqual(Paper.query.filter(Paper.id.in_(paper_ids)).count(), 3)
+        # Invalid items are reported by index; nothing is created
+        status, data = self.post("/papers/bulk_create", [{"title": "bulk_paper_ok"}, {"title": ["bad"]}])
+        self.assertEqual(status, 400)
+        self.assertEqual(list(data["errors"]), ["1"])
+        self.assertEqual(Paper.query.filter(Paper.title=="bulk_paper_ok").count(), 0)
+        # Update
+        status, data = self.post("/papers/bulk_update", [
+            {"id": paper_id, "title": "bulk_paper_updated_%d" % i} for i, paper_id in enumerate(paper_ids)
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            [paper.title for paper in Paper.query.filter(Paper.id.in_(paper_ids)).order_by(Paper.id)],
+            ["bulk_paper_updated_%d" % i for i in range(3)]
+        )
+        # Statements do not grow with the amount of items
+        def count_bulk_statements(n_items):
+            with count_queries(db.engine) as statements:
+                status, data = self.post("/papers/bulk_create", [{"title": "bulk_count_%d" % i} for i in range(n_items)])
+            self.assertEqual(status, 200)
+            ids = [paper["id"] for paper in data["data"]]
+            n_create_statements = len(statements)
+            with count_queries(db.engine) as statements:
+                status, _ = self.post("/papers/bulk_update", [
+                    {"id": paper_id, "title": "bulk_count_updated_%d" % i} for i, paper_id in enumerate(ids)
+                ])
+            self.assertEqual(status, 200)
+            return n_create_statements, len(statements)
+        n_create_statements, n_update_statements = count_bulk_statements(2)
+        n_create_statements_more, n_update_statements_more = count_bulk_statements(6)
+        self.assertEqual(n_update_statements_more, n_update_statements)
+        if db.engine.dialect.name=="postgresql":
+            self.assertEqual(n_create_statements_more, n_create_statements)
+        # Missing elements are reported by index
+        status, data = self.post("/papers/bulk_update", [{"id": paper_ids[0]}, {"id": -1}])
+        self.assertEqual(status, 404)
+        self.assertEqual(data["indexes"], [1])
+        # Notes referring to papers
+        status, data = self.post("/notes/bulk_create", [
+            {"title": "bulk_note_%d" % i, "paper": paper_id} for i, paper_id in enumerate(paper_ids)
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual([note["paper"] for note in data["data"]], paper_ids)
+
+    def test_search(self):
+        """ Papers are searched by words in searchable fields, ranked by relevance and kept in sync with updates. """
+        db.session.add_all([
+            Paper(title="Quasar lensing survey", abstract="Gravitational lensing of quasars."),
+            Paper(title="Stellar spectra", abstract="A quasar appears once; lensing too."),
+            Paper(title="Unrelated work", authors="Quasar Q. Author")
+        ])
+        db.session.commit()
+        def search(query, **params):
+            rv = self.client.get("/papers?json_params=%s" % create_json_param(dict(query=query, **params)))
+            self.assertEqual(rv.status_code, 200)
+            return [paper["title"] for paper in get_response_data(rv.data)["data"]]
+        # Match on any searchable field; all words must match
+        self.assertEqual(
+            set(search(["search", "quasar"])),
+            {"Quasar lensing survey", "Stellar spectra", "Unrelated work"}
+        )
+        self.assertEqual(
+            set(search(["search", "quasar lensing"])),
+            {"Quasar lensing survey", "Stellar spectra"}
+        )
+        # Ranking without explicit order, composition with other filters
+        self.assertEqual(search(["search", "lensing"], limit=1), ["Quasar lensing survey"])
+        self.assertEqual(
+            search(["and", ["search", "lensing"], ["ne", "title", "Quasar lensing survey"]]),
+            ["Stellar spectra"]
+        )
+        # Explicit order; cursor is only available with it
+        titles = search(["search", "quasar"], order=[["title", True]])
+        self.assertEqual(titles, sorted(titles))
+        rv = self.client.get("/papers?json_params=%s" % create_json_param({
+            "query": ["search", "quasar"], "after": "x"
+        }))
+        self.assertEqual(rv.status_code, 400)
+        # Index follows inserts and updates
+        paper = Paper.query.filter_by(title="Unrelated work").first()
+        paper.authors = "Nobody"
+        db.session.add(Paper(title="Blazar quasar jets"))
+        db.session.commit()
+        self.assertEqual(
+            set(search(["search", "quasar"])),
+            {"Quasar lensing survey", "Stellar spectra", "Blazar quasar jets"}
+        )
+        # Models without searchable fields
+        rv = self.client.get("/users?json_params=%s" % create_json_param({"query": ["search", "quasar"]}))
+        self.assertEqual(rv.status_code, 400)
+
+    def test_counters(self):
+        """ Collector counts and user contribution follow changes, and can be ordered, filtered and repaired. """
+        self.login("counter_user")
+        add_papers(3, "counter")
+        # Initial counts; each paper is collected by two users, each user authors a note
+        data, _ = self.list_papers("counter_paper", order=[["title", True]])
+        self.assertEqual([paper["collector_count"] for paper in data], [2, 2, 2])
+        self.assertEqual(User.query.filter_by(username="counter_user_0").first().contribution, 1)
+        # Toggling collection status
+        paper_id = data[0]["id"]
+        self.post("/papers/%d/toggle_collect_status" % paper_id)
+        self.assertEqual(Paper.query.get(paper_id).collector_count, 3)
+        data, _ = self.list_papers("counter_paper", order=[["collector_count", False]], limit=1)
+        self.assertEqual(data[0]["id"], paper_id)
+        data, _ = self.list_papers("counter_paper", query=[
+            "and", ["contains", "title", "counter_paper"], ["gte", "collector_count", 3]
+        ])
+        self.assertEqual([paper["id"] for paper in data], [paper_id])
+        self.post("/papers/%d/toggle_collect_status" % paper_id)
+        self.assertEqual(Paper.query.get(paper_id).collector_count, 2)
+        # Notes by the user and collections of the user follow removal
+        user = User.query.filter_by(username="counter_user_1").first()
+        db.session.delete(user.notes.first())
+        db.session.delete(user)
+        db.session.commit()
+        data, _ = self.list_papers("counter_paper", order=[["title", True]])
+        self.assertEqual([paper["collector_count"] for paper in data], [1, 1, 2])
+        # Repair
+        db.session.execute(Paper.__table__.update().values(collector_count=0))
+        db.session.commit()
+        with db.engine.begin() as conn:
+            self.assertGreaterEqual(recount_counters(conn)["paper.collector_count"], 3)
+        data, _ = self.list_papers("counter_paper", order=[["title", True]])
+        self.assertEqual([paper["collector_count"] for paper in data], [1, 1, 2])
+
+    def test_collect_status(self):
+        """ Collection toggles cost a constant amount of queries, and collection status is set in batch. """
+        self.login("collect_user")
+        user_id = User.query.filter_by(username="collect_user").first().id
+        # Toggle regardless of the amount of collectors
+        add_papers(2, "few_coll")
+        add_papers(20, "many_coll")
+        self.post("/papers/%d/toggle_collect_status" % Paper.query.filter_by(title="many_coll_paper_1").first().id)
+        statement_counts = []
+        for prefix in ("few_coll", "many_coll"):
+            paper_id = Paper.query.filter_by(title="%s_paper_0" % prefix).first().id
+            for collected in (True, False):
+                with count_queries(db.engine) as statements:
+                    status, data = self.post("/papers/%d/toggle_collect_status" % paper_id)
+                self.assertEqual(data["collected"], collected)
+                statement_counts.append(len(statements))
+        self.assertEqual(statement_counts[:2], statement_counts[2:])
+        # Batch
+        paper_ids = [paper.id for paper in Paper.query.filter(Paper.title.startswith("few_coll_paper"))]
+        status, data = self.post("/papers/set_collect_status", {"ids": paper_ids[:1], "collected": True})
+        self.assertEqual(data["changed"], paper_ids[:1])
+        status, data = self.post("/papers/set_collect_status", {"ids": paper_ids, "collected": True})
+        self.assertEqual(data["changed"], paper_ids[1:])
+        self.assertEqual(
+            {paper.id for paper in User.query.get(user_id).collect_papers if paper.id in paper_ids},
+            set(paper_ids)
+        )
+        self.assertEqual([Paper.query.get(paper_id).collector_count for paper_id in paper_ids], [3, 3])
+        status, data = self.post("/papers/set_collect_status", {"ids": paper_ids, "collected": False})
+        self.assertEqual(sorted(data["changed"]), sorted(paper_ids))
+        self.assertEqual([Paper.query.get(paper_id).collector_count for paper_id in paper_ids], [2, 2])
+        # Missing elements are reported by index
+        status, data = self.post("/papers/set_collect_status", {"ids": [paper_ids[0], -1], "collected": True})
+        self.assertEqual(status, 404)
+        self.assertEqual(data["indexes"], [1])
+
+    def test_resumable_upload(self):
+        """ Paper files are uploaded in resumable chunks, with offsets and sizes enforced. """
+        self.login("upload_user")
+        paper = Paper(title="upload_paper")
+        db.session.add(paper)
+        db.session.commit()
+        paper_id = paper.id
+        content = b"%PDF-1.4 upload test content"
+        status, data = self.post("/papers/upload_init", {"filename": "upload.pdf", "size": len(content)})
+        self.assertEqual(status, 200)
+        upload_id = data["upload_id"]
+        # Append chunks; wrong offsets report current offset for resuming
+        status, data = self.post("/papers/upload_append", content[:10], upload_id=upload_id, offset=0)
+        self.assertEqual(data["offset"], 10)
+        status, data = self.post("/papers/upload_append", content[10:], upload_id=upload_id, offset=0)
+        self.assertEqual((status, data["type"], data["offset"]), (409, "offset_mismatch", 10))
+        # Incomplete upload
+        status, data = self.post("/papers/upload_finalize", {"id": paper_id, "upload_id": upload_id})
+        self.assertEqual((status, data["type"]), (400, "upload_incomplete"))
+        # Chunks beyond total size are discarded
+        status, data = self.post("/papers/upload_append", content[10:]+b"extra", upload_id=upload_id, offset=10)
+        self.assertEqual((status, data["type"]), (413, "upload_too_large"))
+        status, data = self.post("/papers/upload_append", content[10:], upload_id=upload_id, offset=10)
+        self.assertEqual(data["offset"], len(content))
+        # Finalize; uploaded file is linked into storage without copying
+        upload_inode = os.stat(os.path.join(UPLOAD_ROOT, upload_id+".part")).st_ino
+        status, data = self.post("/papers/upload_finalize", {"id": paper_id, "upload_id": upload_id})
+        self.assertEqual(status, 200)
+        paper = Paper.query.get(paper_id)
+        self.assertEqual(paper.paper_file.file.read(), content)
+        self.assertEqual(os.stat(paper.paper_file.file._file_path).st_ino, upload_inode)
+        self.assertEqual(paper.paper_file.filename, "upload.pdf")
+        status, data = self.post("/papers/upload_finalize", {"id": paper_id, "upload_id": upload_id})
+        self.assertEqual(status, 404)
+        # Remove stored file
+        db.session.delete(paper)
+        db.session.commit()
+
+    def test_file_range(self):
+        """ Stored paper files are served in byte ranges and revalidated with entity tags. """
+        content = bytes(range(256))*40
+        paper = Paper(title="range_paper", paper_file=content)
+        db.session.add(paper)
+        db.session.commit()
+        url = "/depot/%s" % Paper.query.get(paper.id).paper_file.path
+        # Complete file
+        rv = self.client.get(url)
+        self.assertEqual((rv.status_code, rv.data), (200, content))
+        self.assertEqual(rv.headers["Accept-Ranges"], "bytes")
+        etag = rv.headers["ETag"]
+        # Byte ranges
+        rv = self.client.get(url, headers={"Range": "bytes=100-199"})
+        self.assertEqual((rv.status_code, rv.data), (206, content[100:200]))
+        self.assertEqual(rv.headers["Content-Range"], "bytes 100-199/%d" % len(content))
+        rv = self.client.get(url, headers={"Range": "bytes=-10"})
+        self.assertEqual((rv.status_code, rv.data), (206, content[-10:]))
+        rv = self.client.get(url, headers={"Range": "bytes=%d-" % (len(content)+1)})
+        self.assertEqual(rv.status_code, 416)
+        # Range of outdated representation gets complete file
+        rv = self.client.get(url, headers={"Range": "bytes=0-9", "If-Range": etag})
+        self.assertEqual(rv.status_code, 206)
+        rv = self.client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"outdated"'})
+        self.assertEqual((rv.status_code, rv.data), (200, content))
+        # Revalidation
+        rv = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 304)
+        rv = self.client.get(url, headers={"If-Modified-Since": rv.headers["Last-Modified"]})
+        self.assertEqual(rv.status_code, 304)
+        db.session.delete(Paper.query.get(paper.id))
+        db.session.commit()
+
+    def test_file_dedup(self):
+        """ Identical paper files are stored once, and removed with their last referencing paper. """
+        content = b"%PDF-1.4 dedup test content"
+        papers = [Paper(title="dedup_paper_%d" % i, paper_file=content) for i in range(2)]
+        db.session.add_all(papers)
+        db.session.commit()
+        paper_ids = [paper.id for paper in papers]
+        stored_files = [Paper.query.get(paper_id).paper_file.file for paper_id in paper_ids]
+        stats = [os.stat(stored_file._file_path) for stored_file in stored_files]
+        self.assertEqual(stats[0].st_ino, stats[1].st_ino)
+        self.assertEqual(stats[0].st_nlink, 3)
+        self.assertEqual(stored_files[1].read(), content)
+        # Remove referencing papers
+        blob_path = os.path.join(DATA_ROOT, "sha256", sha256(content).hexdigest()[:2], sha256(content).hexdigest())
+        self.client.delete("/papers/%d" % paper_ids[0])
+        self.assertEqual(os.stat(blob_path).st_nlink, 2)
+        self.client.delete("/papers/%d" % paper_ids[1])
+        self.assertFalse(os.path.exists(blob_path))
+        # Other local files are copied, so that later changes to them do not affect stored files
+        external_path = os.path.join(DATA_ROOT, "external.pdf")
+        with open(external_path, "wb") as f:
+            f.write(content)
+        with open(external_path, "rb") as f:
+            paper = Paper(title="dedup_external_paper", paper_file=f)
+            db.session.add(paper)
+            db.session.commit()
+        stored_path = Paper.query.get(paper.id).paper_file.file._file_path
+        self.assertNotEqual(os.stat(stored_path).st_ino, os.stat(external_path).st_ino)
+        os.unlink(external_path)
+        db.session.delete(Paper.query.get(paper.id))
+        db.session.commit()
@@ -1,8 +1,23 @@
 """ Test of user-related APIs. """
-import os
+import os, sqlite3, sys
+from base64 import b64decode
+from datetime import datetime
+from hashlib import pbkdf2_hmac
+from io import BytesIO
+from tempfile import mkdtemp
+from threading import Timer
+from time import sleep
+from PIL import Image
 from app import app, db
-from app.config import AUTH_TOKEN_HEADER
-from app.models import User
+from app.config import AUTH_TOKEN_HEADER, USER_PASSWD_HMAC_SALT, N_HASH_ROUNDS, N_LEGACY_HASH_ROUNDS, \
+    HASH_POOL_SIZE, HASH_QUEUE_LIMIT, AVATAR_MAX_SIZE, THUMBNAIL_SIZES, THUMBNAIL_FORMATS
+from app.util import password as password_util
+from app.util import perm as perm_util
+from app.util.perm import check_perm, filter_group_perm, MembershipCache
+from app.util.images import UploadedAvatar, ThumbnailCache
+from app.util.pool import InstrumentedQueuePool
+from app.models import User, Group, Note, Session, SessionRevocation
+from app.util.core import auth_cache
 from app.schemas import UserSchema
 
 from app.util.test import *
@@ -62,3 +77,277 @@ class UserTestCase(TestCase):
         # normal logout
         logout_rv = self.logout(token)
         assert '200' in logout_rv.status
+
+    def test_cached_authentication(self):
+        # log in
+        login_rv = self.login('test_user', 'test_pass')
+        token = get_response_data(login_rv.data)['token']
+        # authenticated request costs no queries on a cache hit
+        self.client.get('/users/1', headers={AUTH_TOKEN_HEADER: token})
+        with count_queries(db.engine) as anonymous_statements:
+            self.client.get('/users/1')
+        with count_queries(db.engine) as statements:
+            rv = self.client.get('/users/1', headers={AUTH_TOKEN_HEADER: token})
+        assert '200' in rv.status
+        assert len(statements)==len(anonymous_statements)
+        # logout invalidates cached session
+        logout_rv = self.logout(token)
+        assert '200' in logout_rv.status
+        rv = self.client.get('/users/1', headers={AUTH_TOKEN_HEADER: token})
+        assert '401' in rv.status
+
+    def test_session_revocation(self):
+        login_data = get_response_data(self.login('test_user', 'test_pass').data)
+        token, user_id = login_data['token'], login_data['user']['id']
+        url = '/users/%d' % user_id
+        poll_interval = auth_cache.poll_interval
+        auth_cache.poll_interval = 3600
+        try:
+            assert '200' in self.client.get(url, headers={AUTH_TOKEN_HEADER: token}).status
+            # logout in another worker
+            db.session.delete(Session.query.get(b64decode(token)))
+            db.session.execute(SessionRevocation.__table__.insert().values(
+                token=b64decode(token),
+                revoke_time=datetime.now()
+            ))
+            db.session.commit()
+            assert '200' in self.client.get(url, headers={AUTH_TOKEN_HEADER: token}).status
+            # revocation is polled
+            auth_cache.poll_interval = 0
+            assert '401' in self.client.get(url, headers={AUTH_TOKEN_HEADER: token}).status
+        finally:
+            auth_cache.poll_interval = poll_interval
+        # cached tokens of a user
+        auth_cache.set(b'revoked_token_1', -1)
+        auth_cache.set(b'revoked_token_2', -1)
+        auth_cache.pop_user(-1)
+        assert auth_cache.get(b'revoked_token_1')==None and auth_cache.get(b'revoked_token_2')==None
+        assert -1 not in auth_cache._user_tokens
+
+    def test_legacy_password_rehash(self):
+        # user with password hashed by site-wide salt and legacy rounds
+        db.session.add(User(
+            username='legacy_user',
+            password=pbkdf2_hmac('sha256', b'legacy_pass', USER_PASSWD_HMAC_SALT, N_LEGACY_HASH_ROUNDS)
+        ))
+        db.session.commit()
+        assert '401' in self.login('legacy_user', 'wrong_pass').status
+        assert '200' in self.login('legacy_user', 'legacy_pass').status
+        # rehashed with per-user salt and current rounds
+        user = User.query.filter_by(username='legacy_user').one()
+        assert user.password_salt and user.password_rounds==N_HASH_ROUNDS
+        assert '200' in self.login('legacy_user', 'legacy_pass').status
+
+    def test_unknown_user_hashing(self):
+        # failed logins of unknown users hash the password like those of existing users
+        calls = []
+        calc_password = password_util.calc_password
+        password_util.calc_password = lambda *args: calls.append(args) or calc_password(*args)
+        try:
+            assert '401' in self.login('unknown_user', 'unknown_pass').status
+            assert '401' in self.login('test_user', 'wrong_pass').status
+        finally:
+            password_util.calc_password = calc_password
+        assert [args[2] for args in calls]==[N_HASH_ROUNDS, N_HASH_ROUNDS]
+
+    def test_hash_pool_executable(self):
+        """ Hashing processes are started with Python interpreter when embedded in uWSGI. """
+        # virtual environment only providing "python3"
+        exec_prefix = mkdtemp()
+        os.mkdir(os.path.join(exec_prefix, "bin"))
+        python3 = os.path.join(exec_prefix, "bin", "python3")
+        with open(python3, "w") as f:
+            f.write("#!/bin/sh\n")
+        os.chmod(python3, 0o755)
+        executable, real_exec_prefix = sys.executable, sys.exec_prefix
+        sys.executable, sys.exec_prefix = "/usr/local/bin/uwsgi", exec_prefix
+        try:
+            assert password_util.python_executable()==python3
+            # no interpreter available
+            os.remove(python3)
+            base_executable = getattr(sys, "_base_executable", None)
+            sys._base_executable = "/usr/local/bin/uwsgi"
+            try:
+                password_util.python_executable()
+                assert False
+            except RuntimeError:
+                pass
+            finally:
+                if base_executable==None:
+                    del sys._base_executable
+                else:
+                    sys._base_executable = base_executable
+        finally:
+            sys.executable, sys.exec_prefix = executable, real_exec_prefix
+
+    def test_hash_pool_saturated(self):
+        if not HASH_POOL_SIZE:
+            return
+        # take all queue slots
+        slots = password_util.queue_slots
+        for _ in range(HASH_QUEUE_LIMIT):
+            slots.acquire()
+        try:
+            rv = self.login('test_user', 'test_pass')
+            assert '503' in rv.status
+        finally:
+            for _ in range(HASH_QUEUE_LIMIT):
+                slots.release()
+        assert '200' in self.login('test_user', 'test_pass').status
+
+    def test_group_perm(self):
+        member, outsider = User(username='group_member'), User(username='group_outsider')
+        group, other_group = Group(name='perm_group'), Group(name='perm_other_group')
+        notes = [Note(title='group_note_%d' % i) for i in range(3)]
+        notes[0].owngroup.append(group)
+        notes[2].owngroup.append(other_group)
+        db.session.add_all([member, outsider, group, other_group]+notes)
+        db.session.commit()
+        with app.test_request_context():
+            from flask import g
+            g.user_id = member.id
+            assert not check_perm(group, throw=False)
+            # membership change invalidates cached membership
+            group.users.append(member)
+            db.session.commit()
+            assert check_perm(group, throw=False)
+            # cached membership costs no queries
+            [obj.id for obj in [g.user, outsider, group, other_group]+notes]
+            with count_queries(db.engine) as statements:
+                assert check_perm((outsider, group), throw=False)
+                assert not check_perm([group, other_group], throw=False)
+            assert len(statements)==0
+            # batched check
+            with count_queries(db.engine) as statements:
+                assert filter_group_perm(notes, Note.owngroup)==[notes[0]]
+            assert len(statements)==1
+            assert filter_group_perm(notes, Note.owngroup, user_id=outsider.id)==[]
+            # removal from either side
+            member.groups.remove(group)
+            db.session.commit()
+            assert not check_perm(group, throw=False)
+        # anonymous user
+        with app.test_request_context():
+            assert not check_perm(group, throw=False)
+            assert not check_perm((outsider, group), throw=False)
+
+    def test_group_perm_revocation(self):
+        member, group = User(username='revoked_member'), Group(name='revoked_group')
+        group.users.append(member)
+        db.session.add_all([member, group])
+        db.session.commit()
+        member_id, group_id = member.id, group.id
+        membership_cache = perm_util.membership_cache
+        auth_cache.set(b'member_token', member_id)
+        poll_interval = membership_cache.poll_interval
+        membership_cache.poll_interval = 3600
+        try:
+            with app.test_request_context():
+                from flask import g
+                g.user_id = member_id
+                assert check_perm(Group.query.get(group_id), throw=False)
+            # membership removed in another worker
+            perm_util.membership_cache = MembershipCache(10, 60)
+            try:
+                Group.query.get(group_id).users.remove(User.query.get(member_id))
+                db.session.commit()
+            finally:
+                perm_util.membership_cache = membership_cache
+            with app.test_request_context():
+                g.user_id = member_id
+                assert check_perm(Group.query.get(group_id), throw=False)
+            # revocation is polled
+            membership_cache.poll_interval = 0
+            with app.test_request_context():
+                g.user_id = member_id
+                assert not check_perm(Group.query.get(group_id), throw=False)
+        finally:
+            membership_cache.poll_interval = poll_interval
+        # membership revocations leave cached sessions intact
+        auth_cache.poll(force=True)
+        assert auth_cache.get(b'member_token')==member_id
+        auth_cache.pop(b'member_token')
+        # values loaded before an invalidation are not cached
+        assert membership_cache.load(-1, lambda: membership_cache.pop(-1) or frozenset())==frozenset()
+        assert membership_cache.get(-1)==None
+
+    def test_avatar_thumbnails(self):
+        # transparent avatar larger than normalized size
+        image = BytesIO()
+        Image.new('RGBA', (AVATAR_MAX_SIZE*2, 600), (255, 0, 0, 128)).save(image, 'PNG')
+        user = User(username='avatar_user', avatar=image.getvalue())
+        db.session.add(user)
+        db.session.commit()
+        avatar = User.query.get(user.id).avatar
+        normalized = Image.open(avatar.file)
+        assert normalized.format=='JPEG' and normalized.size==(AVATAR_MAX_SIZE, 300)
+        # pre-rendered thumbnails
+        urls = get_response_data(self.client.get('/users/%d' % user.id).data)['data']['avatar_thumbnails']
+        for size in THUMBNAIL_SIZES:
+            for format in THUMBNAIL_FORMATS:
+                rv = self.client.get(urls[str(size)][format])
+                assert rv.headers['Content-Type']=='image/'+format
+                assert Image.open(BytesIO(rv.data)).size==(size, size)
+        # avatars stored without thumbnails get them rendered on request
+        legacy_avatar = dict(avatar)
+        del legacy_avatar['thumbnails']
+        db.session.execute(User.__table__.update().where(User.id==user.id).values(avatar=UploadedAvatar(legacy_avatar)))
+        db.session.commit()
+        urls = get_response_data(self.client.get('/users/%d' % user.id).data)['data']['avatar_thumbnails']
+        assert urls['64']['webp']=='/depot/%s/thumbnails/64.webp' % avatar.path
+        rv = self.client.get(urls['64']['webp'])
+        assert rv.headers['Content-Type']=='image/webp' and Image.open(BytesIO(rv.data)).size==(64, 64)
+        assert self.client.get(urls['64']['webp'], headers={'If-None-Match': rv.headers['ETag']}).status_code==304
+        assert self.client.get('/depot/%s/thumbnails/65.webp' % avatar.path).status_code==404
+        # invalid avatar
+        rv = self.client.post('/users', data={
+            'username': json.dumps('bad_avatar_user'),
+            'avatar': (BytesIO(b'not an image'), 'avatar.png')
+        })
+        assert '400' in rv.status and get_response_data(rv.data)['type']=='bad_image'
+
+    def test_thumbnail_cache_eviction(self):
+        image = BytesIO()
+        Image.new('RGB', (300, 300), (0, 0, 255)).save(image, 'PNG')
+        user = User(username='cache_user', avatar=image.getvalue())
+        db.session.add(user)
+        db.session.commit()
+        stored_file = User.query.get(user.id).avatar.file
+        cache = ThumbnailCache(mkdtemp(), 1<<30)
+        thumbnails = [cache.get(stored_file, size, 'jpeg') for size in THUMBNAIL_SIZES]
+        # least recently used thumbnail is evicted first
+        for i, thumbnail in enumerate(thumbnails):
+            thumbnail.close()
+            os.utime(thumbnail._file_path, (i, i))
+        os.utime(thumbnails[0]._file_path, (len(thumbnails), len(thumbnails)))
+        sizes = [os.path.getsize(thumbnail._file_path) for thumbnail in thumbnails]
+        cache.max_size = (sizes[0]+sizes[2])/0.9
+        cache.evict()
+        assert [os.path.exists(thumbnail._file_path) for thumbnail in thumbnails]==[True, False, True]
+        assert cache.size==sizes[0]+sizes[2]
+
+    def test_stats_access(self):
+        """ Statistics endpoints are only served to allowed clients. """
+        rv = self.client.get("/stats/db_pool", environ_base={"REMOTE_ADDR": "203.0.113.1"})
+        assert rv.status_code==403
+        assert json.loads(rv.data.decode())["type"]=="perm_denied"
+        rv = self.client.get("/stats/db_pool", environ_base={"REMOTE_ADDR": "127.0.0.1"})
+        assert rv.status_code==200
+
+    def test_db_pool_wait_time(self):
+        """ Connect time is recorded separately from time waiting for a connection. """
+        def connect():
+            sleep(0.05)
+            return sqlite3.connect(":memory:")
+        pool = InstrumentedQueuePool(connect, pool_size=1, max_overflow=0)
+        connection = pool.connect()
+        stats = pool.stats()
+        assert (stats["connects"], stats["waits"])==(1, 0)
+        assert stats["connect_time_total"]>=0.05
+        assert stats["wait_time_total"]<0.05
+        # Wait for a connection in use
+        Timer(0.1, connection.close).start()
+        pool.connect().close()
+        stats = pool.stats()
+        assert (stats["checkouts"], stats["connects"], stats["waits"])==(2, 1, 1)
+        assert stats["wait_time_total"]>=0.1
@@ -1,19 +1,29 @@
 """ Core utility functions and classes. """
-import re, json
+import re, json, functools, itertools, logging, random
+from collections import OrderedDict
 from importlib import import_module
+from threading import RLock
+from weakref import WeakSet
+from time import monotonic, perf_counter
 from base64 import b64decode
 from contextlib import contextmanager
+from datetime import datetime, timedelta
 from types import FunctionType
 from traceback import format_exc, print_exc
 from base64 import b64decode
 from urllib.parse import unquote
-from flask import Response, request, g, jsonify
+from flask import Response, request, g, jsonify, stream_with_context, has_app_context
+from flask.json import JSONEncoder
+from flask.ctx import _AppCtxGlobals
 from flask.views import MethodView
 from marshmallow import Schema
 from marshmallow.schema import SchemaMeta
+from sqlalchemy import event, and_
+from sqlalchemy.engine import Engine
 
 from app import app, db
-from app.config import AUTH_TOKEN_HEADER, CORS_MAX_AGE
+from app.config import AUTH_TOKEN_HEADER, CORS_MAX_AGE, AUTH_CACHE_SIZE, AUTH_CACHE_TTL, REQUEST_TIMING, \
+    REQUEST_TIMING_LOG_RATE, AUTH_REVOCATION_POLL_INTERVAL, AUTH_REVOCATION_MARGIN
 
 # Object metadata key
 METADATA_KEY = "__metadata__"
@@ -44,6 +54,433 @@ def assert_logic(value, description, status=400):
         raise APIError(status, "logic", reason=description)
     return value
 
+def stream_json(data_chunks, **kwargs):
+    """
+    Make a streaming JSON response with a list of data.
+    The response is {<kwargs>..., "data": [...]}, with data encoded and sent chunk by chunk.
+    The first chunk is produced before the response starts, so that errors in it are reported
+    with a proper status; an error in a later chunk leaves the response body truncated.
+
+    Args:
+        data_chunks: Iterable of data chunks. Each chunk is a list of JSON serializable items.
+        kwargs: Other keys of the response object.
+    Returns:
+        Streaming response object.
+    """
+    data_chunks = iter(data_chunks)
+    first_chunk = next(data_chunks, [])
+    def generate():
+        # Response object head
+        head = json.dumps(kwargs)[:-1]
+        yield "%s%s\"data\": [" % (head, ", " if kwargs else "")
+        # Data chunks
+        first = True
+        for chunk in itertools.chain([first_chunk], data_chunks):
+            if not chunk:
+                continue
+            yield ("" if first else ", ")+", ".join(json.dumps(item) for item in chunk)
+            first = False
+        yield "]}"
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+def etag_response(etag, make_response):
+    """
+    Make a response supporting conditional GET with given entity tag.
+
+    Args:
+        etag: Entity tag of current representation, or None if not available.
+        make_response: Function making the full response. Not called if the client representation is current.
+    Returns:
+        "304 Not Modified" response if "If-None-Match" matches, or the full response otherwise.
+    """
+    if etag and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = make_response()
+    if etag:
+        response.set_etag(etag)
+    return response
+
+class ExpiringLRUCache(object):
+    """ Thread-safe LRU cache with bounded size and expiring entries. """
+    def __init__(self, max_size, ttl):
+        """
+        Constructor.
+
+        Args:
+            max_size: Maximum amount of entries.
+            ttl: Time to live of entries in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = RLock()
+    def _removed(self, key, value):
+        """
+        Called with the lock held when an entry is removed, replaced, expires or is evicted.
+
+        Args:
+            key: Entry key.
+            value: Entry value.
+        """
+        pass
+    def get(self, key, default=None):
+        """
+        Get value of a non-expired entry.
+
+        Args:
+            key: Entry key.
+            default: Fallback value for a missing or expired entry.
+        Returns:
+            Entry value.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry==None:
+                return default
+            value, expire_time = entry
+            # Expired
+            if expire_time<=monotonic():
+                del self._entries[key]
+                self._removed(key, value)
+                return default
+            self._entries.move_to_end(key)
+            return value
+    def set(self, key, value):
+        """
+        Set value of an entry, evicting least recently used entries when full.
+
+        Args:
+            key: Entry key.
+            value: Entry value.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry!=None:
+                self._removed(key, entry[0])
+            self._entries[key] = (value, monotonic()+self.ttl)
+            while len(self._entries)>self.max_size:
+                evicted_key, (evicted_value, _) = self._entries.popitem(last=False)
+                self._removed(evicted_key, evicted_value)
+    def pop(self, key):
+        """
+        Remove an entry.
+
+        Args:
+            key: Entry key.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry!=None:
+                self._removed(key, entry[0])
+
+class RevocationCache(ExpiringLRUCache):
+    """
+    LRU cache of current worker invalidated in all workers through the revocation log.
+    Revocations are recorded as "SessionRevocation" rows in the database, which every worker
+    polls at most every "AUTH_REVOCATION_POLL_INTERVAL" seconds on lookup, so that revoked entries
+    stop being served in all workers within the poll interval.
+    """
+    # Live revocation caches, whose entries must outlive revocation log cleanup
+    _caches = WeakSet()
+    # Kind of revocations handled by the cache
+    revocation_kind = None
+    def __init__(self, max_size, ttl, poll_interval=AUTH_REVOCATION_POLL_INTERVAL):
+        """
+        Constructor.
+
+        Args:
+            max_size: Maximum amount of entries.
+            ttl: Time to live of entries in seconds.
+            poll_interval: Interval of polling revocations in seconds.
+        """
+        super(RevocationCache, self).__init__(max_size, ttl)
+        self.poll_interval = poll_interval
+        # Monotonic and wall clock time of last poll
+        self._last_poll = (monotonic(), datetime.now())
+        RevocationCache._caches.add(self)
+    def _revoked(self, revocation):
+        """
+        Remove entries invalidated by a revocation of another worker.
+
+        Args:
+            revocation: Revocation row with "token" and "user_id" columns.
+        """
+        raise NotImplementedError()
+    def get(self, key, default=None):
+        """ Get value of a non-revoked entry. """
+        self.poll()
+        return super(RevocationCache, self).get(key, default)
+    def log_revocation(self, token=None, user_id=None, session=None):
+        """
+        Record a revocation for all workers.
+        The revocation is added to given database session, and takes effect in other workers after commit.
+        Revocations older than any cached entry are removed.
+
+        Args:
+            token: Session token.
+            user_id: User ID.
+            session: Database session. Defaults to "db.session".
+        """
+        if session==None:
+            session = db.session
+        SessionRevocation = import_module("app.models").SessionRevocation
+        table = SessionRevocation.__table__
+        now = datetime.now()
+        max_ttl = max([cache.ttl for cache in RevocationCache._caches]+[self.ttl])
+        session.execute(table.delete().where(
+            table.c.revoke_time<now-timedelta(seconds=max_ttl+AUTH_REVOCATION_MARGIN)
+        ))
+        session.execute(table.insert().values(
+            kind=self.revocation_kind,
+            token=token,
+            user_id=user_id,
+            revoke_time=now
+        ))
+    def poll(self, force=False):
+        """
+        Remove entries revoked by other workers since last poll.
+
+        Args:
+            force: Poll regardless of poll interval.
+        """
+        now = monotonic()
+        with self._lock:
+            last_poll, since = self._last_poll
+            if not force and now-last_poll<self.poll_interval:
+                return
+            self._last_poll = (now, datetime.now())
+        SessionRevocation = import_module("app.models").SessionRevocation
+        table = SessionRevocation.__table__
+        revocations = db.session.execute(table.select().where(and_(
+            table.c.kind==self.revocation_kind,
+            table.c.revoke_time>=since-timedelta(seconds=AUTH_REVOCATION_MARGIN)
+        ))).fetchall()
+        for revocation in revocations:
+            self._revoked(revocation)
+
+class AuthCache(RevocationCache):
+    """
+    Session token to user ID cache of current worker.
+    Logouts and user removals are recorded in the revocation log, so that revoked sessions
+    stop authenticating in all workers within the poll interval.
+    """
+    revocation_kind = "session"
+    def __init__(self, max_size, ttl, poll_interval=AUTH_REVOCATION_POLL_INTERVAL):
+        """
+        Constructor.
+
+        Args:
+            max_size: Maximum amount of entries.
+            ttl: Time to live of entries in seconds.
+            poll_interval: Interval of polling session revocations in seconds.
+        """
+        super(AuthCache, self).__init__(max_size, ttl, poll_interval)
+        # User ID to cached session tokens index
+        self._user_tokens = {}
+    def _removed(self, key, value):
+        """ Remove a token from user index. """
+        tokens = self._user_tokens.get(value)
+        if tokens!=None:
+            tokens.discard(key)
+            if not tokens:
+                del self._user_tokens[value]
+    def _revoked(self, revocation):
+        """ Remove a revoked session token or session tokens of a revoked user. """
+        if revocation.token!=None:
+            self.pop(revocation.token)
+        if revocation.user_id!=None:
+            self.pop_user(revocation.user_id)
+    def set(self, key, value):
+        """ Set user ID of a session token. """
+        with self._lock:
+            super(AuthCache, self).set(key, value)
+            if key in self._entries:
+                self._user_tokens.setdefault(value, set()).add(key)
+    def pop_user(self, user_id):
+        """
+        Remove all session tokens of a user.
+
+        Args:
+            user_id: User ID.
+        """
+        with self._lock:
+            for key in list(self._user_tokens.get(user_id, ())):
+                self.pop(key)
+    def revoke(self, token=None, user_id=None):
+        """
+        Revoke a session token or all session tokens of a user in all workers.
+        The revocation is added to current database session, and takes effect in other workers after commit.
+
+        Args:
+            token: Session token.
+            user_id: User ID.
+        """
+        if token!=None:
+            self.pop(token)
+        if user_id!=None:
+            self.pop_user(user_id)
+        self.log_revocation(token=token, user_id=user_id)
+
+# Session token to user ID cache
+auth_cache = AuthCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+class APIGlobals(_AppCtxGlobals):
+    """ Request globals with user of current request loaded lazily from "user_id". """
+    @property
+    def user(self):
+        """ User of current request. """
+        if "_user" not in self.__dict__:
+            user_id = getattr(self, "user_id", None)
+            if user_id==None:
+                self._user = None
+            else:
+                get_pk = import_module("app.util.data").get_pk
+                self._user = get_pk(import_module("app.models").User, user_id, allow_null=True)
+        return self._user
+    @user.setter
+    def user(self, user):
+        """ Set user of current request. """
+        self._user = user
+        self.user_id = user.id if user else None
+
+app.app_ctx_globals_class = APIGlobals
+
+class RequestTimer(object):
+    """ Timing of request processing sections and SQL statements. """
+    def __init__(self):
+        """ Constructor. """
+        self.start = perf_counter()
+        self.durations = OrderedDict()
+        self.n_statements = 0
+        self.__depths = {}
+    @contextmanager
+    def section(self, name):
+        """
+        Time a processing section in a with block. Only the outermost block of nested sections is timed.
+
+        Args:
+            name: Section name.
+        """
+        depth = self.__depths.get(name, 0)
+        self.__depths[name] = depth+1
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.__depths[name] = depth
+            if depth==0:
+                self.add(name, perf_counter()-start)
+    def add(self, name, duration):
+        """
+        Add duration to a processing section.
+
+        Args:
+            name: Section name.
+            duration: Duration in seconds.
+        """
+        self.durations[name] = self.durations.get(name, 0.0)+duration
+    def server_timing(self):
+        """
+        Format timing as "Server-Timing" header value.
+
+        Returns:
+            Header value with durations in milliseconds.
+        """
+        metrics = ["%s;dur=%.2f" % (name, duration*1000) for name, duration in self.durations.items()]
+        metrics.append('sql;desc="%d statements"' % self.n_statements)
+        metrics.append("total;dur=%.2f" % ((perf_counter()-self.start)*1000))
+        return ", ".join(metrics)
+    def log(self, response):
+        """
+        Log timing of current request as a JSON record.
+
+        Args:
+            response: Response of current request.
+        """
+        timing_logger.info(json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "statements": self.n_statements,
+            "total_ms": (perf_counter()-self.start)*1000,
+            **{"%s_ms" % name: duration*1000 for name, duration in self.durations.items()}
+        }))
+
+timing_logger = logging.getLogger("app.timing")
+
+# Request timing is enabled (Set with "set_request_timing")
+request_timing = False
+
+def current_timer():
+    """
+    Get request timer of current request.
+
+    Returns:
+        Request timer, or None if request timing is disabled or not in a request.
+    """
+    return g.get("timer") if has_app_context() else None
+
+def timed(name):
+    """
+    Time a function as a request processing section.
+    Usually used as decorator. The function is called directly while request timing is disabled.
+
+    Args:
+        name: Section name.
+    Returns:
+        Decorator function.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not request_timing:
+                return func(*args, **kwargs)
+            timer = current_timer()
+            if timer==None:
+                return func(*args, **kwargs)
+            with timer.section(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TimedJSONEncoder(JSONEncoder):
+    """ JSON encoder timing encoding as a request processing section. """
+    encode = timed("json")(JSONEncoder.encode)
+
+def __before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Record start time of SQL statement. """
+    conn.info.setdefault("timing_starts", []).append(perf_counter())
+
+def __after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Add duration of SQL statement to request timer. """
+    start = conn.info["timing_starts"].pop()
+    timer = current_timer()
+    if timer!=None:
+        timer.add("db", perf_counter()-start)
+        timer.n_statements += 1
+
+def set_request_timing(enabled):
+    """
+    Enable or disable request timing, installing or removing its hooks.
+
+    Args:
+        enabled: Whether requests are timed.
+    """
+    global request_timing
+    request_timing = enabled
+    app.json_encoder = TimedJSONEncoder if enabled else JSONEncoder
+    for name, listener in (
+        ("before_cursor_execute", __before_cursor_execute),
+        ("after_cursor_execute", __after_cursor_execute)
+    ):
+        if enabled and not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+        elif not enabled and event.contains(Engine, name, listener):
+            event.remove(Engine, name, listener)
+
+set_request_timing(REQUEST_TIMING)
+
 class APIView(MethodView):
     """ Backend API view class. """
     # Session class (Used to break reference circle)
@@ -61,6 +498,10 @@ class APIView(MethodView):
             self.get_pk = import_module("app.util.data").get_pk
     def dispatch_request(self, *args, **kwargs):
         """ Cross-origin request support. Authentication. """
+        # Request timing
+        timer = None
+        if request_timing:
+            timer = g.timer = RequestTimer()
         try:
             raw_json_params = request.args.get("json_params")
             # Parse raw user filters
@@ -72,9 +513,13 @@ class APIView(MethodView):
             # Authentication
             with map_error(APIError(401, "auth_failed")):
                 token = b64decode(request.headers.get(AUTH_TOKEN_HEADER, b""))
-                g.user = self.get_pk(self.session_class, token).user if token else None
+                g.user_id = self.authenticate(token) if token else None
             # Call base class method
-            response = super(APIView, self).dispatch_request(*args, **kwargs)
+            if timer:
+                with timer.section("handler"):
+                    response = super(APIView, self).dispatch_request(*args, **kwargs)
+            else:
+                response = super(APIView, self).dispatch_request(*args, **kwargs)
         except APIError as e:
             response = jsonify(e.data)
             response.status_code = e.status
@@ -90,7 +535,29 @@ class APIView(MethodView):
             print_exc()
         # Cross-origin request
         response.headers["Access-Control-Allow-Origin"] = "*"
+        # Request timing; streamed responses are timed until the first chunk
+        if timer:
+            response.headers["Server-Timing"] = timer.server_timing()
+            if random.random()<REQUEST_TIMING_LOG_RATE:
+                timer.log(response)
         return response
+    @timed("auth")
+    def authenticate(self, token):
+        """
+        Find ID of the user owning given session token.
+        Cached in "auth_cache", so the database is only queried on a cache miss.
+
+        Args:
+            token: Session token.
+        Returns:
+            User ID.
+        """
+        user_id = auth_cache.get(token)
+        if user_id==None:
+            user_id = self.get_pk(self.session_class, token).user_id
+            if user_id!=None:
+                auth_cache.set(token, user_id)
+        return user_id
     def get(self, ph1, ph2):
         """ HTTP GET method. """
         # List elements
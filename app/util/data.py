@@ -1,15 +1,64 @@
 """ Model and schema related utilities. """
-import functools, operator, json, re
+import functools, itertools, operator, json, re
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import OrderedDict
+from datetime import datetime, date
+from threading import Lock, local
 from flask import request, g
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, class_registry
 from marshmallow.schema import SchemaMeta
-from sqlalchemy import and_, or_, not_
+from marshmallow.utils import missing
+from marshmallow_sqlalchemy import ModelConverter as BaseModelConverter
+from sqlalchemy import and_, or_, not_, bindparam, literal, literal_column, select, event, func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import Session, Mapper, configure_mappers
 from sqlalchemy.orm.query import Query
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.inspection import inspect
+from sqlalchemy.sql.elements import BindParameter
 from sqlalchemy.sql.operators import ColumnOperators
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from app import db
-from app.util.core import APIError, camel_to_snake, map_error, getattr_keypath, setitem_keypath
+from app.config import BULK_MAX_SIZE, UPLOAD_MAX_SIZE
+from app.util.core import APIError, camel_to_snake, map_error, getattr_keypath, setitem_keypath, timed
+
+# Maximum amount of parent keys in a single prefetch query
+PREFETCH_CHUNK_SIZE = 500
+# Maximum amount of cached dump plans
+DUMP_PLAN_CACHE_SIZE = 256
+# Amount of rows fetched and serialized at a time in streaming mode
+STREAM_CHUNK_SIZE = 200
+# Maximum amount of cached user queries
+FILTER_CACHE_SIZE = 256
+# Text search configuration of PostgreSQL full-text search
+SEARCH_CONFIG = "english"
+# Approximate counts below this value are replaced by exact counts
+APPROX_COUNT_MIN = 10000
+
+def get_prefetched(field, kind, attr, obj):
+    """
+    Get relationship data of an object prefetched by "dump_data".
+
+    Args:
+        field: Relationship field being serialized.
+        kind: Prefetch kind, "keys" for related primary keys or "objects" for related objects.
+        attr: Relationship attribute name on the object.
+        obj: The object being serialized.
+    Returns:
+        A tuple with a boolean value indicating whether the data is prefetched, and the prefetched data.
+    """
+    prefetched = field.context.get("__prefetch")
+    if not prefetched:
+        return False, None
+    data_mapping = prefetched[kind].get((type(obj), attr))
+    if data_mapping==None:
+        return False, None
+    identity = inspect(obj).identity
+    if identity not in data_mapping:
+        return False, None
+    return True, data_mapping[identity]
 
 class Nested(fields.Nested):
     """ Modified Marshmallow Nested field with flexible nested serialization and deserialization. """
@@ -23,6 +72,32 @@ class Nested(fields.Nested):
         # Primary key
         model_mirror = self.model_mirror = inspect(model)
         self.primary_key = getattr(model, model_mirror.primary_key[0].name)
+    def serialize(self, attr, obj, accessor=None):
+        """
+        Serialize nested data, using related primary keys prefetched by "dump_data" when possible.
+
+        Args:
+            attr: The attribute or key to get from the object.
+            obj: The object to pull the key from.
+            accessor: Function used to pull values from the object.
+        Returns:
+            Serialized value.
+        """
+        attr = self.attribute or attr
+        # The same relationship may be prefetched as objects at one nesting level and as keys at another
+        nested_fields_stack = self.context.get("__nested_stack")
+        nested_fields = nested_fields_stack[-1] if nested_fields_stack else None
+        kinds = ("objects", "keys") if nested_fields and attr in nested_fields else ("keys", "objects")
+        for kind in kinds:
+            prefetched, value = get_prefetched(self, kind, attr, obj)
+            if not prefetched:
+                continue
+            # Related objects
+            if kind=="objects":
+                return self._serialize(value, attr, obj)
+            # Related primary keys
+            return value
+        return super(Nested, self).serialize(attr, obj, accessor)
     def _serialize(self, value, attr, obj):
         """
         Serialized nested data.
@@ -42,17 +117,19 @@ class Nested(fields.Nested):
         if value==None:
             return value
         # Queryset type check
-        if many and not isinstance(value, Query):
-            raise TypeError("Only queryset can be serialized when many is True.")
+        if many and not isinstance(value, (Query, list)):
+            raise TypeError("Only queryset or list can be serialized when many is True.")
         # Nested field serialization restriction
         if not nested_fields or attr not in nested_fields:
-            if many:
-                return [item[0] for item in value.with_entities(self.primary_key).all()]
+            if many and isinstance(value, list):
+                return [getattr(item, self.primary_key.name) for item in value]
+            elif many:
+                return [item[0] for item in value.with_entities(self.primary_key).order_by(self.primary_key).all()]
             else:
                 return getattr(value, self.primary_key.name)
         # Transfrom query set to iterable data if many is true
         if many and isinstance(value, Query):
-            value = value.all()
+            value = value.order_by(self.primary_key).all()
         # Nested nested fields
         nested_nested_fields = nested_fields[attr]
         if nested_nested_fields:
@@ -84,6 +161,379 @@ class Nested(fields.Nested):
         else:
             return value if isinstance(value, model) else get_pk(model, value)
 
+class RelatedList(fields.List):
+    """ List of related data, using related primary keys prefetched by "dump_data" when possible. """
+    def serialize(self, attr, obj, accessor=None):
+        """
+        Serialize related data.
+
+        Args:
+            attr: The attribute or key to get from the object.
+            obj: The object to pull the key from.
+            accessor: Function used to pull values from the object.
+        Returns:
+            Serialized value.
+        """
+        prefetched, keys = get_prefetched(self, "keys", self.attribute or attr, obj)
+        if prefetched:
+            return keys
+        return super(RelatedList, self).serialize(attr, obj, accessor)
+
+class ModelConverter(BaseModelConverter):
+    """ Model converter that generates prefetchable fields for to-many relationships. """
+    def property2field(self, prop, instance=True, field_class=None, **kwargs):
+        """
+        Convert a SQLAlchemy model property to a schema field.
+
+        Args:
+            prop: SQLAlchemy model property.
+            instance: Return field instance if true, or field class otherwise.
+            field_class: Field class to be used.
+            kwargs: Additional field arguments.
+        Returns:
+            Field instance or field class.
+        """
+        field = super(ModelConverter, self).property2field(prop, instance, field_class, **kwargs)
+        # Replace list of related data
+        if instance and type(field)==fields.List:
+            field = RelatedList(field.container, **kwargs)
+        return field
+
+def __related_columns(prop):
+    """
+    Get the columns used to group related rows of a relationship by their parent.
+
+    Args:
+        prop: SQLAlchemy relationship property.
+    Returns:
+        A tuple with the local join column and the related primary key column.
+    """
+    # Many-to-many relationship through helper table
+    if prop.secondary is not None:
+        return prop.synchronize_pairs[0][1], prop.secondary_synchronize_pairs[0][1]
+    # One-to-many or many-to-one relationship
+    return prop.local_remote_pairs[0][1], prop.mapper.primary_key[0]
+
+def __query_related_keys(prop, keys):
+    """
+    Query related primary keys of given relationship in one grouped query.
+
+    Args:
+        prop: SQLAlchemy relationship property.
+        keys: Values of the local join column of parent objects.
+    Returns:
+        A list of (local join column value, related primary key) tuples.
+    """
+    local_column, remote_column = __related_columns(prop)
+    return db.session.query(local_column, remote_column) \
+        .filter(local_column.in_(keys)) \
+        .order_by(remote_column) \
+        .all()
+
+def __query_related_objects(prop, keys):
+    """
+    Query related objects of given relationship in one grouped query.
+
+    Args:
+        prop: SQLAlchemy relationship property.
+        keys: Values of the local join column of parent objects.
+    Returns:
+        A list of (local join column value, related object) tuples.
+    """
+    local_column, remote_column = __related_columns(prop)
+    target_model = prop.mapper.class_
+    target_pk = prop.mapper.primary_key[0]
+    query_set = db.session.query(local_column, target_model).filter(local_column.in_(keys))
+    # Join helper table
+    if prop.secondary is not None:
+        query_set = query_set.filter(remote_column==target_pk)
+    return query_set.order_by(target_pk).all()
+
+def __group_related(prop, objs, query_func):
+    """
+    Group related data of given relationship by parent objects.
+
+    Args:
+        prop: SQLAlchemy relationship property.
+        objs: Parent model instances.
+        query_func: Grouped query function returning (local join column value, related data) tuples.
+    Returns:
+        A mapping from parent object identity to related data.
+    """
+    mapper = prop.parent
+    local_attr = mapper.get_property_by_column(prop.local_remote_pairs[0][0]).key
+    local_keys = [getattr(obj, local_attr) for obj in objs]
+    # Query related data in chunks
+    related_by_local = {key: [] for key in local_keys}
+    query_keys = [key for key in related_by_local if key!=None]
+    for i in range(0, len(query_keys), PREFETCH_CHUNK_SIZE):
+        for local_key, related in query_func(prop, query_keys[i:i+PREFETCH_CHUNK_SIZE]):
+            related_by_local[local_key].append(related)
+    # Group by parent objects
+    result = {}
+    for obj, key in zip(objs, local_keys):
+        related = related_by_local[key]
+        result[inspect(obj).identity] = related if prop.uselist else (related[0] if related else None)
+    return result
+
+def prefetchable_relationship(schema, name, field):
+    """
+    Get the relationship property behind a schema field if it can be prefetched.
+
+    Args:
+        schema: Schema instance used for serialization.
+        name: Field name.
+        field: Schema field.
+    Returns:
+        SQLAlchemy relationship property, or None if the field cannot be prefetched.
+    """
+    if field.load_only or not isinstance(field, (Nested, RelatedList)):
+        return None
+    prop = inspect(schema.opts.model).relationships.get(field.attribute or name)
+    if not prop or len(prop.synchronize_pairs)!=1:
+        return None
+    # Many-to-one relationship must refer to primary key
+    if not prop.uselist and prop.local_remote_pairs[0][1] not in prop.mapper.primary_key:
+        return None
+    return prop
+
+def prefetch_related(schema, objs, nested_fields, prefetched=None):
+    """
+    Batch-resolve relationship fields of given objects, one grouped query per field and nesting level.
+    Non-nested relationships are resolved to related primary keys, while nested ones are resolved
+    to related objects and prefetched recursively.
+
+    Args:
+        schema: Schema instance used for serialization.
+        objs: Model instances to be serialized.
+        nested_fields: Nested fields tree. Relationships in it are serialized as nested data.
+        prefetched: Prefetch result to be updated.
+    Returns:
+        A mapping from prefetch kind ("keys" or "objects") to a mapping from (model, attribute)
+        to a mapping from object identity to prefetched data.
+    """
+    if prefetched==None:
+        prefetched = {"keys": {}, "objects": {}}
+    objs = [obj for obj in objs if obj!=None]
+    if not objs:
+        return prefetched
+    for name, field in schema.fields.items():
+        prop = prefetchable_relationship(schema, name, field)
+        if not prop:
+            continue
+        attr = prop.key
+        # Nested relationship: prefetch objects and their relationships
+        if attr in nested_fields:
+            if not isinstance(field, Nested):
+                continue
+            related = __group_related(prop, objs, __query_related_objects)
+            prefetched["objects"].setdefault((prop.parent.class_, attr), {}).update(related)
+            children = {}
+            for value in related.values():
+                for child in (value if prop.uselist else [value]):
+                    if child!=None:
+                        children[inspect(child).identity] = child
+            prefetch_related(field.schema, list(children.values()), nested_fields[attr], prefetched)
+        # Many-to-one relationship: take local foreign key directly
+        elif not prop.uselist:
+            fk_attr = prop.parent.get_property_by_column(prop.local_remote_pairs[0][0]).key
+            prefetched["keys"].setdefault((prop.parent.class_, attr), {}).update({
+                inspect(obj).identity: getattr(obj, fk_attr) for obj in objs
+            })
+        # To-many relationship: related primary keys
+        else:
+            related = __group_related(prop, objs, __query_related_keys)
+            prefetched["keys"].setdefault((prop.parent.class_, attr), {}).update(related)
+    return prefetched
+
+def build_nested_fields(nested):
+    """
+    Build nested fields tree from nested field key paths.
+
+    >>> build_nested_fields(["paper.owners", "author", "paper"])
+    {'author': {}, 'paper': {'owners': {}}}
+
+    Args:
+        nested: Key paths of nested fields.
+    Returns:
+        Nested fields tree.
+    """
+    nested_fields = {}
+    # Parent key paths are sorted before their children
+    for keypath in sorted(set(nested)):
+        setitem_keypath(nested_fields, keypath, {}, True)
+    return nested_fields
+
+class DumpPlan(object):
+    """ Compiled serialization plan of a schema class with given nested fields. """
+    def __init__(self, schema_class, nested, only=None, exclude=()):
+        """
+        Constructor.
+
+        Args:
+            schema_class: Schema class used for serialization.
+            nested: Normalized key paths of nested fields.
+            only: Names of fields to be serialized.
+            exclude: Names of fields not to be serialized.
+        """
+        self.schema = schema = schema_class(only=only, exclude=exclude)
+        self.nested_fields = build_nested_fields(nested)
+        self.model = schema.opts.model
+        self.extractors = []
+        # Compile field extractors
+        for name, field in schema.fields.items():
+            if field.load_only:
+                continue
+            key = (schema.prefix or "")+(field.dump_to or name)
+            self.extractors.append((key, self.__compile_field(name, field)))
+    def __compile_field(self, name, field):
+        """
+        Compile extractor function of a field.
+
+        Args:
+            name: Field name.
+            field: Schema field.
+        Returns:
+            Extractor function taking object, object identity and prefetch result.
+        """
+        attr = field.attribute or name
+        prop = prefetchable_relationship(self.schema, name, field)
+        # Generic field
+        if not prop:
+            # Plain attribute
+            if field._CHECK_ATTRIBUTE and type(field).serialize==fields.Field.serialize:
+                serialize = field._serialize
+                return lambda obj, identity, prefetched: serialize(getattr(obj, attr, None), attr, obj)
+            return lambda obj, identity, prefetched: field.serialize(attr, obj)
+        prefetch_key = (self.model, attr)
+        # Nested relationship
+        if attr in self.nested_fields and isinstance(field, Nested):
+            child_plan = get_dump_plan(
+                class_registry.get_class(field.nested) if isinstance(field.nested, str) else field.nested,
+                flatten_nested_fields(self.nested_fields[attr]),
+                field.only,
+                field.exclude
+            )
+            pk_column = field.primary_key
+            def extract_nested(obj, identity, prefetched):
+                objects = prefetched["objects"].get(prefetch_key, {})
+                value = objects[identity] if identity in objects else getattr(obj, attr)
+                if value==None:
+                    return None
+                elif prop.uselist:
+                    if isinstance(value, Query):
+                        value = value.order_by(pk_column).all()
+                    return child_plan.dump(value, prefetched, many=True)
+                else:
+                    return child_plan.dump(value, prefetched)
+            return extract_nested
+        # Related primary keys
+        def extract_keys(obj, identity, prefetched):
+            keys = prefetched["keys"].get(prefetch_key, {})
+            return keys[identity] if identity in keys else field.serialize(attr, obj)
+        return extract_keys
+    def prefetch(self, objs):
+        """
+        Batch-resolve relationships of objects to be serialized.
+
+        Args:
+            objs: Model instances to be serialized.
+        Returns:
+            Prefetch result. See "prefetch_related" for format.
+        """
+        return prefetch_related(self.schema, objs, self.nested_fields)
+    def dump(self, obj, prefetched, many=False):
+        """
+        Serialize objects with compiled field extractors.
+
+        Args:
+            obj: Model instance or instances to be serialized.
+            prefetched: Prefetch result.
+            many: Serialize a list of objects if true.
+        Returns:
+            Serialized data.
+        """
+        if many:
+            return [self.dump(item, prefetched) for item in obj]
+        if obj==None:
+            return None
+        identity = inspect(obj).identity
+        result = {}
+        for key, extract in self.extractors:
+            value = extract(obj, identity, prefetched)
+            if value is not missing:
+                result[key] = value
+        return result
+
+def flatten_nested_fields(nested_fields, prefix=None):
+    """
+    Flatten nested fields tree into key paths.
+
+    >>> flatten_nested_fields({"author": {}, "paper": {"owners": {}}})
+    ['author', 'paper', 'paper.owners']
+
+    Args:
+        nested_fields: Nested fields tree.
+        prefix: Key path prefix.
+    Returns:
+        Sorted key paths of all nodes in the tree.
+    """
+    result = []
+    for name, children in nested_fields.items():
+        keypath = "%s.%s" % (prefix, name) if prefix else name
+        result.append(keypath)
+        result.extend(flatten_nested_fields(children, keypath))
+    return sorted(result)
+
+# Dump plan cache
+__dump_plans = OrderedDict()
+__dump_plans_lock = Lock()
+
+def get_dump_plan(schema_class, nested=(), only=None, exclude=()):
+    """
+    Get cached dump plan of a schema class with given nested fields shape.
+
+    Args:
+        schema_class: Schema class used for serialization.
+        nested: Key paths of nested fields.
+        only: Names of fields to be serialized.
+        exclude: Names of fields not to be serialized.
+    Returns:
+        Dump plan instance.
+    """
+    # Normalize cache key
+    nested = tuple(sorted(set(nested)))
+    only = tuple(sorted(only)) if only!=None else None
+    exclude = tuple(sorted(exclude or ()))
+    key = (schema_class, nested, only, exclude)
+    with __dump_plans_lock:
+        plan = __dump_plans.get(key)
+        if plan:
+            __dump_plans.move_to_end(key)
+            return plan
+    # Compile plan outside lock; nested plans are looked up recursively
+    plan = DumpPlan(schema_class, nested, only, exclude)
+    with __dump_plans_lock:
+        __dump_plans[key] = plan
+        if len(__dump_plans)>DUMP_PLAN_CACHE_SIZE:
+            __dump_plans.popitem(last=False)
+    return plan
+
+def has_dump_processors(schema_class):
+    """
+    Check if a schema class has pre-dump or post-dump processors.
+
+    Args:
+        schema_class: Schema class.
+    Returns:
+        Whether the schema class has dump processors.
+    """
+    processors = getattr(schema_class, "__processors__", {})
+    return any(tag in ("pre_dump", "post_dump") and attrs for (tag, _), attrs in processors.items())
+
+# Per-thread schema instances for deserialization
+__load_schemas = local()
+
 def load_data(schema, data, load_args={}, **kwargs):
     """
     Load data through schema.
@@ -98,17 +548,153 @@ def load_data(schema, data, load_args={}, **kwargs):
     # Schema instance
     if isinstance(schema, Schema):
         load_args = kwargs
+    # Schema class with only target instance given; reuse schema instance of current thread
+    elif issubclass(schema, Schema) and set(kwargs)<={"instance"}:
+        schemas = getattr(__load_schemas, "schemas", None)
+        if schemas==None:
+            schemas = __load_schemas.schemas = {}
+        if schema not in schemas:
+            schemas[schema] = schema()
+        schema = schemas[schema]
+        load_args = dict(load_args, **kwargs)
     # Schema class
     elif issubclass(schema, Schema):
         schema = schema(**kwargs)
     else:
         raise TypeError("'schema' must be a derived class or a instance of Schema class.")
     # Parse with error handling
-    obj, error = schema.load(data, **load_args)
+    try:
+        obj, error = schema.load(data, **load_args)
+    finally:
+        # Model schema keeps target instance after loading
+        if hasattr(schema, "instance"):
+            schema.instance = None
     if error:
         raise APIError(400, "arg_fmt", errors=error)
     return obj
 
+def load_data_many(schema_class, items, instances=None):
+    """
+    Load a list of items through schema, validating all items before reporting errors.
+    Database is not flushed during loading.
+
+    Args:
+        schema_class: Schema class used for deserialization.
+        items: List of data to be deserialized.
+        instances: Target instances of items for updating, or None for creating new instances.
+    Returns:
+        A list of loaded instances.
+    Raises:
+        APIError: When any item fails to load, with errors keyed by item index.
+    """
+    schema = schema_class()
+    objs, errors = [], {}
+    with db.session.no_autoflush:
+        # Load referenced elements into identity map in batch; keep references until loading ends
+        referenced = []
+        for name, field in schema.fields.items():
+            if isinstance(field, Nested) and not field.metadata.get("many", False):
+                model = field.metadata["model"]
+                pk_column = inspect(model).primary_key[0]
+                pks = list({
+                    item[name] for item in items
+                    if isinstance(item, dict) and isinstance(item.get(name), (int, str))
+                })
+                for i in range(0, len(pks), PREFETCH_CHUNK_SIZE):
+                    referenced.extend(model.query.filter(pk_column.in_(pks[i:i+PREFETCH_CHUNK_SIZE])))
+        # Load items
+        for i, item in enumerate(items):
+            schema.instance = instances[i] if instances else None
+            try:
+                obj, error = schema.load(item)
+            except APIError as e:
+                obj, error = None, e.data
+            finally:
+                schema.instance = None
+            if error:
+                errors[i] = error
+            objs.append(obj)
+    if errors:
+        raise APIError(400, "arg_fmt", errors=errors)
+    return objs
+
+def get_pks(model, pks):
+    """
+    Get elements by primary keys with a query per "PREFETCH_CHUNK_SIZE" elements.
+
+    Args:
+        model: Model class to operate.
+        pks: Primary keys of the elements.
+    Returns:
+        Model instances in the order of primary keys.
+    Raises:
+        APIError: When some elements are not found, with indexes of missing elements.
+    """
+    pk_column = inspect(model).primary_key[0]
+    results = {}
+    for i in range(0, len(pks), PREFETCH_CHUNK_SIZE):
+        for obj in model.query.filter(pk_column.in_(pks[i:i+PREFETCH_CHUNK_SIZE])):
+            results[inspect(obj).identity[0]] = obj
+    missing_indexes = [i for i, pk in enumerate(pks) if pk not in results]
+    if missing_indexes:
+        raise APIError(404, "not_found", indexes=missing_indexes)
+    return [results[pk] for pk in pks]
+
+def reload_many(model, objs):
+    """
+    Reload persistent elements, e.g. expired by a commit, with a query per "PREFETCH_CHUNK_SIZE" elements.
+
+    Args:
+        model: Model class of elements.
+        objs: Persistent model instances.
+    Returns:
+        Reloaded model instances in the order of given elements.
+    """
+    return get_pks(model, [inspect(obj).identity[0] for obj in objs])
+
+def add_many(model, objs):
+    """
+    Add new elements to database session and flush them in batch.
+    On PostgreSQL, primary keys are reserved from the sequence with a single query,
+    which lets rows be inserted with "executemany" instead of one statement per row.
+
+    Args:
+        model: Model class of elements.
+        objs: New model instances.
+    """
+    pk_column = inspect(model).primary_key[0]
+    if objs and db.engine.dialect.name=="postgresql" and pk_column.autoincrement:
+        pks = db.session.execute(
+            "SELECT nextval(pg_get_serial_sequence(:table_name, :column_name)) FROM generate_series(1, :n)",
+            {"table_name": model.__tablename__, "column_name": pk_column.name, "n": len(objs)}
+        ).fetchall()
+        for obj, (pk,) in zip(objs, pks):
+            setattr(obj, pk_column.key, pk)
+    db.session.add_all(objs)
+    db.session.flush()
+
+def handle_bulk_prog_error(objs):
+    """
+    Make a PG8000 programming error handler for a batch of elements.
+    Unique violations are mapped to the index of the violating element.
+
+    Args:
+        objs: Elements being written, in request order.
+    Returns:
+        Error handler function.
+    """
+    def handler(e):
+        error = handle_prog_error(e)
+        if isinstance(error, APIError) and error.data["type"]=="unique_violation":
+            key, value = error.data["key"], error.data["value"]
+            for i, obj in enumerate(objs):
+                if str(getattr(obj, key, None))==value:
+                    error.data["index"] = i
+                    break
+        return error
+    return handler
+
+@timed("dump")
 def dump_data(schema, obj, nested=(), nested_user=False, dump_args={}, **kwargs):
     """
     Dump data through schema.
@@ -126,6 +712,13 @@ def dump_data(schema, obj, nested=(), nested_user=False, dump_args={}, **kwargs)
     nested = list(nested)
     if nested_user:
         nested += g.json_params.get("with", [])
+    # Schema class; dump with cached dump plan
+    if isinstance(schema, type) and issubclass(schema, Schema) and set(kwargs)<={"many", "only", "exclude"} \
+        and not dump_args and not has_dump_processors(schema):
+        many = kwargs.get("many", False)
+        plan = get_dump_plan(schema, nested, kwargs.get("only"), kwargs.get("exclude", ()))
+        prefetched = plan.prefetch(obj if many else [obj])
+        return plan.dump(obj, prefetched, many=many)
     # Schema instance
     if isinstance(schema, Schema):
         load_args = kwargs
@@ -135,15 +728,36 @@ def dump_data(schema, obj, nested=(), nested_user=False, dump_args={}, **kwargs)
     else:
         raise TypeError("'schema' must be a derived class or a instance of Schema class.")
     # Nested fields
-    nested_fields = {}
-    for keypath in nested:
-        setitem_keypath(nested_fields, keypath, {}, True)
+    nested_fields = build_nested_fields(nested)
     # Dump with nested schema support
     schema.context["__nested_stack"] = [nested_fields]
+    # Batch-resolve relationships of all objects and nested objects
+    many = dump_args.get("many", schema.many)
+    schema.context["__prefetch"] = prefetch_related(schema, obj if many else [obj], nested_fields)
     result = schema.dump(obj, **dump_args)[0]
     schema.context["__nested_stack"] = None
+    schema.context["__prefetch"] = None
     return result
 
+def dump_stream(schema_class, chunks, nested=(), nested_user=False):
+    """
+    Dump chunks of model instances through schema, one chunk at a time.
+
+    Args:
+        schema_class: Schema class used for serialization.
+        chunks: Iterable of lists of model instances, like the result of "query_user_chunks".
+        nested: Nested fields to be serialized.
+        nested_user: Serialize nested fields designated by user request.
+    Returns:
+        A generator of serialized data chunks.
+    """
+    nested = list(nested)
+    if nested_user:
+        nested += g.json_params.get("with", [])
+    plan = get_dump_plan(schema_class, nested)
+    for chunk in chunks:
+        yield plan.dump(chunk, plan.prefetch(chunk), many=True)
+
 def get_pk(model, pk, allow_null=False, error=APIError(404, "not_found")):
     """
     Get element by primary key.
@@ -194,7 +808,7 @@ def foreign_key(target_model, backref_name):
     """
     return (
         db.relationship(target_model, backref=db.backref(backref_name, lazy="dynamic")),
-        db.Column(db.Integer(), db.ForeignKey("%s.id" % camel_to_snake(target_model)))
+        db.Column(db.Integer(), db.ForeignKey("%s.id" % camel_to_snake(target_model)), index=True)
     )
 
 def many_to_many(source_model, target_model, backref_name):
@@ -210,11 +824,23 @@ def many_to_many(source_model, target_model, backref_name):
     """
     source_model_snake = camel_to_snake(source_model)
     target_model_snake = camel_to_snake(target_model)
-    # Helper table
+    table_name = "m2m_%s_%s_%s" % (source_model, target_model, backref_name)
+    # Helper table; primary key serves lookups from source side, extra index serves target side
     helper_table = db.Table(
-        "m2m_%s_%s_%s" % (source_model, target_model, backref_name),
-        db.Column("%s_id" % source_model_snake, db.Integer, db.ForeignKey("%s.id" % source_model_snake)),
-        db.Column("%s_id" % target_model_snake, db.Integer, db.ForeignKey("%s.id" % target_model_snake))
+        table_name,
+        db.Column(
+            "%s_id" % source_model_snake,
+            db.Integer,
+            db.ForeignKey("%s.id" % source_model_snake),
+            primary_key=True
+        ),
+        db.Column(
+            "%s_id" % target_model_snake,
+            db.Integer,
+            db.ForeignKey("%s.id" % target_model_snake),
+            primary_key=True
+        ),
+        db.Index("ix_%s_%s_id" % (table_name, target_model_snake), "%s_id" % target_model_snake)
     )
     # Many-to-many relationship
     return db.relationship(
@@ -224,6 +850,556 @@ def many_to_many(source_model, target_model, backref_name):
         lazy="dynamic"
     )
 
+# Models with full-text search index
+searchable_models = []
+
+def searchable(*field_names):
+    """
+    Declare full-text searchable fields of a model, for the "search" query operator.
+    The search index is created along with the model table and updated on insert and update.
+    PostgreSQL uses a GIN index over a "tsvector" expression, and SQLite uses a FTS5 table kept
+    in sync by triggers. Other databases fall back to case-insensitive containment.
+    Usually used as class decorator.
+
+    Args:
+        field_names: Names of searchable text fields.
+    Returns:
+        Class decorator.
+    """
+    def decorator(model):
+        model.__search_fields__ = field_names
+        event.listen(model.__table__, "after_create", lambda target, conn, **kwargs: create_search_index(conn, model))
+        event.listen(model.__table__, "before_drop", lambda target, conn, **kwargs: drop_search_index(conn, model))
+        searchable_models.append(model)
+        return model
+    return decorator
+
+def __search_table_name(model):
+    """ Get name of SQLite FTS5 table of a model. """
+    return "fts_%s" % model.__tablename__
+
+def __search_vector(model):
+    """ Build PostgreSQL "tsvector" expression of searchable fields of a model. """
+    columns = [getattr(model, field_name) for field_name in model.__search_fields__]
+    document = func.coalesce(columns[0], literal_column("''"))
+    for column in columns[1:]:
+        document = document.op("||")(literal_column("' '")).op("||")(func.coalesce(column, literal_column("''")))
+    return func.to_tsvector(literal_column("'%s'" % SEARCH_CONFIG), document)
+
+def create_search_index(conn, model):
+    """
+    Create full-text search index of a model if it does not exist, indexing existing rows.
+
+    Args:
+        conn: Database connection.
+        model: Searchable model class.
+    """
+    preparer = conn.dialect.identifier_preparer
+    table_name = preparer.format_table(model.__table__)
+    pk_name = preparer.quote(inspect(model).primary_key[0].name)
+    column_names = [preparer.quote(getattr(model, field_name).name) for field_name in model.__search_fields__]
+    # PostgreSQL; expression index
+    if conn.dialect.name=="postgresql":
+        conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s USING gin ((%s))" % (
+            preparer.quote("ix_%s_search" % model.__tablename__),
+            table_name,
+            __search_vector(model).compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+        ))
+    # SQLite; external content FTS5 table and triggers
+    elif conn.dialect.name=="sqlite":
+        fts_name = __search_table_name(model)
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", fts_name).scalar():
+            return
+        fields = ", ".join(column_names)
+        new_fields = ", ".join("new.%s" % name for name in column_names)
+        old_fields = ", ".join("old.%s" % name for name in column_names)
+        conn.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, content=%s, content_rowid=%s)" % (
+            fts_name, fields, table_name, pk_name
+        ))
+        for trigger_name, event_name, statements in (
+            ("ai", "INSERT", ["INSERT INTO {fts}(rowid, {fields}) VALUES (new.{pk}, {new_fields});"]),
+            ("ad", "DELETE", ["INSERT INTO {fts}({fts}, rowid, {fields}) VALUES ('delete', old.{pk}, {old_fields});"]),
+            ("au", "UPDATE", [
+                "INSERT INTO {fts}({fts}, rowid, {fields}) VALUES ('delete', old.{pk}, {old_fields});",
+                "INSERT INTO {fts}(rowid, {fields}) VALUES (new.{pk}, {new_fields});"
+            ])
+        ):
+            conn.execute(("CREATE TRIGGER {fts}_%s AFTER %s ON {table} BEGIN %s END" % (
+                trigger_name, event_name, " ".join(statements)
+            )).format(fts=fts_name, table=table_name, pk=pk_name, fields=fields, new_fields=new_fields, old_fields=old_fields))
+        conn.execute("INSERT INTO {fts}({fts}) VALUES ('rebuild')".format(fts=fts_name))
+
+def drop_search_index(conn, model):
+    """
+    Drop full-text search index of a model stored outside of model table.
+
+    Args:
+        conn: Database connection.
+        model: Searchable model class.
+    """
+    if conn.dialect.name=="sqlite":
+        conn.execute("DROP TABLE IF EXISTS %s" % __search_table_name(model))
+
+def __search_value(search_text):
+    """
+    Convert user-provided search text into full-text search query value of current database.
+
+    Args:
+        search_text: Search text.
+    Returns:
+        Query value; a FTS5 query matching all words on SQLite, or the text itself otherwise.
+    """
+    if not isinstance(search_text, str):
+        raise APIError(400, "bad_json_params")
+    if db.engine.dialect.name=="sqlite":
+        return " ".join('"%s"' % word for word in re.findall(r"\w+", search_text)) or '""'
+    return search_text
+
+def __search_exp(model, value):
+    """
+    Build full-text search filter expression.
+
+    Args:
+        model: Searchable model class.
+        value: Search query value or bind parameter.
+    Returns:
+        SQLAlchemy filter expression.
+    """
+    if not hasattr(model, "__search_fields__"):
+        raise APIError(400, "search_not_supported")
+    dialect = db.engine.dialect.name
+    if dialect=="postgresql":
+        return __search_vector(model).op("@@")(func.plainto_tsquery(literal_column("'%s'" % SEARCH_CONFIG), value))
+    elif dialect=="sqlite":
+        fts_name = __search_table_name(model)
+        return inspect(model).primary_key[0].in_(
+            select([literal_column("rowid")])
+                .select_from(text(fts_name))
+                .where(literal_column(fts_name).op("MATCH")(value))
+        )
+    return or_(*[
+        getattr(model, field_name).ilike(literal("%")+value+"%")
+        for field_name in model.__search_fields__
+    ])
+
+def __search_rank(model, value):
+    """
+    Build ordering expression of full-text search rank, best matches first.
+
+    Args:
+        model: Searchable model class.
+        value: Search query value or bind parameter.
+    Returns:
+        SQLAlchemy ordering expression, or None if ranking is not supported.
+    """
+    dialect = db.engine.dialect.name
+    if dialect=="postgresql":
+        return func.ts_rank(
+            __search_vector(model),
+            func.plainto_tsquery(literal_column("'%s'" % SEARCH_CONFIG), value)
+        ).desc()
+    elif dialect=="sqlite":
+        fts_name = __search_table_name(model)
+        # BM25 rank; smaller is better
+        return select([literal_column("rank")]) \
+            .select_from(text(fts_name)) \
+            .where(and_(
+                literal_column("rowid")==inspect(model).primary_key[0],
+                literal_column(fts_name).op("MATCH")(value)
+            )) \
+            .as_scalar() \
+            .asc()
+    return None
+
+class Versioned(object):
+    """ Mixin of models whose representation version is tracked for conditional requests. """
+    version = db.Column(db.Integer(), nullable=False, default=1, server_default="1")
+
+def bump_versions(model, condition):
+    """
+    Increase representation versions of matching elements with a single UPDATE statement.
+    Also keeps "last_modified" columns current. Write paths bypassing the ORM must call this.
+
+    Args:
+        model: Model class to operate.
+        condition: SQLAlchemy filter expression of elements.
+    """
+    table = model.__table__
+    values = {}
+    if issubclass(model, Versioned):
+        values["version"] = table.c.version+1
+    if "last_modified" in table.c:
+        values["last_modified"] = datetime.now()
+    if values:
+        db.session.execute(table.update().where(condition).values(values))
+
+def __track_versions(session, flush_context, instances):
+    """
+    Increase representation versions of elements modified in current flush.
+    Versions are increased with one UPDATE statement per model, so that the flush itself
+    can batch updates of modified elements.
+
+    Args:
+        session: SQLAlchemy session being flushed.
+        flush_context: Flush context.
+        instances: Unused.
+    """
+    # Model to primary keys and extra conditions of elements to bump
+    bump_ids = OrderedDict()
+    bump_conditions = OrderedDict()
+    def bump_parents(obj, state, prop_filter):
+        """ Bump targets of many-to-one relationships by their foreign keys. """
+        for prop in state.mapper.relationships:
+            if prop.uselist or not issubclass(prop.mapper.class_, Versioned) or len(prop.synchronize_pairs)!=1:
+                continue
+            if not prop_filter(prop):
+                continue
+            # Foreign key is synchronized later in the flush, so it still refers to previous target
+            fk_value = getattr(obj, state.mapper.get_property_by_column(prop.local_remote_pairs[0][0]).key)
+            if fk_value!=None:
+                bump_ids.setdefault(prop.mapper.class_, set()).add(fk_value)
+    # New elements; parents gain them
+    for obj in session.new:
+        bump_parents(obj, inspect(obj), lambda prop: True)
+    # Deleted elements; related elements lose their keys
+    for obj in session.deleted:
+        state = inspect(obj)
+        bump_parents(obj, state, lambda prop: True)
+        for prop in state.mapper.relationships:
+            target_model = prop.mapper.class_
+            if not prop.uselist or not issubclass(target_model, Versioned) or len(prop.synchronize_pairs)!=1:
+                continue
+            local_value = getattr(obj, state.mapper.get_property_by_column(prop.local_remote_pairs[0][0]).key)
+            if local_value==None:
+                continue
+            # Many-to-many relationship
+            if prop.secondary is not None:
+                local_column, remote_column = __related_columns(prop)
+                condition = prop.mapper.primary_key[0].in_(select([remote_column]).where(local_column==local_value))
+            # One-to-many relationship
+            else:
+                condition = prop.local_remote_pairs[0][1]==local_value
+            bump_conditions.setdefault(target_model, []).append(condition)
+    # Modified elements
+    for obj in session.dirty:
+        if not session.is_modified(obj):
+            continue
+        state = inspect(obj)
+        # Previous targets of changed many-to-one relationships
+        bump_parents(obj, state, lambda prop: state.attrs[prop.key].history.has_changes())
+        # Own version
+        model = type(obj)
+        if isinstance(obj, Versioned) or "last_modified" in state.mapper.columns:
+            bump_ids.setdefault(model, set()).add(state.mapper.primary_key_from_instance(obj)[0])
+            session.expire(obj, [attr for attr in ("version", "last_modified") if attr in state.mapper.column_attrs])
+    for model in set(bump_ids)|set(bump_conditions):
+        conditions = list(bump_conditions.get(model, ()))
+        ids = bump_ids.get(model)
+        if ids:
+            conditions.append(inspect(model).primary_key[0].in_(ids))
+        bump_versions(model, or_(*conditions))
+
+event.listen(Session, "before_flush", __track_versions)
+
+def entity_etag(obj, nested_user=False):
+    """
+    Get strong entity tag of an element's representation.
+
+    Args:
+        obj: Model instance.
+        nested_user: Nested fields designated by user request are serialized.
+            Versions of nested elements are not tracked, so no entity tag is available in this case.
+    Returns:
+        Entity tag, or None if not available.
+    """
+    if not isinstance(obj, Versioned):
+        return None
+    if nested_user and g.json_params.get("with"):
+        return None
+    return "%s-%s-%s" % (type(obj).__tablename__, "-".join(map(str, inspect(obj).identity)), obj.version)
+
+def counter(*sources):
+    """
+    Declare a denormalized counter column, holding the weighted amount of related elements.
+    Counters are kept current on ORM flushes; write paths bypassing the ORM must call "recount_counters".
+
+    Args:
+        sources: Names of collection relationships of the model to count, or tuples of name and weight.
+    Returns:
+        Counter column.
+    """
+    sources = tuple((source, 1) if isinstance(source, str) else source for source in sources)
+    return db.Column(db.Integer(), default=0, server_default="0", index=True, info={"counter_sources": sources})
+
+# Mappers with counter columns
+__counter_mappers = []
+# Relationship properties affecting counters; property to list of (column key, weight, counted key, owner side)
+__counted_props = {}
+
+def __find_counters(mapper, class_):
+    """ Remember mappers with counter columns. """
+    if any("counter_sources" in column.info for column in mapper.columns):
+        __counter_mappers.append(mapper)
+
+def __configure_counters():
+    """ Find counted relationships and their reverse relationships after all mappers are configured. """
+    __counted_props.clear()
+    for mapper in __counter_mappers:
+        for column in mapper.columns:
+            for name, weight in column.info.get("counter_sources", ()):
+                prop = mapper.relationships[name]
+                column_key = mapper.get_property_by_column(column).key
+                __counted_props.setdefault(prop, []).append((column_key, weight, prop.key, True))
+                for reverse_prop in prop._reverse_property:
+                    __counted_props.setdefault(reverse_prop, []).append((column_key, weight, prop.key, False))
+
+event.listen(Mapper, "mapper_configured", __find_counters)
+event.listen(Mapper, "after_configured", __configure_counters)
+
+def __counter_key(obj):
+    """ Get identity key of a persistent element, or the element itself if it is pending. """
+    return inspect(obj).key or obj
+
+def __related_owner_changes(state, prop, deleted):
+    """
+    Get changes of counter owners related to an element through the reverse of a counted relationship.
+
+    Args:
+        state: Instance state of the element.
+        prop: Reverse relationship property.
+        deleted: Whether the element is being deleted. Not supported for many-to-many relationships.
+    Returns:
+        A list of tuples with owner key and sign of the change.
+    """
+    # Many-to-many relationship
+    if prop.uselist:
+        history = state.attrs[prop.key].history
+        return [(__counter_key(owner), 1) for owner in history.added]+ \
+            [(__counter_key(owner), -1) for owner in history.deleted]
+    # Many-to-one relationship; previous owner is identified by foreign key, which is synchronized later in the flush
+    owner_model = prop.mapper.class_
+    fk_history = state.attrs[state.mapper.get_property_by_column(prop.local_remote_pairs[0][0]).key].history
+    prev_id = (fk_history.unchanged or fk_history.deleted or [None])[0]
+    if deleted:
+        owner = None
+    elif state.attrs[prop.key].history.has_changes():
+        owner = (state.attrs[prop.key].history.added or [None])[0]
+    else:
+        owner = (fk_history.added or fk_history.unchanged or [None])[0]
+        owner = None if owner==None else identity_key(owner_model, owner)
+    prev_owner = None if prev_id==None else identity_key(owner_model, prev_id)
+    if owner is not None and not isinstance(owner, tuple):
+        owner = __counter_key(owner)
+    if owner==prev_owner:
+        return []
+    return [(key, sign) for key, sign in ((prev_owner, -1), (owner, 1)) if key is not None]
+
+def __track_counters(session, flush_context, instances):
+    """
+    Update counter columns of elements whose counted relationships change in current flush.
+    Counters of persistent elements are increased by the database, so that concurrent changes are not lost.
+
+    Args:
+        session: SQLAlchemy session being flushed.
+        flush_context: Flush context.
+        instances: Unused.
+    """
+    if not __counted_props:
+        return
+    deleted_keys = {inspect(obj).key for obj in session.deleted}
+    # Changes as (owner, column key, weight, counted key, related element, sign); both sides may report a change
+    changes = set()
+    # Deleted elements of many-to-many relationships, whose owners are not loaded
+    removed = []
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        state = inspect(obj)
+        deleted = obj in session.deleted
+        for prop in state.mapper.relationships:
+            for column_key, weight, counted_key, owner_side in __counted_props.get(prop, ()):
+                # Counted relationship of counter owner
+                if owner_side:
+                    if deleted:
+                        continue
+                    history = state.attrs[prop.key].history
+                    for sign, related_objs in ((1, history.added), (-1, history.deleted)):
+                        for related_obj in related_objs:
+                            if prop.secondary is not None and __counter_key(related_obj) in deleted_keys:
+                                continue
+                            changes.add((__counter_key(obj), column_key, weight, counted_key, __counter_key(related_obj), sign))
+                # Reverse relationship of deleted many-to-many related element
+                elif deleted and prop.uselist:
+                    removed.append((prop, column_key, weight, state.identity[0]))
+                # Reverse relationship of related element
+                else:
+                    for owner, sign in __related_owner_changes(state, prop, deleted):
+                        changes.add((owner, column_key, weight, counted_key, __counter_key(obj), sign))
+    # Net change of each counter
+    deltas = OrderedDict()
+    for owner, column_key, weight, _, _, sign in changes:
+        if owner not in deleted_keys:
+            deltas[owner, column_key] = deltas.get((owner, column_key), 0)+weight*sign
+    for (owner, column_key), delta in deltas.items():
+        if not delta:
+            continue
+        # Pending element
+        if not isinstance(owner, tuple):
+            setattr(owner, column_key, (getattr(owner, column_key) or 0)+delta)
+            continue
+        model = owner[0]
+        column = getattr(model, column_key)
+        obj = session.identity_map.get(owner)
+        # Loaded element; updated with other changes of the element
+        if obj is not None:
+            setattr(obj, column_key, func.coalesce(column, 0)+delta)
+        # Element not loaded
+        else:
+            condition = inspect(model).primary_key[0]==owner[1][0]
+            session.execute(model.__table__.update().where(condition).values({
+                column.property.columns[0].name: func.coalesce(column, 0)+delta
+            }))
+            bump_versions(model, condition)
+    # Owners of deleted many-to-many related elements; versions are increased by version tracking
+    for prop, column_key, weight, related_id in removed:
+        model = prop.mapper.class_
+        column = getattr(model, column_key)
+        local_column, remote_column = __related_columns(prop)
+        session.execute(model.__table__.update().where(
+            inspect(model).primary_key[0].in_(select([remote_column]).where(local_column==related_id))
+        ).values({
+            column.property.columns[0].name: func.coalesce(column, 0)-weight
+        }))
+
+# Runs before version tracking, so that elements with changed counters get new versions
+event.listen(Session, "before_flush", __track_counters, insert=True)
+
+def recount_counters(conn, tables=None):
+    """
+    Recompute counter columns from related rows in bulk, with a single UPDATE statement per counter.
+    Only rows with wrong counters are updated, and their versions are increased.
+
+    Args:
+        conn: SQLAlchemy connection or session.
+        tables: Tables to repair, or None for all tables with counters.
+    Returns:
+        A dictionary with amount of repaired rows, keyed by "<table>.<column>".
+    """
+    configure_mappers()
+    result = OrderedDict()
+    for mapper in __counter_mappers:
+        model = mapper.class_
+        table = mapper.local_table
+        if tables!=None and table not in tables:
+            continue
+        for column in mapper.columns:
+            sources = column.info.get("counter_sources")
+            if not sources:
+                continue
+            # Correlated count of related rows of each source
+            value = None
+            for name, weight in sources:
+                local_column, remote_column = mapper.relationships[name].local_remote_pairs[0]
+                count = select([func.count()]).select_from(remote_column.table).where(remote_column==local_column).as_scalar()
+                count = count if weight==1 else count*weight
+                value = count if value is None else value+count
+            values = {column.name: value}
+            if issubclass(model, Versioned):
+                values["version"] = table.c.version+1
+            rv = conn.execute(table.update().where(column.is_distinct_from(value)).values(values))
+            result["%s.%s" % (table.name, column.name)] = rv.rowcount
+    return result
+
+def __adjust_link_counters(prop, obj_ids, related_id, sign):
+    """
+    Update counters and versions of elements whose many-to-many links changed outside of the ORM.
+
+    Args:
+        prop: Many-to-many relationship property.
+        obj_ids: Primary keys of elements on the relationship side with changed links.
+        related_id: Primary key of the related element.
+        sign: 1 for added links, -1 for removed links.
+    """
+    model, related_model = prop.parent.class_, prop.mapper.class_
+    condition = inspect(model).primary_key[0].in_(obj_ids)
+    related_condition = inspect(related_model).primary_key[0]==related_id
+    # Counters of both sides
+    for owner_prop, owner_condition, n_links in itertools.chain(
+        [(prop, condition, 1)],
+        [(reverse_prop, related_condition, len(obj_ids)) for reverse_prop in prop._reverse_property]
+    ):
+        owner_model = owner_prop.parent.class_
+        for column_key, weight, _, owner_side in __counted_props.get(owner_prop, ()):
+            if owner_side:
+                column = getattr(owner_model, column_key)
+                db.session.execute(owner_model.__table__.update().where(owner_condition).values({
+                    column.property.columns[0].name: func.coalesce(column, 0)+weight*sign*n_links
+                }))
+    bump_versions(model, condition)
+    bump_versions(related_model, related_condition)
+
+def set_links(prop, obj_ids, related_id, linked):
+    """
+    Add or remove links between elements and a related element of a many-to-many relationship,
+    with one atomic statement on the helper table. Existing links are kept and missing links are ignored.
+    Counters and versions of affected elements are updated.
+
+    Args:
+        prop: Many-to-many relationship property.
+        obj_ids: Primary keys of elements on the relationship side.
+        related_id: Primary key of the related element.
+        linked: Whether elements should be linked to the related element.
+    Returns:
+        Primary keys of elements whose link status changed.
+    """
+    configure_mappers()
+    table = prop.secondary
+    local_column, related_column = __related_columns(prop)
+    obj_ids = list(OrderedDict.fromkeys(obj_ids))
+    if not obj_ids:
+        return []
+    dialect = db.engine.dialect.name
+    # Add links
+    if linked:
+        rows = [{local_column.name: obj_id, related_column.name: related_id} for obj_id in obj_ids]
+        # PostgreSQL; "INSERT ... ON CONFLICT DO NOTHING RETURNING"
+        if dialect=="postgresql":
+            statement = pg_insert(table).values(rows).on_conflict_do_nothing().returning(local_column)
+            changed_ids = [row[0] for row in db.session.execute(statement)]
+        # SQLite and MySQL; conflicting rows are ignored one by one
+        else:
+            statement = table.insert().prefix_with("OR IGNORE" if dialect=="sqlite" else "IGNORE")
+            changed_ids = [row[local_column.name] for row in rows if db.session.execute(statement, row).rowcount]
+    # Remove links
+    else:
+        condition = and_(related_column==related_id, local_column.in_(obj_ids))
+        # PostgreSQL; "DELETE ... RETURNING"
+        if dialect=="postgresql":
+            changed_ids = [row[0] for row in db.session.execute(table.delete().where(condition).returning(local_column))]
+        # Other databases; rows are deleted one by one
+        else:
+            changed_ids = [obj_id for obj_id in obj_ids if db.session.execute(table.delete().where(
+                and_(related_column==related_id, local_column==obj_id)
+            )).rowcount]
+    if changed_ids:
+        __adjust_link_counters(prop, changed_ids, related_id, 1 if linked else -1)
+    return changed_ids
+
+def toggle_link(prop, obj_id, related_id):
+    """
+    Toggle link between an element and a related element of a many-to-many relationship.
+    The link is removed if it exists, and added otherwise, without loading other links of the relationship.
+
+    Args:
+        prop: Many-to-many relationship property.
+        obj_id: Primary key of the element on the relationship side.
+        related_id: Primary key of the related element.
+    Returns:
+        Whether the elements are linked afterwards.
+    """
+    if set_links(prop, [obj_id], related_id, False):
+        return False
+    set_links(prop, [obj_id], related_id, True)
+    return True
+
 def parse_param(schema=None, schema_class=None, target="params", init_args={}, load_args={}):
     """
     Decorator for checking and parsing request parameters.
@@ -268,7 +1444,7 @@ __comp_filters = {
     "lt": operator.lt,
     "lte": operator.le,
     "contains": ColumnOperators.contains,
-    "icontains": lambda column, text: column.ilike("%"+text+"%")
+    "icontains": lambda column, text: column.ilike(literal("%")+text+"%")
 }
 
 # Logical filter
@@ -287,6 +1463,7 @@ def __build_filter_exp(query, model):
             Subsequent elements in this array are the parameters of this filter.
             Parameters can be a single value or another query array.
             e.g. ["and", ["eq", "field1", true], ["or", ["ne", "field2", "hi"], ["gte", "field3.nested", 10]]]
+            Full-text search over searchable fields of the model is done with ["search", "text"].
         model: Data model on which fields in the filters can be found.
     Returns:
         A corresponding SQLAlchemy filter expression.
@@ -298,6 +1475,12 @@ def __build_filter_exp(query, model):
     if comp_builder:
         field = getattr_keypath(model, query[1])
         return comp_builder(field, query[2])
+    # Full-text search filter
+    if query[0]=="search":
+        value = query[1]
+        if not isinstance(value, BindParameter):
+            value = __search_value(value)
+        return __search_exp(model, value)
     # Logical filters
     logical_builder = __logical_filters.get(query[0])
     if logical_builder:
@@ -306,6 +1489,38 @@ def __build_filter_exp(query, model):
     # Unknown filter
     raise APIError(400, "unknown_query_oper", operator=query[0])
 
+def __search_param(query):
+    """
+    Find search text of the first full-text search filter outside of "not" filters in user-provided query.
+
+    Args:
+        query: User-provided query. See "__build_filter_exp" for format.
+    Returns:
+        Search text or bind parameter, or None if there is no such filter.
+    """
+    if not query:
+        return None
+    if query[0]=="search":
+        return query[1]
+    if query[0] in ("and", "or"):
+        for nested_query in query[1:]:
+            value = __search_param(nested_query)
+            if value is not None:
+                return value
+    return None
+
+def __rank_ordered(params):
+    """
+    Check if results are ordered by full-text search rank.
+    Results of full-text search are ranked unless ordering is explicitly requested.
+
+    Args:
+        params: User-provided filter params.
+    Returns:
+        Whether results are ordered by search rank.
+    """
+    return not params.get("order") and __search_param(params.get("query")) is not None
+
 def __filter_handler(query_set, model, params):
     """
     Handle user-provided filtering requests.
@@ -325,6 +1540,25 @@ def __filter_handler(query_set, model, params):
     else:
         return query_set
 
+def __ordering_keypaths(model, params):
+    """
+    Get ordering field key paths and directions of user-provided ordering requests.
+    When paginated, primary key is appended to make the ordering total.
+
+    Args:
+        model: Data model from which given query set is generated.
+        params: User-provided filter params.
+    Returns:
+        A list of (field key path, ascending) tuples.
+    """
+    orders = [(field_keypath, bool(order)) for field_keypath, order in params.get("order") or []]
+    # Paginated; order by primary key at last
+    if params.get("limit") is not None or params.get("after") is not None:
+        pk_name = inspect(model).primary_key[0].name
+        if pk_name not in (field_keypath for field_keypath, _ in orders):
+            orders.append((pk_name, True))
+    return orders
+
 def __ordering_handler(query_set, model, params):
     """
     Handle ordering requests.
@@ -332,22 +1566,102 @@ def __ordering_handler(query_set, model, params):
     Args:
         query_set: SQLAlchemy query set to be ordered.
         model: Data model from which given query set is generated.
-        params: User-provided filter params, with format {"order": {"field1": <bool>, ...}, ...}.
+        params: User-provided filter params, with format {"order": [["field1", <bool>], ...], ...}.
             True indicates ascending order, while False indicates descending order.
     Returns:
         A query set with user-provided ordering applied.
     """
-    orders = params.get("order")
-    if not orders:
+    orders = __ordering_keypaths(model, params)
+    sqla_params = []
+    # Full-text search rank
+    if __rank_ordered(params):
+        value = __search_param(params["query"])
+        rank = __search_rank(model, value if isinstance(value, BindParameter) else __search_value(value))
+        if rank is not None:
+            sqla_params.append(rank)
+    if not orders and not sqla_params:
         return query_set
     # Ordering
-    sqla_params = []
     for (field_keypath, order) in orders:
         field = getattr_keypath(model, field_keypath)
         param = field.asc() if order else field.desc()
         sqla_params.append(param)
     return query_set.order_by(*sqla_params)
 
+def __encode_cursor_value(value):
+    """
+    Encode ordering key value for pagination cursor.
+
+    Args:
+        value: Ordering key value.
+    Returns:
+        JSON serializable value.
+    """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def __decode_cursor_value(field, value):
+    """
+    Decode ordering key value from pagination cursor.
+
+    Args:
+        field: Ordering field.
+        value: JSON value in pagination cursor.
+    Returns:
+        Ordering key value.
+    """
+    if value==None:
+        return value
+    try:
+        python_type = field.type.python_type
+    except (AttributeError, NotImplementedError):
+        return value
+    if python_type==datetime:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f" if "." in value else "%Y-%m-%dT%H:%M:%S")
+    elif python_type==date:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    return value
+
+def encode_cursor(values):
+    """
+    Encode ordering key values into an opaque pagination cursor.
+
+    >>> decode_cursor(encode_cursor([1, "a"]))
+    [1, 'a']
+
+    Args:
+        values: Ordering key values.
+    Returns:
+        Pagination cursor.
+    """
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Decode ordering key values from a pagination cursor.
+
+    Args:
+        cursor: Pagination cursor.
+    Returns:
+        Ordering key values.
+    Raises:
+        APIError: When the cursor is malformed.
+    """
+    with map_error(APIError(400, "bad_cursor")):
+        values = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+        assert isinstance(values, list)
+    return values
+
+def __nulls_last():
+    """
+    Check if null values are ordered after non-null values in ascending order by current database.
+
+    Returns:
+        Whether null values are larger than non-null values in ordering.
+    """
+    return db.engine.dialect.name in ("postgresql", "oracle")
+
 def __pagination_handler(query_set, model, params):
     """
     Handle user-provided pagination requests.
@@ -355,42 +1669,365 @@ def __pagination_handler(query_set, model, params):
     Args:
         query_set: SQLAlchemy query set to be paginated.
         model: Data model from which given query set is generated.
-        params: User-provided filter params, with format {"offset": <int>, "limit": <int>, ...}.
+        params: User-provided filter params, with format {"offset": <int>, "limit": <int>, "after": <cursor>, ...}.
+            "after" is the "next_cursor" of previous page, which encodes ordering key values of the last row.
+            It is decoded into ordering key values by "__parametrize_params", where null values are kept as None.
     Returns:
         A query set with user-provided pagination applied.
     """
+    # Cursor
+    values = params.get("after")
+    if values is not None:
+        orders = __ordering_keypaths(model, params)
+        fields = [getattr_keypath(model, field_keypath) for field_keypath, _ in orders]
+        nulls_last = __nulls_last()
+        # Rows after the cursor in lexicographical order of ordering keys
+        after_exps = []
+        for i, (field, (_, order)) in enumerate(zip(fields, orders)):
+            equal_exps = [
+                prev_field.is_(None) if value is None else prev_field==value
+                for prev_field, value in zip(fields[:i], values[:i])
+            ]
+            # Whether null values follow non-null values in this ordering
+            nulls_after = order==nulls_last
+            if values[i] is None:
+                if not nulls_after:
+                    after_exps.append(and_(*equal_exps, field.isnot(None)))
+            else:
+                exp = field>values[i] if order else field<values[i]
+                after_exps.append(and_(*equal_exps, or_(exp, field.is_(None)) if nulls_after else exp))
+        # Leading range condition for index range scan
+        if values[0] is None:
+            first_exps = [fields[0].is_(None)] if orders[0][1]==nulls_last else []
+        else:
+            first_exp = fields[0]>=values[0] if orders[0][1] else fields[0]<=values[0]
+            first_exps = [or_(first_exp, fields[0].is_(None)) if orders[0][1]==nulls_last else first_exp]
+        query_set = query_set.filter(*first_exps, or_(*after_exps))
     # Offset
     offset = params.get("offset")
-    if offset!=None:
+    if offset is not None:
         query_set = query_set.offset(offset)
     # Limit
     limit = params.get("limit")
-    if limit!=None:
+    if limit is not None:
         query_set = query_set.limit(limit)
     return query_set
 
 # User filter handlers
 __user_filters = [
     __filter_handler,
-    __pagination_handler,
-    __ordering_handler
+    __ordering_handler,
+    __pagination_handler
 ]
 
-def filter_user(query_set, model):
+def pagination_info(objs, model):
     """
-    Apply user-provided data filters to given query set.
+    Get pagination information of a page retrieved with user-provided filters.
+
+    Args:
+        objs: Model instances in current page.
+        model: Data model of the instances.
+    Returns:
+        {"next_cursor": <cursor>} if the page is limited, or an empty dictionary otherwise.
+        The cursor is null when there are no more rows. Pages ordered by search rank have no cursor,
+        and are paginated with offset instead.
+    """
+    params = g.json_params
+    limit = params.get("limit")
+    # Cursor is not available for pages ordered by search rank
+    if limit==None or __rank_ordered(params):
+        return {}
+    if not objs or len(objs)<limit:
+        return {"next_cursor": None}
+    last_obj = objs[-1]
+    values = [
+        __encode_cursor_value(getattr_keypath(last_obj, field_keypath))
+        for field_keypath, _ in __ordering_keypaths(model, params)
+    ]
+    return {"next_cursor": encode_cursor(values)}
+
+def __parametrize_query(query, model, values):
+    """
+    Recursively replace literals in user-provided query with bind parameters.
+
+    Args:
+        query: User-provided query. See "__build_filter_exp" for format.
+        model: Data model on which fields in the filters can be found.
+        values: Bind parameter values to be updated.
+    Returns:
+        A tuple with the query shape and the query with literals replaced.
+    Raises:
+        APIError: When unknown query operator occurs.
+    """
+    oper = query[0]
+    # Comparison filters
+    if oper in __comp_filters:
+        field_keypath, value = query[1], query[2]
+        # Null comparison is kept as is
+        if value==None:
+            return (oper, field_keypath, None), query
+        name = "q%d" % len(values)
+        values[name] = value
+        return (oper, field_keypath), [oper, field_keypath, bindparam(name)]
+    # Full-text search filter
+    elif oper=="search":
+        name = "q%d" % len(values)
+        values[name] = __search_value(query[1])
+        return (oper,), [oper, bindparam(name)]
+    # Logical filters
+    elif oper in __logical_filters:
+        shapes, nested_queries = [oper], [oper]
+        for nested_query in query[1:]:
+            shape, nested_query = __parametrize_query(nested_query, model, values)
+            shapes.append(shape)
+            nested_queries.append(nested_query)
+        return tuple(shapes), nested_queries
+    # Unknown filter
+    raise APIError(400, "unknown_query_oper", operator=oper)
+
+def __parametrize_params(model, params):
+    """
+    Replace literals in user-provided filter params with bind parameters.
+
+    Args:
+        model: Data model from which given query set is generated.
+        params: User-provided filter params.
+    Returns:
+        A tuple with the params shape, the params with literals replaced and bind parameter values.
+        Filter params with the same shape produce the same SQL statement.
+    """
+    shape, template, values = [], {}, {}
+    # Filter
+    query = params.get("query")
+    if query:
+        query_shape, template["query"] = __parametrize_query(query, model, values)
+        shape.append(("query", query_shape))
+    # Ordering
+    orders = params.get("order")
+    if orders:
+        template["order"] = [(field_keypath, bool(order)) for field_keypath, order in orders]
+        shape.append(("order", tuple(template["order"])))
+    # Pagination
+    with map_error(APIError(400, "bad_json_params")):
+        for key in ("offset", "limit"):
+            if params.get(key)!=None:
+                values[key] = int(params[key])
+                template[key] = bindparam(key)
+                shape.append(key)
+    # Cursor
+    cursor = params.get("after")
+    if cursor!=None:
+        if __rank_ordered(params):
+            raise APIError(400, "bad_cursor")
+        cursor_values = decode_cursor(cursor)
+        orders = __ordering_keypaths(model, params)
+        if len(cursor_values)!=len(orders):
+            raise APIError(400, "bad_cursor")
+        # Null values are kept as is
+        template["after"] = []
+        for i, ((field_keypath, _), value) in enumerate(zip(orders, cursor_values)):
+            if value==None:
+                template["after"].append(None)
+                continue
+            values["c%d" % i] = __decode_cursor_value(getattr_keypath(model, field_keypath), value)
+            template["after"].append(bindparam("c%d" % i))
+        shape.append(("after", tuple(value==None for value in cursor_values)))
+    return tuple(shape), template, values
+
+def __apply_user_filters(query_set, model, template):
+    """
+    Apply user filter handlers with parametrized filter params.
 
     Args:
         query_set: SQLAlchemy query set to be filtered.
         model: Data model from which given query set is generated.
+        template: Filter params with literals replaced by bind parameters.
     Returns:
         A query set with user-provided filters, ordering and pagination applied.
     """
-    # Handle user filters
     for handler in __user_filters:
-        query_set = handler(query_set, model, g.json_params)
+        query_set = handler(query_set, model, template)
     return query_set
 
+def filter_user(query_set, model):
+    """
+    Apply user-provided data filters to given query set.
+
+    Args:
+        query_set: SQLAlchemy query set to be filtered.
+        model: Data model from which given query set is generated.
+    Returns:
+        A query set with user-provided filters, ordering and pagination applied.
+    """
+    _, template, values = __parametrize_params(model, g.json_params)
+    return __apply_user_filters(query_set, model, template).params(**values)
+
+# Baked user queries
+__filter_bakery = baked.bakery(size=FILTER_CACHE_SIZE)
+__filter_queries = OrderedDict()
+__filter_queries_lock = Lock()
+__filter_cache_stats = {"hits": 0, "misses": 0}
+
+def __bake_user_query(key, build):
+    """
+    Get cached user query, or bake a new one.
+
+    Args:
+        key: Cache key, made of data model and filter params shape.
+        build: Function building the baked query.
+    Returns:
+        A SQLAlchemy baked query.
+    """
+    with __filter_queries_lock:
+        baked_query = __filter_queries.get(key)
+        if baked_query:
+            __filter_queries.move_to_end(key)
+            __filter_cache_stats["hits"] += 1
+            return baked_query
+        __filter_cache_stats["misses"] += 1
+    baked_query = build()
+    with __filter_queries_lock:
+        __filter_queries[key] = baked_query
+        if len(__filter_queries)>FILTER_CACHE_SIZE:
+            __filter_queries.popitem(last=False)
+    return baked_query
+
+def query_user(model, params=None):
+    """
+    Query all elements of a model with user-provided data filters.
+    The query is cached per model and filter params shape, with literals sent as bind parameters,
+    so repeated filter shapes skip building filter expressions and compiling SQL statements.
+
+    Args:
+        model: Data model to query.
+        params: Filter params. Defaults to user-provided filter params.
+    Returns:
+        A SQLAlchemy baked query result with user-provided filters, ordering and pagination applied.
+    """
+    shape, template, values = __parametrize_params(model, g.json_params if params==None else params)
+    def build():
+        baked_query = __filter_bakery(lambda session: session.query(model), model, shape)
+        baked_query += lambda query_set: __apply_user_filters(query_set, model, template)
+        return baked_query
+    return __bake_user_query((model, shape), build)(db.session()).params(**values)
+
+def query_user_chunks(model, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Query all elements of a model with user-provided data filters, in chunks of at most "chunk_size" rows.
+    Each chunk is a separate query continuing after ordering key values of the previous chunk,
+    so only one chunk is held in memory regardless of server-side cursor support of the database driver.
+    Chunks of results ordered by search rank continue with offset instead.
+
+    Args:
+        model: Data model to query.
+        chunk_size: Maximum amount of rows in each chunk.
+    Returns:
+        A generator of lists of model instances.
+    Raises:
+        APIError: When user-provided filter params are malformed.
+    """
+    params = dict(g.json_params)
+    params.pop("stream", None)
+    with map_error(APIError(400, "bad_json_params")):
+        remaining = int(params.pop("limit")) if params.get("limit")!=None else None
+        offset = int(params.get("offset") or 0)
+    orders = __ordering_keypaths(model, dict(params, limit=chunk_size))
+    keyset = not __rank_ordered(params)
+    while remaining==None or remaining>0:
+        limit = chunk_size if remaining==None else min(chunk_size, remaining)
+        chunk = query_user(model, dict(params, limit=limit)).all()
+        if chunk:
+            yield chunk
+        if len(chunk)<limit:
+            return
+        if remaining!=None:
+            remaining -= len(chunk)
+        # Continue after ordering key values of last row
+        if keyset:
+            offset = 0
+            params["after"] = encode_cursor([
+                __encode_cursor_value(getattr_keypath(chunk[-1], field_keypath)) for field_keypath, _ in orders
+            ])
+        # Continue with offset
+        else:
+            offset += len(chunk)
+        params["offset"] = offset or None
+
+def __estimate_count(model, template, values):
+    """
+    Estimate amount of filtered elements from PostgreSQL planner statistics.
+
+    Args:
+        model: Data model to query.
+        template: Filter params with literals replaced by bind parameters.
+        values: Bind parameter values.
+    Returns:
+        Estimated amount of elements, or None if no estimation is available.
+    """
+    if db.engine.dialect.name!="postgresql":
+        return None
+    # Unfiltered; table statistics
+    if not template.get("query"):
+        estimate = db.session.execute(
+            "SELECT reltuples FROM pg_class WHERE oid = CAST(:table_name AS regclass)",
+            {"table_name": model.__tablename__}
+        ).scalar()
+    # Filtered; planner row estimate
+    else:
+        query_set = __filter_handler(db.session.query(inspect(model).primary_key[0]), model, template)
+        statement = query_set.statement.compile(dialect=db.engine.dialect)
+        # Statement is compiled in paramstyle of database driver, so it is executed without conversion
+        params = statement.construct_params(values)
+        if statement.positional:
+            params = tuple(params[name] for name in statement.positiontup)
+        plan = db.session.connection().execute("EXPLAIN (FORMAT JSON) "+str(statement), params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = plan[0]["Plan"]["Plan Rows"]
+    # Tables never analyzed have no statistics
+    return int(estimate) if estimate and estimate>0 else None
+
+def count_user(model):
+    """
+    Count elements of a model matching user-provided filters, if requested by "count" param.
+    Ordering and pagination are not applied. With "approximate" count mode, PostgreSQL planner
+    estimates are used instead, unless unavailable or below "APPROX_COUNT_MIN".
+
+    Args:
+        model: Data model to query.
+    Returns:
+        A dictionary with element count and whether it is approximate, or an empty dictionary
+        if count is not requested.
+    """
+    mode = g.json_params.get("count")
+    if not mode:
+        return {}
+    if mode not in (True, "exact", "approximate"):
+        raise APIError(400, "bad_json_params")
+    shape, template, values = __parametrize_params(model, {"query": g.json_params.get("query")})
+    # Approximate count
+    if mode=="approximate":
+        estimate = __estimate_count(model, template, values)
+        if estimate!=None and estimate>=APPROX_COUNT_MIN:
+            return {"count": estimate, "count_approximate": True}
+    # Exact count
+    def build():
+        baked_query = __filter_bakery(lambda session: session.query(func.count(inspect(model).primary_key[0])), model, shape)
+        baked_query += lambda query_set: __filter_handler(query_set, model, template)
+        return baked_query
+    count = __bake_user_query((model, "count", shape), build)(db.session()).params(**values).one()[0]
+    return {"count": count, "count_approximate": False}
+
+def filter_cache_stats():
+    """
+    Get statistics of cached user queries.
+
+    Returns:
+        A dictionary with cache size, hit count and miss count.
+    """
+    with __filter_queries_lock:
+        return dict(__filter_cache_stats, size=len(__filter_queries))
+
 class FileField(fields.Field):
     """ Schema field for FileDepot file. """
     def _serialize(self, value, attr, obj):
@@ -399,19 +2036,44 @@ class FileField(fields.Field):
         return value
 
 def get_data():
-    """ Get request data from request object. """
-    # JSON
-    if request.is_json:
-        return request.get_json()
-    req_data = {}
-    # Form
-    for key, value in request.form.items():
-        req_data[key] = json.loads(value)
-    # File
-    for key, value in request.files.items():
-        req_data[key] = value
+    """
+    Get request data from request object.
+    Uploaded files are streamed to temporary files while parsing, and limited to "UPLOAD_MAX_SIZE".
+
+    Returns:
+        Request data.
+    Raises:
+        APIError: When request body is larger than "UPLOAD_MAX_SIZE".
+    """
+    with map_error({RequestEntityTooLarge: APIError(413, "upload_too_large", max_size=UPLOAD_MAX_SIZE)}):
+        # JSON
+        if request.is_json:
+            return request.get_json()
+        req_data = {}
+        # Form
+        for key, value in request.form.items():
+            req_data[key] = json.loads(value)
+        # File
+        for key, value in request.files.items():
+            req_data[key] = value
     return req_data
 
+def get_bulk_data():
+    """
+    Get a list of items from request data for bulk operations.
+
+    Returns:
+        A list of item data.
+    Raises:
+        APIError: When request data is not a list of objects, or has more than "BULK_MAX_SIZE" items.
+    """
+    items = get_data()
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise APIError(400, "bad_bulk_data")
+    if len(items)>BULK_MAX_SIZE:
+        raise APIError(400, "bulk_too_large", max_size=BULK_MAX_SIZE)
+    return items
+
 unique_msg_rx = re.compile(r"\((\w+)\)=\((\w+)\)")
 
 def handle_prog_error(e):
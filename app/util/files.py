@@ -0,0 +1,328 @@
+""" Content-addressed storage and serving of stored files. """
+import errno, json, os, uuid
+from calendar import timegm
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from depot.io import utils
+from depot.io.local import LocalFileStorage, _check_file_id, _metadata_path, _file_path
+from depot.manager import DepotManager
+from depot.middleware import DepotMiddleware, FileServeApp
+from depot.utils import make_content_disposition
+from werkzeug.http import parse_range_header, parse_if_range_header, parse_etags, parse_date, http_date
+
+from app.config import DATA_ROOT, UPLOAD_ROOT, THUMBNAIL_SIZES, THUMBNAIL_FORMATS
+from app.util.core import APIError
+
+# Size of blocks read when serving files by the application
+FILE_BLOCK_SIZE = 256*1024
+# Size of blocks read when hashing and storing files
+STORE_BLOCK_SIZE = 64*1024
+
+class ContentAddressedStorage(LocalFileStorage):
+    """
+    Local file storage keeping a single copy of each distinct content.
+    Contents are hashed with SHA-256 while being stored, and kept as blobs named by their digests.
+    Stored files are hard links to blobs, so that duplicates take neither disk space nor page cache,
+    and the link count of a blob is its reference count. Blobs are removed with their last stored file,
+    which happens when referencing rows are deleted or their files replaced.
+    """
+    def __blob_path(self, digest):
+        """ Get path of the blob of a digest. """
+        return os.path.join(self.storage_path, "sha256", digest[:2], digest)
+    def __store(self, content, file_path):
+        """
+        Store content at a path, linking to the existing blob of the same digest if there is one.
+        Finished uploads under "UPLOAD_ROOT" are hashed and linked without copying; other contents,
+        including other local files that may still change, are hashed while being written.
+
+        Args:
+            content: Bytes or file object.
+            file_path: Path of the stored file.
+        Returns:
+            Digest of content.
+        """
+        blob_dir = os.path.join(self.storage_path, "sha256")
+        os.makedirs(blob_dir, exist_ok=True)
+        digest = sha256()
+        source_path = getattr(content, "name", None)
+        temp_path = None
+        # Finished upload; hash without writing
+        if isinstance(source_path, str) and os.path.isabs(source_path) and os.path.isfile(source_path) \
+            and os.path.dirname(os.path.realpath(source_path))==os.path.realpath(UPLOAD_ROOT):
+            with open(source_path, "rb") as f:
+                for block in iter(lambda: f.read(STORE_BLOCK_SIZE), b""):
+                    digest.update(block)
+        # Other content; hash while writing to a temporary file
+        else:
+            with NamedTemporaryFile(dir=blob_dir, delete=False) as f:
+                temp_path = source_path = f.name
+                blocks = [content] if isinstance(content, bytes) else iter(lambda: content.read(STORE_BLOCK_SIZE), b"")
+                for block in blocks:
+                    digest.update(block)
+                    f.write(block)
+        digest = digest.hexdigest()
+        blob_path = self.__blob_path(digest)
+        try:
+            # Duplicate content
+            try:
+                os.link(blob_path, file_path)
+                return digest
+            # New content, or blob removed with its last stored file meanwhile
+            except FileNotFoundError:
+                pass
+            try:
+                os.link(source_path, file_path)
+            # Different file system
+            except OSError as e:
+                if e.errno!=errno.EXDEV:
+                    raise
+                with open(source_path, "rb") as src, open(file_path, "wb") as dst:
+                    for block in iter(lambda: src.read(STORE_BLOCK_SIZE), b""):
+                        dst.write(block)
+            # Register blob; a concurrently stored blob of the same content wins
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                os.link(file_path, blob_path)
+            except FileExistsError:
+                pass
+            return digest
+        finally:
+            if temp_path:
+                os.unlink(temp_path)
+    def __save_file(self, file_id, content, filename, content_type=None):
+        """ Save content and metadata as a stored file. """
+        local_path = os.path.join(self.storage_path, file_id)
+        os.makedirs(local_path)
+        file_path = _file_path(local_path)
+        digest = self.__store(content, file_path)
+        with open(os.path.join(local_path, "sha256"), "w") as f:
+            f.write(digest)
+        with open(_metadata_path(local_path), "w") as f:
+            json.dump({
+                "filename": filename,
+                "content_type": content_type,
+                "content_length": os.path.getsize(file_path),
+                "last_modified": utils.timestamp()
+            }, f)
+    def create(self, content, filename=None, content_type=None):
+        """ Store a new file. """
+        file_id = str(uuid.uuid1())
+        content, filename, content_type = self.fileinfo(content, filename, content_type)
+        self.__save_file(file_id, content, filename, content_type)
+        return file_id
+    def replace(self, file_or_id, content, filename=None, content_type=None):
+        """ Replace content of an existing file. """
+        file_id = self.fileid(file_or_id)
+        _check_file_id(file_id)
+        if not self.exists(file_id):
+            raise IOError("File %s not existing" % file_or_id)
+        content, filename, content_type = self.fileinfo(content, filename, content_type, lambda: self.get(file_id))
+        self.delete(file_id)
+        self.__save_file(file_id, content, filename, content_type)
+        return file_id
+    def delete(self, file_or_id):
+        """ Delete a file, and its blob if no other file references it. """
+        file_id = self.fileid(file_or_id)
+        _check_file_id(file_id)
+        try:
+            with open(os.path.join(self.storage_path, file_id, "sha256")) as f:
+                blob_path = self.__blob_path(f.read().strip())
+        # Files stored before content addressing
+        except FileNotFoundError:
+            blob_path = None
+        super(ContentAddressedStorage, self).delete(file_id)
+        if blob_path:
+            try:
+                if os.stat(blob_path).st_nlink<=1:
+                    os.unlink(blob_path)
+            except FileNotFoundError:
+                pass
+
+class RangeFileIter(object):
+    """ Iterator over a byte range of a file, read in fixed-size blocks. """
+    def __init__(self, fileobj, length, block_size=FILE_BLOCK_SIZE):
+        """
+        Constructor.
+
+        Args:
+            fileobj: File object positioned at the start of the range.
+            length: Length of the range.
+            block_size: Size of blocks.
+        """
+        self.fileobj = fileobj
+        self.remaining = length
+        self.block_size = block_size
+    def __iter__(self):
+        return self
+    def __next__(self):
+        if self.remaining<=0:
+            raise StopIteration
+        block = self.fileobj.read(min(self.block_size, self.remaining))
+        if not block:
+            raise StopIteration
+        self.remaining -= len(block)
+        return block
+    def close(self):
+        self.fileobj.close()
+
+class RangeFileServeApp(FileServeApp):
+    """ Stored file WSGI application with range requests, revalidation and sendfile offload. """
+    def __init__(self, storedfile, cache_max_age, offload="", accel_prefix=""):
+        """
+        Constructor.
+
+        Args:
+            storedfile: Depot stored file.
+            cache_max_age: Cache max age of the file. (In seconds)
+            offload: Offload mode of file bodies; "x-accel-redirect", "x-sendfile" or empty.
+            accel_prefix: Internal front proxy location of data root for "X-Accel-Redirect".
+        """
+        super(RangeFileServeApp, self).__init__(storedfile, cache_max_age)
+        self.last_modified = self.last_modified.replace(microsecond=0)
+        self.offload = offload
+        self.accel_prefix = accel_prefix
+        # Path of local files
+        self.local_path = getattr(storedfile, "_file_path", None)
+    def generate_etag(self):
+        """ Strong entity tag; stored files are never modified in place. """
+        return '"%s-%d-%d"' % (self.file.file_id, timegm(self.last_modified.utctimetuple()), self.content_length)
+    def not_modified(self, environ, etag):
+        """ Check conditional request headers; "If-None-Match" takes precedence over "If-Modified-Since". """
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match:
+            return parse_etags(if_none_match).contains_weak(etag.strip('"'))
+        modified_since = parse_date(environ.get("HTTP_IF_MODIFIED_SINCE"))
+        return modified_since!=None and self.last_modified<=modified_since
+    def range_applies(self, environ, etag):
+        """ Check "If-Range" header; a partial response is only sent for the current representation. """
+        if_range = environ.get("HTTP_IF_RANGE")
+        if not if_range:
+            return True
+        if_range = parse_if_range_header(if_range)
+        if if_range.etag:
+            return if_range.etag==etag.strip('"')
+        return if_range.date!=None and if_range.date==self.last_modified
+    def __call__(self, environ, start_response):
+        """ Serve the file. """
+        etag = self.generate_etag()
+        headers = [
+            ("ETag", etag),
+            ("Last-Modified", http_date(self.last_modified)),
+            ("Cache-Control", "max-age=%d, public" % self.cache_expires),
+            ("Accept-Ranges", "bytes")
+        ]
+        # Revalidation
+        if self.not_modified(environ, etag):
+            self.file.close()
+            start_response("304 Not Modified", headers)
+            return []
+        headers += [
+            ("Content-Type", str(self.content_type)),
+            ("Content-Disposition", make_content_disposition("inline", self.filename))
+        ]
+        # Offload to front proxy, which handles ranges by itself
+        if self.offload and self.local_path:
+            self.file.close()
+            if self.offload=="x-accel-redirect":
+                relative_path = os.path.relpath(self.local_path, DATA_ROOT)
+                headers.append(("X-Accel-Redirect", "%s/%s" % (self.accel_prefix.rstrip("/"), relative_path)))
+            else:
+                headers.append(("X-Sendfile", self.local_path))
+            start_response("200 OK", headers)
+            return []
+        # Byte range
+        start, stop, status = 0, self.content_length, "200 OK"
+        byte_range = parse_range_header(environ.get("HTTP_RANGE"))
+        if byte_range and byte_range.units=="bytes" and len(byte_range.ranges)==1 and self.range_applies(environ, etag):
+            bounds = byte_range.range_for_length(self.content_length)
+            # Unsatisfiable range
+            if bounds==None:
+                self.file.close()
+                start_response("416 Range Not Satisfiable", headers+[("Content-Range", "bytes */%d" % self.content_length)])
+                return []
+            start, stop = bounds
+            status = "206 Partial Content"
+            headers.append(("Content-Range", "bytes %d-%d/%d" % (start, stop-1, self.content_length)))
+        headers.append(("Content-Length", str(stop-start)))
+        start_response(status, headers)
+        if environ["REQUEST_METHOD"]=="HEAD":
+            self.file.close()
+            return []
+        # Local file; complete files are sent with file wrapper of WSGI server, which can use "sendfile"
+        if self.local_path:
+            self.file.close()
+            fileobj = open(self.local_path, "rb")
+            fileobj.seek(start)
+            file_wrapper = environ.get("wsgi.file_wrapper")
+            if file_wrapper and stop-start==self.content_length:
+                return file_wrapper(fileobj, FILE_BLOCK_SIZE)
+            return RangeFileIter(fileobj, stop-start)
+        # Other storages; skip to the start of the range
+        remaining = start
+        while remaining>0:
+            block = self.file.read(min(FILE_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+        return RangeFileIter(self.file, stop-start)
+
+class FileServeMiddleware(DepotMiddleware):
+    """ Depot middleware serving files with range requests, revalidation and sendfile offload. """
+    def __init__(self, app, offload="", accel_prefix="", **kwargs):
+        """
+        Constructor.
+
+        Args:
+            app: WSGI application.
+            offload: Offload mode of file bodies; "x-accel-redirect", "x-sendfile" or empty.
+            accel_prefix: Internal front proxy location of data root for "X-Accel-Redirect".
+            kwargs: Other arguments of Depot middleware.
+        """
+        super(FileServeMiddleware, self).__init__(app, **kwargs)
+        self.offload = offload
+        self.accel_prefix = accel_prefix
+    def serve_thumbnail(self, environ, start_response, storedfile, name):
+        """
+        Serve a thumbnail of a stored image, rendering it on cache miss.
+        Only thumbnails of "THUMBNAIL_SIZES" in "THUMBNAIL_FORMATS" are served.
+
+        Args:
+            environ: WSGI environment.
+            start_response: WSGI response starter.
+            storedfile: Depot stored file.
+            name: Thumbnail name; "<size>.<format>".
+        """
+        from app.util.images import THUMBNAIL_NAME_RX, thumbnail_cache
+        match = THUMBNAIL_NAME_RX.fullmatch(name)
+        if not match or int(match.group(1)) not in THUMBNAIL_SIZES or match.group(2) not in THUMBNAIL_FORMATS \
+            or not (storedfile.content_type or "").startswith("image/"):
+            storedfile.close()
+            return self._404_response(start_response)
+        try:
+            thumbnail = thumbnail_cache.get(storedfile, int(match.group(1)), match.group(2))
+        except APIError:
+            return self._404_response(start_response)
+        finally:
+            storedfile.close()
+        return RangeFileServeApp(thumbnail, self.cache_max_age, self.offload, self.accel_prefix)(environ, start_response)
+    def __call__(self, environ, start_response):
+        """ Serve stored files under mount point, and pass other requests to the application. """
+        full_path = environ["PATH_INFO"]
+        if environ["REQUEST_METHOD"] not in ("GET", "HEAD") or not full_path.startswith(self.mountpoint+"/"):
+            return self.app(environ, start_response)
+        path = full_path[len(self.mountpoint)+1:].split("/")
+        if len(path)<2:
+            return self._404_response(start_response)
+        depot = DepotManager.get(path[0])
+        if not depot:
+            return self._404_response(start_response)
+        try:
+            storedfile = depot.get(path[1])
+        except (IOError, ValueError):
+            return self._404_response(start_response)
+        if storedfile.public_url!=None:
+            return self._301_response(start_response, storedfile.public_url)
+        # Thumbnails of stored images
+        if len(path)==4 and path[2]=="thumbnails":
+            return self.serve_thumbnail(environ, start_response, storedfile, path[3])
+        return RangeFileServeApp(storedfile, self.cache_max_age, self.offload, self.accel_prefix)(environ, start_response)
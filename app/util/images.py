@@ -0,0 +1,242 @@
+""" Avatar normalization and thumbnails of stored images. """
+import os, re
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+from depot.fields.upload import UploadedFile
+from depot.io import utils
+from depot.io.interfaces import StoredFile
+from depot.manager import DepotManager
+from marshmallow import fields
+from PIL import Image, ImageOps
+
+from app.config import AVATAR_MAX_SIZE, IMAGE_MAX_PIXELS, THUMBNAIL_SIZES, THUMBNAIL_FORMATS, THUMBNAIL_QUALITY, \
+    THUMBNAIL_CACHE_ROOT, THUMBNAIL_CACHE_SIZE
+from app.util.core import APIError, map_error
+
+# Pillow format names and content types of image formats
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp")
+}
+# Name of thumbnails; "<size>.<format>"
+THUMBNAIL_NAME_RX = re.compile(r"(\d+)\.(\w+)")
+# Minimum interval between recency updates of a cached thumbnail (In seconds)
+THUMBNAIL_TOUCH_INTERVAL = 60
+# Fraction of maximum size a full thumbnail cache is evicted to
+THUMBNAIL_CACHE_LOW_WATER = 0.9
+
+def open_image(content, size):
+    """
+    Decode an image for rendering at no more than given size.
+    JPEG images are decoded at reduced scale, EXIF orientation is applied, metadata is dropped,
+    and transparency is flattened onto white background.
+
+    Args:
+        content: File object or path of the image.
+        size: Size of rendered images. (In pixels)
+    Returns:
+        RGB image.
+    Raises:
+        APIError: When content is not a supported image, or has more than "IMAGE_MAX_PIXELS" pixels.
+    """
+    with map_error({(OSError, SyntaxError, ValueError, Image.DecompressionBombError): APIError(400, "bad_image")}):
+        image = Image.open(content)
+        if image.width*image.height>IMAGE_MAX_PIXELS:
+            raise APIError(400, "image_too_large", max_pixels=IMAGE_MAX_PIXELS)
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "PA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        return image.convert("RGB")
+
+def encode_image(image, format):
+    """
+    Encode an image.
+
+    Args:
+        image: Image.
+        format: Image format; one of "IMAGE_FORMATS".
+    Returns:
+        File object of encoded image.
+    """
+    output = BytesIO()
+    image.save(output, IMAGE_FORMATS[format][0], quality=THUMBNAIL_QUALITY)
+    output.seek(0)
+    return output
+
+def render_thumbnail(image, size, format):
+    """
+    Render a square thumbnail of an image, cropped around its center.
+
+    Args:
+        image: Decoded image.
+        size: Thumbnail size. (In pixels)
+        format: Thumbnail format; one of "IMAGE_FORMATS".
+    Returns:
+        File object of encoded thumbnail.
+    """
+    return encode_image(ImageOps.fit(image, (size, size), Image.LANCZOS), format)
+
+class UploadedAvatar(UploadedFile):
+    """
+    Uploaded avatar.
+    Avatars are normalized to JPEG images of at most "AVATAR_MAX_SIZE" pixels without metadata on upload,
+    and thumbnails of "THUMBNAIL_SIZES" in "THUMBNAIL_FORMATS" are rendered and stored next to them.
+    Thumbnails are removed together with their avatar.
+    """
+    def process_content(self, content, filename=None, content_type=None):
+        """ Normalize and store avatar, then render and store its thumbnails. """
+        image = open_image(utils.file_from_content(content), AVATAR_MAX_SIZE)
+        image.thumbnail((AVATAR_MAX_SIZE, AVATAR_MAX_SIZE), Image.LANCZOS)
+        super(UploadedAvatar, self).process_content(encode_image(image, "jpeg"), "avatar.jpg", "image/jpeg")
+        thumbnails = {}
+        for size in THUMBNAIL_SIZES:
+            for format in THUMBNAIL_FORMATS:
+                name = "%d.%s" % (size, format)
+                thumbnails[name], _ = self.store_content(
+                    render_thumbnail(image, size, format),
+                    "avatar_"+name,
+                    IMAGE_FORMATS[format][1]
+                )
+        self["thumbnails"] = thumbnails
+
+def thumbnail_urls(uploaded_file):
+    """
+    Get URLs of thumbnails of an uploaded image.
+    Thumbnails stored on upload are served as stored files; others are rendered on first request.
+
+    Args:
+        uploaded_file: Uploaded file.
+    Returns:
+        A dictionary of thumbnail URLs keyed by format, keyed by size.
+    """
+    middleware = DepotManager.get_middleware()
+    stored = uploaded_file.get("thumbnails") or {}
+    urls = {}
+    for size in THUMBNAIL_SIZES:
+        urls[str(size)] = {}
+        for format in THUMBNAIL_FORMATS:
+            name = "%d.%s" % (size, format)
+            urls[str(size)][format] = middleware.url_for(stored.get(name) or "%s/thumbnails/%s" % (uploaded_file.path, name))
+    return urls
+
+class ThumbnailField(fields.Field):
+    """ Schema field for thumbnail URLs of an uploaded image. """
+    def _serialize(self, value, attr, obj):
+        return thumbnail_urls(value) if value else None
+
+class CachedThumbnail(StoredFile):
+    """ Cached thumbnail of a stored file, served like stored files. """
+    def __init__(self, file_id, path, content_type, last_modified):
+        """
+        Constructor.
+
+        Args:
+            file_id: Identifier of the thumbnail.
+            path: Path of the cached thumbnail.
+            content_type: Content type of the thumbnail.
+            last_modified: Last modification time of the thumbnail.
+        """
+        super(CachedThumbnail, self).__init__(file_id, os.path.basename(path), content_type, last_modified,
+            os.path.getsize(path))
+        self._file_path = path
+        self._file = open(path, "rb")
+    def read(self, n=-1):
+        return self._file.read(n)
+    def close(self):
+        self._file.close()
+    @property
+    def closed(self):
+        return self._file.closed
+
+class ThumbnailCache(object):
+    """
+    Bounded on-disk cache of thumbnails rendered on request.
+    Recency of entries is kept in their modification times, so that the cache is shared by all workers.
+    When the cache grows beyond its maximum size, least recently used entries are evicted.
+    """
+    def __init__(self, root, max_size):
+        """
+        Constructor.
+
+        Args:
+            root: Root directory of the cache.
+            max_size: Maximum total size of cached thumbnails. (In bytes)
+        """
+        self.root = root
+        self.max_size = max_size
+        self.size = None
+        self.lock = Lock()
+    def __entries(self):
+        """ Get modification time, size and path of all cached thumbnails. """
+        entries = []
+        for dir_entry in os.scandir(self.root) if os.path.isdir(self.root) else ():
+            for entry in os.scandir(dir_entry.path):
+                # Unfinished thumbnails
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+    def evict(self):
+        """ Evict least recently used thumbnails until the cache is below its low water mark. """
+        with self.lock:
+            entries = sorted(self.__entries())
+            self.size = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if self.size<=self.max_size*THUMBNAIL_CACHE_LOW_WATER:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                self.size -= size
+    def get(self, storedfile, size, format):
+        """
+        Get the thumbnail of a stored image, rendering it on cache miss.
+
+        Args:
+            storedfile: Depot stored file.
+            size: Thumbnail size. (In pixels)
+            format: Thumbnail format; one of "IMAGE_FORMATS".
+        Returns:
+            Cached thumbnail.
+        Raises:
+            APIError: When the stored file is not a supported image.
+        """
+        file_id = storedfile.file_id
+        path = os.path.join(self.root, file_id[:2], "%s_%d.%s" % (file_id, size, format))
+        content_type = IMAGE_FORMATS[format][1]
+        try:
+            # Recency update; rate-limited to save writes
+            if time()-os.stat(path).st_mtime>THUMBNAIL_TOUCH_INTERVAL:
+                os.utime(path)
+            return CachedThumbnail(os.path.basename(path), path, content_type, storedfile.last_modified)
+        except FileNotFoundError:
+            pass
+        # Render from local file when available
+        image = open_image(getattr(storedfile, "_file_path", None) or storedfile, size)
+        output = render_thumbnail(image, size, format).getvalue()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with NamedTemporaryFile(dir=os.path.dirname(path), prefix=".", delete=False) as f:
+            f.write(output)
+        os.replace(f.name, path)
+        thumbnail = CachedThumbnail(os.path.basename(path), path, content_type, storedfile.last_modified)
+        with self.lock:
+            if self.size!=None:
+                self.size += len(output)
+            full = self.size==None or self.size>self.max_size
+        if full:
+            self.evict()
+        return thumbnail
+
+# Thumbnail cache of current worker
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_ROOT, THUMBNAIL_CACHE_SIZE)
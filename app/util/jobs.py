@@ -0,0 +1,293 @@
+""" Database-backed background job queue. """
+import json, logging, os, signal, socket
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from traceback import format_exc
+from sqlalchemy import select, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+import app
+from app.config import JOB_WORKERS, JOB_POLL_INTERVAL, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY, JOB_TIMEOUT, JOB_RETENTION, \
+    JOB_HEARTBEAT_INTERVAL
+
+# Logger of job workers
+logger = logging.getLogger("app.jobs")
+
+# Registered job handlers
+job_handlers = {}
+
+def job(name):
+    """
+    Register a background job handler. Usually used as decorator.
+    Handlers are called in an application context with job arguments as keyword arguments.
+    Database changes of a handler are committed together with the completion of its job.
+
+    Args:
+        name: Job name.
+    Returns:
+        A decorator registering the handler.
+    """
+    def decorator(handler):
+        job_handlers[name] = handler
+        return handler
+    return decorator
+
+def enqueue(name, args={}, priority=0, key=None, delay=0, max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Add a job to the queue in the transaction of current database session.
+    The job becomes visible to workers when the transaction commits, and is discarded if it rolls back.
+
+    Args:
+        name: Name of a registered job handler.
+        args: JSON-serializable keyword arguments of the handler.
+        priority: Job priority; jobs with higher priorities run first.
+        key: Idempotency key; the job is not added if a job with the same key is kept in the queue.
+        delay: Delay before the job may run. (In seconds)
+        max_attempts: Maximum attempts of the job, including retries.
+    Returns:
+        Whether the job is added.
+    Raises:
+        ValueError: When no handler is registered for the name.
+    """
+    from app.models import Job
+    if name not in job_handlers:
+        raise ValueError("Unknown job: %s" % name)
+    db = app.db
+    now = datetime.now()
+    table = Job.__table__
+    values = {
+        "name": name,
+        "args": json.dumps(args),
+        "priority": priority,
+        "idempotency_key": key,
+        "status": "pending",
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "run_after": now+timedelta(seconds=delay),
+        "create_time": now
+    }
+    dialect = db.engine.dialect.name
+    # Duplicate jobs are ignored
+    if key==None:
+        statement = table.insert()
+    elif dialect=="postgresql":
+        statement = pg_insert(table).on_conflict_do_nothing()
+    else:
+        statement = table.insert().prefix_with("OR IGNORE" if dialect=="sqlite" else "IGNORE")
+    return db.session.execute(statement, values).rowcount>0
+
+class Worker(object):
+    """ Pool of threads running background jobs. """
+    def __init__(self, flask_app, n_threads=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL):
+        """
+        Constructor.
+
+        Args:
+            flask_app: Flask application.
+            n_threads: Amount of worker threads.
+            poll_interval: Polling interval of idle worker threads. (In seconds)
+        """
+        self.app = flask_app
+        self.n_threads = n_threads
+        self.poll_interval = poll_interval
+        self.name = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.stop_event = Event()
+    def claim(self):
+        """
+        Claim the pending job of highest priority that is ready to run.
+        On PostgreSQL, workers skip jobs locked by each other; otherwise claims are optimistic.
+
+        Returns:
+            A tuple with job ID, name, arguments, attempts and maximum attempts, or None if no job is ready.
+        """
+        from app.models import Job
+        db = app.db
+        table = Job.__table__
+        now = datetime.now()
+        ready = and_(table.c.status=="pending", table.c.run_after<=now)
+        order = (table.c.priority.desc(), table.c.id)
+        values = {"status": "running", "attempts": table.c.attempts+1, "locked_by": self.name, "locked_at": now}
+        columns = (table.c.id, table.c.name, table.c.args, table.c.attempts, table.c.max_attempts)
+        # PostgreSQL; "UPDATE ... WHERE id = (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING"
+        if db.engine.dialect.name=="postgresql":
+            candidate = select([table.c.id]).where(ready).order_by(*order).limit(1).with_for_update(skip_locked=True)
+            row = db.session.execute(
+                table.update().where(table.c.id==candidate.as_scalar()).values(values).returning(*columns)
+            ).first()
+            db.session.commit()
+            return tuple(row) if row else None
+        # Other databases; retry if another worker claims the job first
+        while True:
+            job_id = db.session.execute(select([table.c.id]).where(ready).order_by(*order).limit(1)).scalar()
+            if job_id==None:
+                db.session.commit()
+                return None
+            claimed = db.session.execute(
+                table.update().where(and_(table.c.id==job_id, table.c.status=="pending")).values(values)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return tuple(db.session.execute(select(columns).where(table.c.id==job_id)).first())
+    def __claimed(self, job_id, attempts):
+        """ Build condition matching a job while it is still claimed by this worker for given attempt. """
+        from app.models import Job
+        table = Job.__table__
+        return and_(
+            table.c.id==job_id,
+            table.c.status=="running",
+            table.c.locked_by==self.name,
+            table.c.attempts==attempts
+        )
+    @contextmanager
+    def heartbeat(self, job_id, attempts):
+        """
+        Refresh lock time of a claimed job every "JOB_HEARTBEAT_INTERVAL" seconds in a with block,
+        so that running jobs are not considered abandoned.
+
+        Args:
+            job_id: Job ID.
+            attempts: Attempts of the job when claimed.
+        """
+        from app.models import Job
+        engine = app.db.engine
+        table = Job.__table__
+        stop_event = Event()
+        def beat():
+            while not stop_event.wait(JOB_HEARTBEAT_INTERVAL):
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(table.update().where(self.__claimed(job_id, attempts)).values(
+                            locked_at=datetime.now()
+                        ))
+                except Exception:
+                    logger.exception("Heartbeat of job %d failed", job_id)
+        thread = Thread(target=beat, name="job-heartbeat-%d" % job_id, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            thread.join()
+    def run_one(self):
+        """
+        Claim and run a job.
+        A failed job is retried with exponential backoff until it runs out of attempts.
+        Results of a job are discarded if it is no longer claimed by this worker when it finishes.
+
+        Returns:
+            Whether a job is run.
+        """
+        from app.models import Job
+        db = app.db
+        table = Job.__table__
+        with self.app.app_context():
+            try:
+                claimed = self.claim()
+                if not claimed:
+                    return False
+                job_id, name, args, attempts, max_attempts = claimed
+                try:
+                    handler = job_handlers.get(name)
+                    if not handler:
+                        raise ValueError("Unknown job: %s" % name)
+                    with self.heartbeat(job_id, attempts):
+                        handler(**json.loads(args))
+                    # Handler changes are committed with job completion
+                    completed = db.session.execute(table.update().where(self.__claimed(job_id, attempts)).values(
+                        status="done",
+                        finish_time=datetime.now(),
+                        last_error=None
+                    )).rowcount
+                    if completed:
+                        db.session.commit()
+                    else:
+                        db.session.rollback()
+                        logger.warning("Job %d (%s) was taken over while running; results discarded", job_id, name)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Job %d (%s) failed on attempt %d", job_id, name, attempts)
+                    retry = attempts<max_attempts and name in job_handlers
+                    db.session.execute(table.update().where(self.__claimed(job_id, attempts)).values(
+                        status="pending" if retry else "failed",
+                        run_after=datetime.now()+timedelta(seconds=JOB_RETRY_DELAY*2**(attempts-1)),
+                        finish_time=None if retry else datetime.now(),
+                        last_error=format_exc()
+                    ))
+                    db.session.commit()
+                return True
+            finally:
+                db.session.remove()
+    def run_until_idle(self):
+        """
+        Run jobs in current thread until no job is ready.
+
+        Returns:
+            Amount of run jobs.
+        """
+        n_jobs = 0
+        while self.run_one():
+            n_jobs += 1
+        return n_jobs
+    def maintain(self):
+        """ Retry abandoned jobs, and remove finished jobs older than "JOB_RETENTION". """
+        from app.models import Job
+        db = app.db
+        table = Job.__table__
+        now = datetime.now()
+        with self.app.app_context():
+            try:
+                abandoned = and_(table.c.status=="running", table.c.locked_at<now-timedelta(seconds=JOB_TIMEOUT))
+                db.session.execute(table.update().where(and_(abandoned, table.c.attempts<table.c.max_attempts)).values(
+                    status="pending",
+                    run_after=now
+                ))
+                db.session.execute(table.update().where(abandoned).values(
+                    status="failed",
+                    finish_time=now,
+                    last_error="Job timed out"
+                ))
+                db.session.execute(table.delete().where(and_(
+                    table.c.status.in_(("done", "failed")),
+                    table.c.finish_time<now-timedelta(seconds=JOB_RETENTION)
+                )))
+                db.session.commit()
+            finally:
+                db.session.remove()
+    def __work(self):
+        """ Worker thread loop. """
+        while not self.stop_event.is_set():
+            try:
+                if self.run_one():
+                    continue
+            except Exception:
+                logger.exception("Job worker error")
+            self.stop_event.wait(self.poll_interval)
+    def run(self):
+        """ Run worker threads until the process receives "SIGINT" or "SIGTERM". Running jobs are finished before exit. """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self.stop_event.set())
+        threads = [Thread(target=self.__work, name="job-worker-%d" % i) for i in range(self.n_threads)]
+        for thread in threads:
+            thread.start()
+        while not self.stop_event.is_set():
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception("Job queue maintenance failed")
+            self.stop_event.wait(JOB_TIMEOUT/10)
+        for thread in threads:
+            thread.join()
+
+def job_stats():
+    """
+    Get amount of jobs by status.
+
+    Returns:
+        A dictionary with amount of jobs, keyed by status.
+    """
+    from app.models import Job
+    from sqlalchemy import func
+    db = app.db
+    table = Job.__table__
+    return dict(db.session.execute(select([table.c.status, func.count()]).group_by(table.c.status)).fetchall())
@@ -0,0 +1,89 @@
+""" In-place upgrade of existing databases to current models. """
+from sqlalchemy.inspection import inspect
+from sqlalchemy.schema import CreateColumn
+
+from app.util.data import searchable_models, create_search_index, recount_counters
+
+def __remove_duplicates(conn, table, columns):
+    """
+    Remove rows duplicating or lacking values of given columns, so that a primary key can be added.
+
+    Args:
+        conn: Database connection.
+        table: Table to operate.
+        columns: Columns of the primary key.
+    """
+    preparer = conn.dialect.identifier_preparer
+    table_name = preparer.format_table(table)
+    column_names = [preparer.quote(column.name) for column in columns]
+    # Physical row identifier
+    row_id = "ctid" if conn.dialect.name=="postgresql" else "rowid"
+    conn.execute("DELETE FROM %s WHERE %s" % (
+        table_name,
+        " OR ".join("%s IS NULL" % name for name in column_names)
+    ))
+    conn.execute("DELETE FROM {table} WHERE {row_id} NOT IN (SELECT MIN({row_id}) FROM {table} GROUP BY {columns})".format(
+        table=table_name,
+        row_id=row_id,
+        columns=", ".join(column_names)
+    ))
+
+def upgrade_db(db):
+    """
+    Add missing tables, columns, primary keys and indexes of current models to the database.
+    Existing columns and constraints are not altered. On SQLite, missing primary keys are
+    replaced by unique indexes, since they cannot be added to existing tables.
+    Added counter columns are computed from existing rows.
+
+    Args:
+        db: Flask-SQLAlchemy database object.
+    Returns:
+        A list of applied changes, as human-readable strings.
+    """
+    changes = []
+    recount_tables = set()
+    db.create_all()
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        preparer = conn.dialect.identifier_preparer
+        for table in db.metadata.sorted_tables:
+            table_name = preparer.format_table(table)
+            # Columns
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s" % (
+                        table_name,
+                        CreateColumn(column).compile(dialect=conn.dialect)
+                    ))
+                    changes.append("column %s.%s" % (table.name, column.name))
+                    if "counter_sources" in column.info:
+                        recount_tables.add(table)
+            # Primary key
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            pk_columns = list(table.primary_key.columns)
+            pk_exists = inspector.get_pk_constraint(table.name)["constrained_columns"] or "pk_%s" % table.name in indexes
+            if pk_columns and not pk_exists:
+                __remove_duplicates(conn, table, pk_columns)
+                column_names = ", ".join(preparer.quote(column.name) for column in pk_columns)
+                if conn.dialect.name=="postgresql":
+                    conn.execute("ALTER TABLE %s ADD PRIMARY KEY (%s)" % (table_name, column_names))
+                else:
+                    conn.execute("CREATE UNIQUE INDEX %s ON %s (%s)" % (
+                        preparer.quote("pk_%s" % table.name),
+                        table_name,
+                        column_names
+                    ))
+                changes.append("primary key %s" % table.name)
+            # Indexes
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    changes.append("index %s" % index.name)
+        # Full-text search indexes
+        for model in searchable_models:
+            create_search_index(conn, model)
+        # Added counters
+        if recount_tables:
+            recount_counters(conn, recount_tables)
+    return changes
@@ -0,0 +1,147 @@
+""" Password hashing in a bounded process pool. """
+import os, sys
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from hashlib import pbkdf2_hmac
+from hmac import compare_digest
+from threading import BoundedSemaphore, Lock
+
+from app.config import USER_PASSWD_HMAC_SALT, N_HASH_ROUNDS, N_LEGACY_HASH_ROUNDS, HASH_POOL_SIZE, \
+    HASH_QUEUE_LIMIT, HASH_TIMEOUT
+from app.util.core import APIError, map_error
+
+# Length of per-user password salts
+SALT_LEN = 16
+
+__pool = None
+__pool_lock = Lock()
+# Queue slots of hashing tasks of current worker
+queue_slots = BoundedSemaphore(HASH_QUEUE_LIMIT)
+# Salt of hashing done for unknown users
+__dummy_salt = os.urandom(SALT_LEN)
+
+def python_executable():
+    """
+    Get path of Python interpreter of current installation.
+    Under uWSGI, "sys.executable" is the uWSGI binary, so the interpreter is located from installation prefix instead.
+    Virtual environments may only provide "python3" and "python", so these names are tried as well.
+
+    Returns:
+        Path of Python interpreter.
+    Raises:
+        RuntimeError: No executable Python interpreter is found.
+    """
+    if os.path.basename(sys.executable).startswith("python"):
+        return sys.executable
+    names = ["python%d.%d" % sys.version_info[:2], "python%d" % sys.version_info[0], "python"]
+    candidates = [os.path.join(sys.exec_prefix, "bin", name) for name in names]
+    base_executable = getattr(sys, "_base_executable", None)
+    if base_executable and os.path.basename(base_executable).startswith("python"):
+        candidates.append(base_executable)
+    for path in candidates:
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    raise RuntimeError("Python interpreter not found, tried: %s" % ", ".join(candidates))
+
+def __get_pool():
+    """
+    Get hashing process pool of current worker, creating it on first use.
+    Hashing processes are started from a fork server instead of being forked from the multi-threaded worker.
+    Before Python 3.7, the pool does not accept a multiprocessing context, and forks the worker instead.
+    """
+    global __pool
+    with __pool_lock:
+        if __pool==None and sys.version_info<(3, 7):
+            __pool = ProcessPoolExecutor(max_workers=HASH_POOL_SIZE)
+        elif __pool==None:
+            context = get_context("forkserver")
+            context.set_executable(python_executable())
+            # Hashing processes only need the standard library
+            context.set_forkserver_preload(["hashlib"])
+            __pool = ProcessPoolExecutor(max_workers=HASH_POOL_SIZE, mp_context=context)
+        return __pool
+
+def calc_password(raw_password, salt, rounds):
+    """
+    Calculate PBKDF2-HMAC-SHA256 password hash.
+    Hashing runs in the hashing process pool, or inline if "HASH_POOL_SIZE" is 0.
+
+    Args:
+        raw_password: Raw user password.
+        salt: Password salt.
+        rounds: Rounds of hashing.
+    Returns:
+        Byte sequence of password hash.
+    Raises:
+        APIError: When all "HASH_QUEUE_LIMIT" queue slots are taken or hashing times out.
+    """
+    if not HASH_POOL_SIZE:
+        return pbkdf2_hmac("sha256", raw_password.encode(), salt, rounds)
+    # Backpressure; fail fast instead of queuing
+    if not queue_slots.acquire(blocking=False):
+        raise APIError(503, "hash_pool_saturated")
+    try:
+        future = __get_pool().submit(pbkdf2_hmac, "sha256", raw_password.encode(), salt, rounds)
+    except:
+        queue_slots.release()
+        raise
+    future.add_done_callback(lambda future: queue_slots.release())
+    with map_error({TimeoutError: APIError(503, "hash_timeout")}):
+        return future.result(timeout=HASH_TIMEOUT)
+
+def new_password(raw_password):
+    """
+    Hash a new password with a random salt and current rounds of hashing.
+
+    Args:
+        raw_password: Raw user password.
+    Returns:
+        A tuple with password hash, salt and rounds of hashing.
+    """
+    salt = os.urandom(SALT_LEN)
+    return calc_password(raw_password, salt, N_HASH_ROUNDS), salt, N_HASH_ROUNDS
+
+def set_password(user, raw_password):
+    """
+    Hash and set user password.
+
+    Args:
+        user: User model instance.
+        raw_password: Raw user password.
+    """
+    user.password, user.password_salt, user.password_rounds = new_password(raw_password)
+
+def check_dummy_password(raw_password):
+    """
+    Hash a password like checking it against a user, so that failed logins of unknown users
+    take as long as those of existing users.
+
+    Args:
+        raw_password: Raw password.
+    Returns:
+        False.
+    """
+    calc_password(raw_password, __dummy_salt, N_HASH_ROUNDS)
+    return False
+
+def check_password(user, raw_password):
+    """
+    Verify user password, rehashing it if stored with outdated salt or rounds of hashing.
+    Passwords without stored salt or rounds use the site-wide salt and legacy rounds.
+
+    Args:
+        user: User model instance.
+        raw_password: Raw user password.
+    Returns:
+        Whether the password is correct.
+    """
+    if not user.password:
+        return check_dummy_password(raw_password)
+    salt = user.password_salt or USER_PASSWD_HMAC_SALT
+    rounds = user.password_rounds or N_LEGACY_HASH_ROUNDS
+    if not compare_digest(calc_password(raw_password, salt, rounds), user.password):
+        return False
+    # Rehash on login
+    if not user.password_salt or rounds<N_HASH_ROUNDS:
+        set_password(user, raw_password)
+    return True
@@ -1,10 +1,177 @@
 """ Permission management utilities. """
 import functools
 from types import FunctionType
-from flask import g
+from flask import g, has_app_context
+from sqlalchemy import select, exists, event, and_
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Session
 
-from app.models import AbstractBaseGroup, User
-from app.util.core import APIError
+from app import db
+from app.config import GROUP_CACHE_SIZE, GROUP_CACHE_TTL
+from app.models import AbstractBaseGroup, Group, User
+from app.util.core import APIError, RevocationCache
+
+# Group membership helper table
+membership_table = Group.users.property.secondary
+# Session info key of users whose group membership changes in current transaction
+MEMBERSHIP_CHANGES_KEY = "membership_changes"
+
+class MembershipCache(RevocationCache):
+    """
+    User ID to group IDs cache of current worker.
+    Membership changes are recorded in the revocation log, so that stale membership
+    stops granting access in all workers within the poll interval.
+    """
+    revocation_kind = "membership"
+    def __init__(self, max_size, ttl, **kwargs):
+        """
+        Constructor.
+
+        Args:
+            max_size: Maximum amount of entries.
+            ttl: Time to live of entries in seconds.
+            kwargs: Other arguments of "RevocationCache".
+        """
+        super(MembershipCache, self).__init__(max_size, ttl, **kwargs)
+        # Amount of invalidations, used to discard values loaded before an invalidation
+        self._invalidations = 0
+    def _revoked(self, revocation):
+        """ Remove group IDs of a user whose membership changed in another worker. """
+        if revocation.user_id!=None:
+            self.pop(revocation.user_id)
+    def pop(self, key):
+        """ Remove an entry and discard values being loaded. """
+        with self._lock:
+            self._invalidations += 1
+            super(MembershipCache, self).pop(key)
+    def load(self, key, loader):
+        """
+        Get value of an entry, loading and caching it when missing.
+        The loaded value is not cached if any entry is invalidated while loading.
+
+        Args:
+            key: Entry key.
+            loader: Function loading entry value.
+        Returns:
+            Entry value.
+        """
+        value = self.get(key)
+        if value!=None:
+            return value
+        with self._lock:
+            invalidations = self._invalidations
+        value = loader()
+        with self._lock:
+            if self._invalidations==invalidations:
+                self.set(key, value)
+        return value
+
+# User ID to group IDs cache
+membership_cache = MembershipCache(GROUP_CACHE_SIZE, GROUP_CACHE_TTL)
+
+def group_member_exp(group_id, user_id):
+    """
+    Build SQL expression testing group membership with an EXISTS subquery.
+
+    Args:
+        group_id: Group ID or group ID column expression.
+        user_id: User ID or user ID column expression.
+    Returns:
+        SQLAlchemy EXISTS expression.
+    """
+    return exists().where(and_(
+        membership_table.c.group_id==group_id,
+        membership_table.c.user_id==user_id
+    ))
+
+def user_group_ids(user_id):
+    """
+    Get IDs of groups a user belongs to.
+    Memoized per request, and cached per worker in "membership_cache".
+
+    Args:
+        user_id: User ID.
+    Returns:
+        A frozen set of group IDs.
+    """
+    memo = g.setdefault("group_ids_memo", {}) if has_app_context() else {}
+    group_ids = memo.get(user_id)
+    if group_ids==None:
+        group_ids = membership_cache.load(user_id, lambda: frozenset(group_id for group_id, in db.session.execute(
+            select([membership_table.c.group_id]).where(membership_table.c.user_id==user_id)
+        )))
+    memo[user_id] = group_ids
+    return group_ids
+
+def invalidate_membership(user_id):
+    """
+    Invalidate cached group IDs of a user in current worker.
+
+    Args:
+        user_id: User ID.
+    """
+    membership_cache.pop(user_id)
+    if has_app_context():
+        g.get("group_ids_memo", {}).pop(user_id, None)
+
+def __track_membership(session, flush_context, instances):
+    """
+    Record users whose group membership changes in current flush.
+    The changes are logged for other workers, and invalidated in current worker after commit.
+
+    Args:
+        session: SQLAlchemy session being flushed.
+        flush_context: Flush context.
+        instances: Unused.
+    """
+    user_ids = set()
+    for obj in session.dirty:
+        # Membership changes from either side
+        if isinstance(obj, Group):
+            history = inspect(obj).attrs.users.history
+            user_ids.update(user.id for user in history.added+history.deleted)
+        elif isinstance(obj, User):
+            history = inspect(obj).attrs.groups.history
+            if history.has_changes():
+                user_ids.add(obj.id)
+    for obj in session.new:
+        if isinstance(obj, Group):
+            user_ids.update(user.id for user in inspect(obj).attrs.users.history.added)
+    for obj in session.deleted:
+        if isinstance(obj, Group):
+            user_ids.update(user_id for user_id, in session.execute(
+                select([membership_table.c.user_id]).where(membership_table.c.group_id==obj.id)
+            ))
+        elif isinstance(obj, User):
+            user_ids.add(obj.id)
+    user_ids.discard(None)
+    changes = session.info.setdefault(MEMBERSHIP_CHANGES_KEY, set())
+    for user_id in user_ids-changes:
+        membership_cache.log_revocation(user_id=user_id, session=session)
+    changes.update(user_ids)
+
+def __invalidate_membership_changes(session):
+    """
+    Invalidate cached group IDs of users whose group membership changed in committed transaction.
+
+    Args:
+        session: Committed SQLAlchemy session.
+    """
+    for user_id in session.info.pop(MEMBERSHIP_CHANGES_KEY, ()):
+        invalidate_membership(user_id)
+
+def __discard_membership_changes(session):
+    """
+    Discard membership changes of a rolled back transaction.
+
+    Args:
+        session: Rolled back SQLAlchemy session.
+    """
+    session.info.pop(MEMBERSHIP_CHANGES_KEY, None)
+
+event.listen(Session, "before_flush", __track_membership)
+event.listen(Session, "after_commit", __invalidate_membership_changes)
+event.listen(Session, "after_rollback", __discard_membership_changes)
 
 def __handle_perm_rule(rule, user, **kwargs):
     """
@@ -16,7 +183,11 @@ def __handle_perm_rule(rule, user, **kwargs):
     Returns:
         Whether the user is authorized or not.
     """
-    return __perm_rule_map[type(rule)](rule, user, **kwargs)
+    for rule_type in type(rule).__mro__:
+        handler = __perm_rule_map.get(rule_type)
+        if handler:
+            return handler(rule, user, **kwargs)
+    raise TypeError("Unknown permission rule type: %s." % type(rule).__name__)
 
 def __perm_rule_tuple(rules, user, **kwargs):
     """
@@ -29,10 +200,7 @@ def __perm_rule_tuple(rules, user, **kwargs):
     Returns:
         Whether the user is authorized or not.
     """
-    authorized = True
-    for rule in rules:
-        authorized = authorized or __handle_perm_rule(rule, user, **kwargs)
-    return authorized
+    return any(__handle_perm_rule(rule, user, **kwargs) for rule in rules)
 
 def __perm_rule_list(rules, user, **kwargs):
     """
@@ -45,10 +213,7 @@ def __perm_rule_list(rules, user, **kwargs):
     Returns:
         Whether the user is authorized or not.
     """
-    authorized = True
-    for rule in rules:
-        authorized = authorized and __handle_perm_rule(rule, user, **kwargs)
-    return authorized
+    return all(__handle_perm_rule(rule, user, **kwargs) for rule in rules)
 
 def __perm_rule_user(rule_user, user, **kwargs):
     """
@@ -74,8 +239,10 @@ def __perm_rule_group(group, user, **kwargs):
     Returns:
         Whether the user is authorized or not.
     """
-    # TODO: Group authorization
-    return True
+    # Not logged in
+    if user==None:
+        return False
+    return group.id in user_group_ids(user.id)
 
 def __perm_rule_func(func, user, **kwargs):
     """
@@ -113,14 +280,43 @@ def check_perm(*rules, **kwargs):
     """
     throw = kwargs.get("throw", True)
     # Not logged in
-    if not g.user and throw:
+    if g.get("user_id")==None and throw:
         raise APIError(401, "login_required")
-    # Execute rules
-    authorized = __handle_perm_rule(rules, g.user, **kwargs)
+    # Execute rules (User is only loaded when there are rules)
+    authorized = __handle_perm_rule(rules, g.user, **kwargs) if rules else True
     if not authorized and throw:
         raise APIError(403, "perm_denied")
     return authorized
 
+def filter_group_perm(objs, relationship, user_id=None):
+    """
+    Find elements the user is permitted to through groups, with a single query.
+    The user is permitted to an element if the user belongs to any group related to the element.
+
+    Args:
+        objs: Elements to check.
+        relationship: Many-to-many relationship from elements to groups, like "Note.owngroup".
+        user_id: User ID. Defaults to the user of current request.
+    Returns:
+        A list of permitted elements, in the order of given elements.
+    """
+    if user_id==None:
+        user_id = g.get("user_id")
+    if user_id==None or not objs:
+        return []
+    prop = relationship.property
+    local_column = prop.synchronize_pairs[0][1]
+    group_column = prop.secondary_synchronize_pairs[0][1]
+    local_attr = prop.parent.get_property_by_column(prop.local_remote_pairs[0][0]).key
+    local_values = list({getattr(obj, local_attr) for obj in objs})
+    permitted = {value for value, in db.session.execute(
+        select([local_column]).distinct().where(and_(
+            local_column.in_(local_values),
+            group_member_exp(group_column, user_id)
+        ))
+    )}
+    return [obj for obj in objs if getattr(obj, local_attr) in permitted]
+
 def auth_required(*rules, **auth_kwargs):
     """
     Decorate views that needs authorization.
@@ -0,0 +1,105 @@
+""" Instrumented database connection pool. """
+import os
+from threading import Lock, local
+from time import monotonic
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds of checkout wait time histogram buckets (In milliseconds)
+WAIT_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    Queue pool recording checkout counts and wait times of current worker.
+    Time spent opening new connections during checkout is recorded separately from wait time.
+    """
+    def __init__(self, *args, **kwargs):
+        """ Constructor. """
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = Lock()
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._wait_histogram = [0]*(len(WAIT_BUCKETS)+1)
+        self._connects = 0
+        self._connect_time = 0.0
+        # Connect time of current checkout in each thread
+        self._checkout_local = local()
+    def _create_connection(self):
+        """ Open a new connection, recording time spent connecting. """
+        start = monotonic()
+        try:
+            return super(InstrumentedQueuePool, self)._create_connection()
+        finally:
+            elapsed = monotonic()-start
+            self._checkout_local.connect_time = getattr(self._checkout_local, "connect_time", 0.0)+elapsed
+            with self._stats_lock:
+                self._connects += 1
+                self._connect_time += elapsed
+    def _do_get(self):
+        """ Get a connection from the pool, recording time spent waiting for it. """
+        self._checkout_local.connect_time = 0.0
+        start = monotonic()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                self._timeouts += 1
+            raise
+        finally:
+            # Connect time is not wait time
+            elapsed = max(monotonic()-start-self._checkout_local.connect_time, 0.0)
+            bucket = len(WAIT_BUCKETS)
+            for i, upper_bound in enumerate(WAIT_BUCKETS):
+                if elapsed*1000<=upper_bound:
+                    bucket = i
+                    break
+            with self._stats_lock:
+                self._checkouts += 1
+                self._waits += bucket>0
+                self._wait_time += elapsed
+                self._wait_histogram[bucket] += 1
+    def stats(self):
+        """
+        Get statistics of the pool in current worker.
+
+        Returns:
+            A dictionary with pool configuration, connection counts, checkout counts, wait time histogram
+            and time spent opening connections. Checkouts waiting longer than the first histogram bucket are
+            counted as waits.
+        """
+        with self._stats_lock:
+            histogram = {"le_%dms" % upper_bound: count for upper_bound, count in zip(WAIT_BUCKETS, self._wait_histogram)}
+            histogram["gt_%dms" % WAIT_BUCKETS[-1]] = self._wait_histogram[-1]
+            return {
+                "size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": self.checkedout(),
+                "idle": self.checkedin(),
+                "overflow": max(self.overflow(), 0),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "wait_time_total": self._wait_time,
+                "wait_histogram": histogram,
+                "connects": self._connects,
+                "connect_time_total": self._connect_time
+            }
+
+def pool_stats(engine):
+    """
+    Get connection pool statistics of an engine in current worker.
+
+    Args:
+        engine: SQLAlchemy engine.
+    Returns:
+        A dictionary with worker process ID, pool class and pool statistics if available.
+    """
+    pool = engine.pool
+    result = {"pid": os.getpid(), "pool_class": type(pool).__name__}
+    if isinstance(pool, InstrumentedQueuePool):
+        result.update(pool.stats())
+    else:
+        result["status"] = pool.status()
+    return result
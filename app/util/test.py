@@ -1,7 +1,9 @@
 """ Utilities for testing """
 import json
+from contextlib import contextmanager
 from urllib.parse import quote
 from base64 import b64encode
+from sqlalchemy import event
 
 def create_json_param(param):
     '''
@@ -25,4 +27,39 @@ def get_response_data(data):
         decoded json object.
     '''
     return json.loads(data.decode())
-    
\ No newline at end of file
+    
+@contextmanager
+def count_queries(engine):
+    '''
+    Count SQL statements executed on given engine inside a with block.
+
+    Args:
+        engine: SQLAlchemy engine to be observed.
+    Returns:
+        A list whose length is the number of executed statements.
+    '''
+    statements = []
+    def on_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", on_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", on_execute)
+
+def login_token(client, username, password):
+    '''
+    Log in with test client and get session token.
+
+    Args:
+        client: Flask test client.
+        username: User name.
+        password: Raw user password.
+    Returns:
+        Session token for authentication header.
+    '''
+    rv = client.post("/users/login", data=json.dumps(dict(
+        username=username,
+        password=password
+    )).encode(), content_type="application/json")
+    return get_response_data(rv.data)["token"]
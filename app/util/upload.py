@@ -0,0 +1,186 @@
+""" Streaming and resumable file uploads. """
+import fcntl, json, os, re
+from binascii import hexlify
+from contextlib import contextmanager
+from time import time
+from depot.io.utils import FileIntent
+
+from app.config import UPLOAD_ROOT, UPLOAD_MAX_SIZE, UPLOAD_CHUNK_SIZE, UPLOAD_TTL
+from app.util.core import APIError
+
+# Upload ID pattern
+upload_id_rx = re.compile(r"^[0-9a-f]{32}$")
+
+def stream_to_file(stream, fileobj, max_size, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Copy a stream to a file in fixed-size chunks, so that memory usage does not depend on stream size.
+
+    Args:
+        stream: Readable stream, usually request body stream.
+        fileobj: Writable file object.
+        max_size: Maximum amount of bytes to copy.
+        chunk_size: Size of chunks.
+    Returns:
+        Amount of copied bytes.
+    Raises:
+        APIError: When the stream is longer than maximum size. Copied bytes are kept in the file.
+    """
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return size
+        size += len(chunk)
+        if size>max_size:
+            raise APIError(413, "upload_too_large", max_size=UPLOAD_MAX_SIZE)
+        fileobj.write(chunk)
+
+def __upload_paths(upload_id):
+    """ Get paths of metadata and data file of an upload. """
+    if not isinstance(upload_id, str) or not upload_id_rx.match(upload_id):
+        raise APIError(404, "upload_not_found")
+    path = os.path.join(UPLOAD_ROOT, upload_id)
+    return path+".json", path+".part"
+
+def __load_upload(user_id, upload_id):
+    """
+    Get metadata and data file path of an upload started by given user.
+
+    Args:
+        user_id: ID of the uploading user.
+        upload_id: Upload ID.
+    Returns:
+        A tuple with upload metadata and data file path.
+    Raises:
+        APIError: When the upload does not exist or is started by another user.
+    """
+    metadata_path, data_path = __upload_paths(upload_id)
+    try:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        raise APIError(404, "upload_not_found")
+    if metadata["user_id"]!=user_id:
+        raise APIError(404, "upload_not_found")
+    return metadata, data_path
+
+def __purge_uploads():
+    """ Remove unfinished uploads without appended data for "UPLOAD_TTL". """
+    expire_time = time()-UPLOAD_TTL
+    for entry in os.scandir(UPLOAD_ROOT):
+        upload_id, ext = os.path.splitext(entry.name)
+        try:
+            if ext==".part" and entry.stat().st_mtime<expire_time:
+                for path in __upload_paths(upload_id):
+                    os.unlink(path)
+        except (FileNotFoundError, APIError):
+            pass
+
+def __lock_upload(f):
+    """
+    Lock data file of an upload exclusively.
+
+    Args:
+        f: Data file object.
+    Raises:
+        APIError: When the upload is locked by another request, or already finalized.
+    """
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise APIError(409, "upload_busy")
+    # Finalized data files are linked into storage
+    if os.fstat(f.fileno()).st_nlink!=1:
+        raise APIError(404, "upload_not_found")
+
+def init_upload(user_id, filename=None, content_type=None, size=None):
+    """
+    Start a resumable upload.
+
+    Args:
+        user_id: ID of the uploading user.
+        filename: Name of the uploaded file.
+        content_type: Content type of the uploaded file.
+        size: Total size of the uploaded file, if known.
+    Returns:
+        A dictionary with upload ID, current offset, suggested chunk size and maximum size.
+    Raises:
+        APIError: When the file is larger than "UPLOAD_MAX_SIZE".
+    """
+    if size!=None and size>UPLOAD_MAX_SIZE:
+        raise APIError(413, "upload_too_large", max_size=UPLOAD_MAX_SIZE)
+    os.makedirs(UPLOAD_ROOT, exist_ok=True)
+    __purge_uploads()
+    upload_id = hexlify(os.urandom(16)).decode()
+    metadata_path, data_path = __upload_paths(upload_id)
+    open(data_path, "wb").close()
+    with open(metadata_path, "w") as f:
+        json.dump({
+            "user_id": user_id,
+            "filename": filename,
+            "content_type": content_type,
+            "size": size
+        }, f)
+    return {
+        "upload_id": upload_id,
+        "offset": 0,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "max_size": UPLOAD_MAX_SIZE
+    }
+
+def append_upload(user_id, upload_id, offset, stream):
+    """
+    Append a chunk to a resumable upload, streaming it to disk.
+    Chunks must be appended at the end of uploaded data; after an interruption, the upload is resumed
+    from the offset reported by the offset mismatch error.
+
+    Args:
+        user_id: ID of the uploading user.
+        upload_id: Upload ID.
+        offset: Offset of the chunk in the file.
+        stream: Stream of chunk data.
+    Returns:
+        A dictionary with upload ID and offset after the chunk.
+    Raises:
+        APIError: When the upload is not found, the offset is not at the end of uploaded data,
+            another chunk is being appended, or the chunk exceeds the total or maximum size.
+    """
+    metadata, data_path = __load_upload(user_id, upload_id)
+    max_size = UPLOAD_MAX_SIZE if metadata["size"]==None else metadata["size"]
+    with open(data_path, "ab") as f:
+        # Serialize concurrent appends
+        __lock_upload(f)
+        current_offset = f.seek(0, os.SEEK_END)
+        if offset!=current_offset:
+            raise APIError(409, "offset_mismatch", offset=current_offset)
+        try:
+            stream_to_file(stream, f, max_size-offset)
+        # Discard the oversized chunk
+        except APIError:
+            f.truncate(offset)
+            raise
+        return {"upload_id": upload_id, "offset": f.tell()}
+
+@contextmanager
+def finalize_upload(user_id, upload_id):
+    """
+    Finish a resumable upload.
+    Yields a file intent to be assigned to a file field; the file is moved to storage on flush.
+    The upload is removed when the with block exits without error.
+
+    Args:
+        user_id: ID of the uploading user.
+        upload_id: Upload ID.
+    Raises:
+        APIError: When the upload is not found, or uploaded data is shorter than total size.
+    """
+    metadata, data_path = __load_upload(user_id, upload_id)
+    with open(data_path, "rb") as f:
+        __lock_upload(f)
+        offset = f.seek(0, os.SEEK_END)
+        if metadata["size"]!=None and offset!=metadata["size"]:
+            raise APIError(400, "upload_incomplete", offset=offset)
+        f.seek(0)
+        yield FileIntent(f, metadata["filename"] or "unnamed", metadata["content_type"] or "application/octet-stream")
+    for path in __upload_paths(upload_id):
+        os.unlink(path)
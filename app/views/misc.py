@@ -1,7 +1,28 @@
-from flask import jsonify
+import functools
+from flask import jsonify, request
 
-from app import app
+from app import app, db
+from app.config import STATS_ALLOWED_ADDRS
 from app.util.core import SUCCESS_RESP
+from app.util.data import filter_cache_stats
+from app.util.jobs import job_stats
+from app.util.pool import pool_stats
+
+def stats_required(func):
+    """
+    Decorate statistics endpoints, which are only served to clients in "STATS_ALLOWED_ADDRS".
+
+    Args:
+        func: Endpoint.
+    Returns:
+        Endpoint that rejects other clients with "perm_denied".
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if request.remote_addr not in STATS_ALLOWED_ADDRS:
+            return jsonify(status="failed", type="perm_denied"), 403
+        return func(*args, **kwargs)
+    return wrapper
 
 @app.route("/ping")
 def ping_endpoint():
@@ -9,3 +30,27 @@ def ping_endpoint():
         academia_bknd=1,
         **SUCCESS_RESP,
     )
+
+@app.route("/stats/filter_cache")
+@stats_required
+def filter_cache_stats_endpoint():
+    return jsonify(
+        **SUCCESS_RESP,
+        data=filter_cache_stats()
+    )
+
+@app.route("/stats/db_pool")
+@stats_required
+def db_pool_stats_endpoint():
+    return jsonify(
+        **SUCCESS_RESP,
+        data=pool_stats(db.engine)
+    )
+
+@app.route("/stats/jobs")
+@stats_required
+def job_stats_endpoint():
+    return jsonify(
+        **SUCCESS_RESP,
+        data=job_stats()
+    )
@@ -1,24 +1,33 @@
 """ Paper-related APIs. """
 import os
 from flask import request, jsonify, g
+from marshmallow import fields, validate
 from sqlalchemy.exc import ProgrammingError
 
 from app import db
+from app.config import BULK_MAX_SIZE
 from app.models import *
 from app.schemas import *
 from app.util.core import *
 from app.util.data import *
 from app.util.perm import auth_required
+from app.util.upload import init_upload, append_upload, finalize_upload
 
 @register_view("/papers")
 class PaperView(APIView):
     """ User view class. """
     def list(self):
         """ List all users. """
-        papers = filter_user(Paper.query, Paper).all()
+        count = count_user(Paper)
+        # Streaming mode
+        if g.json_params.get("stream"):
+            return stream_json(dump_stream(PaperSchema, query_user_chunks(Paper), nested_user=True), **SUCCESS_RESP, **count)
+        papers = query_user(Paper).all()
         # Success
         return jsonify(
             **SUCCESS_RESP,
+            **pagination_info(papers, Paper),
+            **count,
             data=dump_data(PaperSchema, papers, many=True, nested_user=True)
         )
     @auth_required()
@@ -35,13 +44,48 @@ class PaperView(APIView):
             **SUCCESS_RESP,
             data=dump_data(PaperSchema, paper)
         )
+    @res_action("bulk_create")
+    @auth_required()
+    def bulk_create(self):
+        """ Create papers in batch. """
+        # Load all papers data
+        papers = load_data_many(PaperSchema, [{**item, "author": g.user} for item in get_bulk_data()])
+        # Add to database in a single transaction
+        with map_error({ProgrammingError: handle_bulk_prog_error(papers)}):
+            add_many(Paper, papers)
+            db.session.commit()
+        papers = reload_many(Paper, papers)
+        # Success
+        return jsonify(
+            **SUCCESS_RESP,
+            data=dump_data(PaperSchema, papers, many=True)
+        )
+    @res_action("bulk_update")
+    @auth_required()
+    def bulk_update(self):
+        """ Update papers in batch. """
+        items = get_bulk_data()
+        # Find all papers
+        with map_error(APIError(400, "bad_bulk_data")):
+            ids = [item.pop("id") for item in items]
+        papers = get_pks(Paper, ids)
+        # Load update data, then update in a single transaction
+        load_data_many(PaperSchema, items, instances=papers)
+        with map_error({ProgrammingError: handle_bulk_prog_error(papers)}):
+            db.session.commit()
+        papers = reload_many(Paper, papers)
+        # Success
+        return jsonify(
+            **SUCCESS_RESP,
+            data=dump_data(PaperSchema, papers, many=True)
+        )
     def retrieve(self, id):
         """ Get existing user information. """
         paper = get_pk(Paper, id)
-        return jsonify(
+        return etag_response(entity_etag(paper, nested_user=True), lambda: jsonify(
             **SUCCESS_RESP,
             data=dump_data(PaperSchema, paper, nested_user=True)
-        )
+        ))
     def partial_update(self, id):
         """ Update user information. """
         # Load update data, then find and update user
@@ -66,22 +110,71 @@ class PaperView(APIView):
     @auth_required()
     def toggle_collect_status(self, id):
         """ Toggle paper collection status. """
-        # Find paper
+        # Find paper, then toggle collection without loading collectors
         paper = get_pk(Paper, id)
-        user = g.user
-        # Cancel collection
-        if user in paper.collectors:
-            paper.collectors.remove(user)
-            db.session.commit()
-            return jsonify(
-                **SUCCESS_RESP,
-                collected=False
-            )
-        # Collect paper
-        else:
-            paper.collectors.append(user)
+        collected = toggle_link(Paper.collectors.property, paper.id, g.user_id)
+        db.session.commit()
+        return jsonify(
+            **SUCCESS_RESP,
+            collected=collected
+        )
+    @res_action("set_collect_status")
+    @auth_required()
+    @parse_param(schema_class={
+        "ids": fields.List(fields.Integer(), required=True, validate=validate.Length(max=BULK_MAX_SIZE)),
+        "collected": fields.Boolean(required=True)
+    })
+    def set_collect_status(self):
+        """ Collect or cancel collection of papers in batch. """
+        # Find all papers
+        ids = g.params["ids"]
+        get_pks(Paper, ids)
+        # Update collection status in a single statement
+        changed_ids = set_links(Paper.collectors.property, ids, g.user_id, g.params["collected"])
+        db.session.commit()
+        return jsonify(
+            **SUCCESS_RESP,
+            collected=g.params["collected"],
+            changed=changed_ids
+        )
+    @res_action("upload_init")
+    @auth_required()
+    @parse_param(schema_class={
+        "filename": fields.String(),
+        "content_type": fields.String(),
+        "size": fields.Integer(validate=validate.Range(min=0))
+    })
+    def upload_init(self):
+        """ Start resumable upload of paper file. """
+        return jsonify(
+            **SUCCESS_RESP,
+            **init_upload(g.user_id, **g.params)
+        )
+    @res_action("upload_append")
+    @auth_required()
+    def upload_append(self):
+        """ Append a chunk from request body to resumable upload of paper file. """
+        offset = g.json_params.get("offset")
+        if not isinstance(offset, int):
+            raise APIError(400, "bad_json_params")
+        return jsonify(
+            **SUCCESS_RESP,
+            **append_upload(g.user_id, g.json_params.get("upload_id"), offset, request.stream)
+        )
+    @res_action("upload_finalize")
+    @auth_required()
+    @parse_param(schema_class={
+        "id": fields.Integer(required=True),
+        "upload_id": fields.String(required=True)
+    })
+    def upload_finalize(self):
+        """ Finish resumable upload and set it as paper file. """
+        paper = get_pk(Paper, g.params["id"])
+        with finalize_upload(g.user_id, g.params["upload_id"]) as content:
+            paper.paper_file = content
             db.session.commit()
-            return jsonify(
-                **SUCCESS_RESP,
-                collected=True
-            )
+        # Success
+        return jsonify(
+            **SUCCESS_RESP,
+            data=dump_data(PaperSchema, paper)
+        )
@@ -9,19 +9,26 @@ from app import db
 from app.models import User, Session
 from app.schemas import UserSchema
 from app.config import TOKEN_LEN, AUTH_TOKEN_HEADER
-from app.util.core import SUCCESS_RESP, APIView, register_view, res_action, assert_logic, APIError, map_error
-from app.util.data import load_data, dump_data, get_pk, get_by, parse_param, filter_user, get_data, handle_prog_error
+from app.util.core import SUCCESS_RESP, APIView, register_view, res_action, assert_logic, APIError, map_error, stream_json, auth_cache, etag_response
+from app.util.data import load_data, dump_data, dump_stream, get_pk, get_by, parse_param, query_user, query_user_chunks, count_user, pagination_info, entity_etag, get_data, handle_prog_error
 from app.util.perm import auth_required
+from app.util.password import check_password, check_dummy_password
 
 @register_view("/users")
 class UserView(APIView):
     """ User view class. """
     def list(self):
         """ List all users. """
-        users = filter_user(User.query, User).all()
+        count = count_user(User)
+        # Streaming mode
+        if g.json_params.get("stream"):
+            return stream_json(dump_stream(UserSchema, query_user_chunks(User), nested_user=True), **SUCCESS_RESP, **count)
+        users = query_user(User).all()
         # Success
         return jsonify(
             **SUCCESS_RESP,
+            **pagination_info(users, User),
+            **count,
             data=dump_data(UserSchema, users, many=True, nested_user=True)
         )
     def create(self):
@@ -42,10 +49,10 @@ class UserView(APIView):
     def retrieve(self, id):
         """ Get existing user information. """
         user = get_pk(User, id)
-        return jsonify(
+        return etag_response(entity_etag(user, nested_user=True), lambda: jsonify(
             **SUCCESS_RESP,
             data=dump_data(UserSchema, user, nested_user=True)
-        )
+        ))
     def partial_update(self, id):
         """ Update user information. """
         # Load update data, then find and update user
@@ -63,27 +70,26 @@ class UserView(APIView):
         # Find and remove user
         user = get_pk(User, id)
         db.session.delete(user)
+        # Invalidate cached sessions of user in all workers
+        auth_cache.revoke(user_id=id)
         db.session.commit()
         # Success
         return jsonify(**SUCCESS_RESP)
     @res_action("login")
     @parse_param(schema_class={
-        "username": fields.String(),
-        "password": fields.Method(deserialize="calc_password"),
-        "calc_password": UserSchema.calc_password
+        "username": fields.String(required=True),
+        "password": fields.String(required=True)
     })
     def login(self):
         """ Log user in. """
-        import sys
-        print(g, file=sys.stderr)
-        assert g.params!=None
-        # Find user
-        user = get_by(
-            User,
-            username=g.params["username"],
-            password=g.params["password"],
-            error=APIError(401, "incorrect_credential")
-        )
+        # Find user, then verify password
+        user = get_by(User, allow_null=True, username=g.params["username"])
+        # Unknown users are hashed for as long as existing ones
+        if not user:
+            check_dummy_password(g.params["password"])
+            raise APIError(401, "incorrect_credential")
+        if not check_password(user, g.params["password"]):
+            raise APIError(401, "incorrect_credential")
         # Log user in
         session = Session(token=os.urandom(TOKEN_LEN), user=user)
         db.session.add(session)
@@ -102,8 +108,11 @@ class UserView(APIView):
         """ Log user out. """
         # Remove current session
         with map_error(APIError(400, "bad_token")):
-            api_session = get_by(Session, b64decode(request.headers[AUTH_TOKEN_HEADER]))
+            token = b64decode(request.headers[AUTH_TOKEN_HEADER])
+            api_session = get_pk(Session, token)
             db.session.delete(api_session)
+            # Invalidate cached session in all workers
+            auth_cache.revoke(token=token)
             db.session.commit()
         # Success
         return jsonify(**SUCCESS_RESP)
@@ -16,14 +16,23 @@ if __name__=="__main__":
     parser.add_argument("-t", "--test", action="store_const", dest="mode", const="test", help="Test mode.")
     parser.add_argument("-P", "--production", action="store_true", help="Production mode.")
     parser.add_argument("-s", "--shell", action="store_const", dest="mode", const="shell", help="Interactive mode.")
+    parser.add_argument("-u", "--upgrade", action="store_const", dest="mode", const="upgrade", help="Upgrade existing database.")
+    parser.add_argument("--recount", action="store_const", dest="mode", const="recount", help="Recompute denormalized counters.")
+    parser.add_argument("-w", "--worker", action="store_const", dest="mode", const="worker", help="Background job worker mode.")
+    parser.add_argument("--workers", type=int, help="Job worker threads for worker mode.")
+    parser.add_argument("-b", "--bench", action="store_const", dest="mode", const="bench", help="Benchmark mode.")
+    parser.add_argument("--bench-db", help="Database URI for benchmark mode. (In-memory SQLite by default)")
+    parser.add_argument("--bench-scale", type=int, default=1, help="Synthetic dataset scale for benchmark mode.")
+    parser.add_argument("--bench-requests", type=int, default=200, help="Requests per benchmark scenario.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of synthetic data.")
     parser.add_argument("-r", "--reset", action="store_true", help="Reset database.")
     # Parse arguments
     args = vars(parser.parse_args())
     if not args.get("mode"):
         args["mode"] = "app"
     app.run_with_mode(**args)
-# Production mode; get WSGI application
-else:
+# Production mode; get WSGI application (Not in hashing processes, which run this file as "__mp_main__")
+elif __name__!="__mp_main__":
     # Set-up application
     app.setup_app(db_uri=app.DB_URI)
     # Create database